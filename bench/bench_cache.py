@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2014 Red Hat, Inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+# Compares the size and read time of cached query results
+# stored with each of the compression formats. Cold reads
+# evict the file from the page cache first, which is the
+# case that matters on network filesystems. Point --dir
+# at such a filesystem to measure it
+
+import argparse
+import json
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from gerrymander.cache import CacheBackendFiles
+
+
+def make_change(number):
+    # Roughly what '--patch-sets --all-approvals --files
+    # --comments' returns for a typical change
+    patches = []
+    for patch in range(random.randint(1, 8)):
+        patches.append({
+            "number": str(patch + 1),
+            "revision": "%040x" % random.getrandbits(160),
+            "createdOn": 1400000000 + number,
+            "uploader": {"name": "Some Body", "username": "somebody"},
+            "approvals": [
+                {"type": "Code-Review", "value": str(random.randint(-2, 2)),
+                 "grantedOn": 1400000000 + number,
+                 "by": {"name": "Reviewer %d" % idx,
+                        "username": "reviewer%d" % idx}}
+                for idx in range(random.randint(0, 6))
+            ],
+            "files": [
+                {"file": "nova/compute/module%d.py" % idx, "type": "MODIFIED",
+                 "insertions": random.randint(0, 100),
+                 "deletions": -random.randint(0, 100)}
+                for idx in range(random.randint(1, 10))
+            ],
+        })
+    return {
+        "project": "openstack/nova",
+        "branch": "master",
+        "id": "I%040x" % random.getrandbits(160),
+        "number": str(number),
+        "subject": "Fix the frobnication of widget %d" % number,
+        "owner": {"name": "Some Body", "username": "somebody"},
+        "url": "https://review.openstack.org/%d" % number,
+        "createdOn": 1400000000 + number,
+        "lastUpdated": 1400000000 + number,
+        "status": "MERGED",
+        "comments": [
+            {"timestamp": 1400000000 + number,
+             "reviewer": {"name": "Reviewer", "username": "reviewer"},
+             "message": "Patch Set 1: Code-Review+1\n\n" + "Looks good. " * 20}
+            for idx in range(random.randint(0, 8))
+        ],
+        "patchSets": patches,
+    }
+
+
+def drop_page_cache(file):
+    fd = os.open(file, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    finally:
+        os.close(fd)
+
+
+def time_replay(cache, key, cold):
+    if cold:
+        drop_page_cache(cache._get_file(key, ".json"))
+    rows = []
+    start = time.time()
+    cache.replay(key, rows.append)
+    return time.time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark cache compression")
+    parser.add_argument("--changes", type=int, default=20000,
+                        help="Number of changes in the cached result")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="Number of times to repeat each read")
+    parser.add_argument("--dir", default=None,
+                        help="Directory to create the cache in")
+    options = parser.parse_args()
+
+    random.seed(0)
+    lines = [(json.dumps(make_change(number)) + "\n").encode("UTF-8")
+             for number in range(options.changes)]
+
+    print("%-6s %10s %10s %10s %10s" % ("format", "size (MB)", "write (s)",
+                                         "cold (s)", "warm (s)"))
+    for compression in ["none", "gzip", "lzma", "zstd"]:
+        if not CacheBackendFiles._has_compression(compression):
+            print("%-6s %10s" % (compression, "n/a"))
+            continue
+
+        cachedir = tempfile.mkdtemp(prefix="gerrymander-bench-", dir=options.dir)
+        try:
+            cache = CacheBackendFiles(cachedir, 3600, 3600,
+                                      compression=compression)
+            start = time.time()
+            entry = cache.open_entry("bench", "")
+            for line in lines:
+                entry.write(line)
+            entry.commit()
+            write = time.time() - start
+
+            size = os.path.getsize(cache._get_file("bench", ".json"))
+            cold = min([time_replay(cache, "bench", True)
+                        for i in range(options.repeat)])
+            warm = min([time_replay(cache, "bench", False)
+                        for i in range(options.repeat)])
+            print("%-6s %10.1f %10.3f %10.3f %10.3f" %
+                  (compression, size / 1024.0 / 1024.0, write, cold, warm))
+        finally:
+            shutil.rmtree(cachedir)
+
+
+if __name__ == '__main__':
+    main()
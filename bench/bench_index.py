@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+#
+# Copyright (C) 2014 Red Hat, Inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+# Compares matching the files touched by a set of changes
+# against a list of regexes, the way the 'changes --file'
+# report used to, with looking them up in an IndexPath
+
+import argparse
+import os
+import random
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from gerrymander.index import IndexPath
+from gerrymander.model import ModelChange
+
+
+def make_tree(dirs, files):
+    # A source tree a few levels deep, like a large project
+    paths = []
+    for idx in range(dirs):
+        parts = ["nova"]
+        for depth in range(random.randint(1, 3)):
+            parts.append("%s%d" % (random.choice(["virt", "compute", "api",
+                                                  "network", "tests", "db"]),
+                                   random.randint(0, 20)))
+        for file in range(files):
+            paths.append("/".join(parts + ["module%d.py" % file]))
+    return paths
+
+
+def make_changes(paths, entries):
+    # Most changes touch a handful of files, with some files
+    # touched by far more changes than others
+    changes = []
+    number = 0
+    while entries > 0:
+        count = min(entries, random.randint(1, 20))
+        files = []
+        for idx in range(count):
+            if random.random() < 0.3:
+                path = paths[int(random.paretovariate(1.0)) % 100]
+            else:
+                path = random.choice(paths)
+            files.append({"file": path})
+        changes.append(ModelChange.from_json({
+            "number": str(number),
+            "patchSets": [{"number": "1", "files": files}],
+        }))
+        entries = entries - count
+        number = number + 1
+    return changes
+
+
+def match_loop(changes, patterns):
+    found = set()
+    for change in changes:
+        for pattern in patterns:
+            for file in change.get_current_patch().files:
+                if re.search(pattern, file.path):
+                    found.add(change.number)
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark file path matching")
+    parser.add_argument("--entries", type=int, default=100000,
+                        help="Number of files touched across all changes")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="Number of times to repeat each match")
+    options = parser.parse_args()
+
+    random.seed(0)
+    paths = make_tree(2000, 10)
+    changes = make_changes(paths, options.entries)
+
+    patternsets = [
+        ["^nova/virt1/"],
+        ["^nova/virt1/", "^nova/db2/", "^nova/api/"],
+        ["module3\\.py$"],
+        ["libvirt", "xenapi", "hyperv", "vmware", "^nova/db"],
+    ]
+
+    start = time.time()
+    index = IndexPath(changes)
+    build = time.time() - start
+    print("%d changes, %d file entries, %d distinct paths, index built in %0.3fs" %
+          (len(changes), options.entries, len(index.paths), build))
+    print("")
+    print("%-50s %10s %10s" % ("patterns", "loop (s)", "index (s)"))
+    for patterns in patternsets:
+        loop = None
+        indexed = None
+        for i in range(options.repeat):
+            start = time.time()
+            expect = match_loop(changes, patterns)
+            took = time.time() - start
+            if loop is None or took < loop:
+                loop = took
+
+            start = time.time()
+            found = index.find(patterns)
+            took = time.time() - start
+            if indexed is None or took < indexed:
+                indexed = took
+
+            if found != expect:
+                raise Exception("Index found %d changes, not %d for %s" %
+                                (len(found), len(expect), patterns))
+
+        print("%-50s %10.3f %10.3f" % (" ".join(patterns), loop, indexed))
+
+
+if __name__ == '__main__':
+    main()
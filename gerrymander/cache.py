@@ -0,0 +1,950 @@
+#
+# Copyright (C) 2014 Red Hat, Inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import errno
+import fcntl
+import gzip
+import io
+import json
+import logging
+import mmap
+import os
+import os.path
+import pickle
+import sqlite3
+import stat
+import threading
+import time
+
+# Neither is available on every python
+try:
+    import lzma
+except ImportError:
+    lzma = None
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+LOG = logging.getLogger(__name__)
+
+
+class CacheLock(object):
+    def __init__(self, lockfile):
+        self.lockfile = lockfile
+
+    def __enter__(self):
+        self.lockfh = open(self.lockfile, "w")
+        fcntl.lockf(self.lockfh, fcntl.LOCK_EX)
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        try:
+            fcntl.lockf(self.lockfh, fcntl.LOCK_UN)
+            self.lockfh.close()
+            self.lockfh = None
+        except:
+            LOG.exception("could not release lock on %s" % self.lockfile)
+
+
+class CacheEntryLock(object):
+    '''An exclusive lock on a single cache entry, held while
+    it is being fetched. It uses flock rather than lockf, so
+    that it excludes other threads as well as processes.
+    The lock file is deleted on release, so they don't pile
+    up for every key ever fetched'''
+
+    def __init__(self, lockfile):
+        self.lockfile = lockfile
+        self.lockfh = None
+        self.waited = False
+
+    def acquire(self, blocking=True):
+        while True:
+            lockfh = open(self.lockfile, "a")
+            try:
+                fcntl.flock(lockfh, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError as e:
+                if e.errno not in (errno.EAGAIN, errno.EACCES):
+                    lockfh.close()
+                    raise
+                if not blocking:
+                    lockfh.close()
+                    return False
+                LOG.debug("waiting for lock %s" % self.lockfile)
+                fcntl.flock(lockfh, fcntl.LOCK_EX)
+                self.waited = True
+
+            # The previous holder may have deleted the file
+            # after we opened it, in which case our lock is
+            # on an orphaned inode and we must try again
+            try:
+                current = os.stat(self.lockfile).st_ino
+            except OSError:
+                current = None
+            if current == os.fstat(lockfh.fileno()).st_ino:
+                self.lockfh = lockfh
+                return True
+            lockfh.close()
+
+    def is_held(self):
+        '''Determine if anyone holds the lock, without taking it'''
+        try:
+            lockfh = open(self.lockfile, "r")
+        except IOError as e:
+            if e.errno == errno.ENOENT:
+                return False
+            raise
+        try:
+            fcntl.flock(lockfh, fcntl.LOCK_SH | fcntl.LOCK_NB)
+        except IOError as e:
+            if e.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+            return True
+        finally:
+            lockfh.close()
+        return False
+
+    def release(self):
+        try:
+            os.unlink(self.lockfile)
+        except OSError:
+            LOG.exception("could not remove lock %s" % self.lockfile)
+        fcntl.flock(self.lockfh, fcntl.LOCK_UN)
+        self.lockfh.close()
+        self.lockfh = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.release()
+
+
+class CachePickle(object):
+    '''Objects pickled to save decoding them again. Unpickling
+    can run arbitrary code, and objects from another version
+    may not match the classes, so anything written by another
+    user or another format version is refused unread'''
+
+    # Must be bumped whenever the classes in gerrymander.model
+    # or gerrymander.index change what they hold
+    HEADER = b"gerrymander-pickle-2\n"
+
+    @staticmethod
+    def dumps(obj):
+        return CachePickle.HEADER + pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)
+
+    @staticmethod
+    def loads(data, path):
+        '''Return the object pickled in 'data', which was read
+        from the file 'path', or None if it is refused'''
+        if not data.startswith(CachePickle.HEADER):
+            LOG.debug("Ignoring objects in %s from another version" % path)
+            return None
+        # Group write permission is left alone, since many
+        # systems give each user a group of their own
+        st = os.stat(path)
+        if st.st_uid != os.getuid() or st.st_mode & stat.S_IWOTH:
+            LOG.warning("Ignoring objects in %s writable by other users" % path)
+            return None
+        return pickle.loads(data[len(CachePickle.HEADER):])
+
+
+class CacheDatabase(object):
+    '''An SQLite database file, with a separate connection
+    for each thread that uses it'''
+
+    SCHEMA = []
+
+    # Tuples of table, name and type of each column added
+    # since the tables were first created
+    COLUMNS = []
+
+    # Bumped when the tables change in a way COLUMNS can't
+    # describe. The tables listed in DISCARD are then dropped,
+    # along with everything in them, and created afresh
+    VERSION = 0
+    DISCARD = []
+
+    def __init__(self, dbfile):
+        self.dbfile = dbfile
+        self.local = threading.local()
+
+        with self._get_conn() as conn:
+            if conn.execute("PRAGMA user_version").fetchone()[0] < self.VERSION:
+                # Several processes may be starting up at once
+                conn.execute("BEGIN IMMEDIATE")
+                if conn.execute("PRAGMA user_version").fetchone()[0] < self.VERSION:
+                    for table in self.DISCARD:
+                        conn.execute("DROP TABLE IF EXISTS %s" % table)
+                    conn.execute("PRAGMA user_version = %d" % self.VERSION)
+            for sql in self.SCHEMA:
+                conn.execute(sql)
+            for table, column, coltype in self.COLUMNS:
+                cur = conn.execute("PRAGMA table_info(%s)" % table)
+                if column in [row[1] for row in cur]:
+                    continue
+                try:
+                    conn.execute("ALTER TABLE %s ADD COLUMN %s %s" %
+                                 (table, column, coltype))
+                except sqlite3.OperationalError:
+                    # Another process may have just added it
+                    cur = conn.execute("PRAGMA table_info(%s)" % table)
+                    if column not in [row[1] for row in cur]:
+                        raise
+
+    def _get_conn(self):
+        # SQLite connections can't be shared between threads
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.dbfile, timeout=60)
+            self.local.conn = conn
+        return conn
+
+
+class CacheManifest(CacheDatabase):
+    '''Tracks the size, modification and access time of every
+    file in a cache directory, so expired and least recently
+    used files can be found without scanning the directory'''
+
+    SCHEMA = [
+        '''CREATE TABLE IF NOT EXISTS entries (
+               name TEXT PRIMARY KEY,
+               kind TEXT NOT NULL,
+               size INTEGER NOT NULL,
+               atime REAL NOT NULL,
+               mtime REAL NOT NULL)''',
+        '''CREATE INDEX IF NOT EXISTS entries_mtime
+               ON entries (kind, mtime)''',
+        '''CREATE INDEX IF NOT EXISTS entries_atime
+               ON entries (atime)''',
+        '''CREATE TABLE IF NOT EXISTS total (
+               size INTEGER NOT NULL)''',
+        '''INSERT INTO total SELECT 0 WHERE NOT EXISTS (SELECT 1 FROM total)''',
+        '''CREATE TRIGGER IF NOT EXISTS entries_insert AFTER INSERT ON entries
+               BEGIN UPDATE total SET size = size + NEW.size; END''',
+        '''CREATE TRIGGER IF NOT EXISTS entries_delete AFTER DELETE ON entries
+               BEGIN UPDATE total SET size = size - OLD.size; END''',
+        '''CREATE TRIGGER IF NOT EXISTS entries_update AFTER UPDATE OF size ON entries
+               BEGIN UPDATE total SET size = size - OLD.size + NEW.size; END''',
+    ]
+
+    COLUMNS = [
+        ("entries", "rowlimit", "INTEGER"),
+    ]
+
+    def __init__(self, dbfile):
+        self.created = not os.path.exists(dbfile)
+        super(CacheManifest, self).__init__(dbfile)
+
+    def add(self, name, kind, size, now, limit=None):
+        with self._get_conn() as conn:
+            # Not 'INSERT OR REPLACE', as that would not run the
+            # delete trigger which keeps the total size correct
+            conn.execute("DELETE FROM entries WHERE name = ?", (name,))
+            conn.execute("INSERT INTO entries (name, kind, size, atime, mtime, rowlimit) "
+                         "VALUES (?, ?, ?, ?, ?, ?)",
+                         (name, kind, size, now, now, limit))
+
+    def remove(self, name):
+        with self._get_conn() as conn:
+            conn.execute("DELETE FROM entries WHERE name = ?", (name,))
+
+    def touch(self, name, now):
+        # Access times only need to be roughly right for LRU
+        # ordering, so skip writing on every single access
+        with self._get_conn() as conn:
+            conn.execute("UPDATE entries SET atime = ? WHERE name = ? AND atime < ?",
+                         (now, name, now - 60))
+
+    def get_info(self, name):
+        cur = self._get_conn().execute("SELECT mtime, rowlimit FROM entries "
+                                       "WHERE name = ?", (name,))
+        return cur.fetchone()
+
+    def get_expired(self, kind, before):
+        cur = self._get_conn().execute("SELECT name FROM entries "
+                                       "WHERE kind = ? AND mtime < ?",
+                                       (kind, before))
+        return [row[0] for row in cur]
+
+    def get_total_size(self):
+        return self._get_conn().execute("SELECT size FROM total").fetchone()[0]
+
+    def get_least_recent(self, limit):
+        # Files still being written are never candidates
+        cur = self._get_conn().execute("SELECT name, size FROM entries "
+                                       "WHERE kind != '.tmp' "
+                                       "ORDER BY atime LIMIT ?", (limit,))
+        return cur.fetchall()
+
+
+class CacheBackend(object):
+    '''Storage for the results of gerrit commands. Each
+    result is identified by a key derived from the command
+    arguments, along with a variant that identifies the set
+    of flags that determine the content of change records'''
+
+    def __init__(self, cachedir, cachelifetime, snapshotlifetime):
+        self.cachedir = cachedir
+        self.cachelifetime = cachelifetime
+        self.snapshotlifetime = snapshotlifetime
+        self.lastpurge = None
+        self.purgelock = threading.Lock()
+        self.lockdir = os.path.join(self.cachedir, "locks")
+
+        # Several processes may be starting up at once
+        try:
+            os.makedirs(self.lockdir)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+    def _purge_locked(self, now):
+        raise NotImplementedError("Subclass should override _purge_locked method")
+
+    def lock_entry(self, key):
+        '''Return a lock to serialize fetching the entry for 'key'
+        across all threads and processes sharing the cache'''
+        return CacheEntryLock(os.path.join(self.lockdir, key + ".lock"))
+
+    def purge(self):
+        # Readers don't need protecting against files being
+        # deleted, since they already have them open, and
+        # replay copes with them going away beforehand
+        lock = CacheLock(os.path.join(self.cachedir, "lock"))
+        LOG.debug("acquiring lock for cache")
+        # The lock file only excludes other processes, so
+        # threads sharing this cache need their own lock
+        with self.purgelock:
+            now = time.time()
+            if self.lastpurge is not None and (now - self.lastpurge) < 60 * 60:
+                return
+            self.lastpurge = now
+
+            with lock as lock:
+                self._purge_locked(now)
+
+    def get_info(self, key):
+        '''Return a tuple of the time the result stored under
+        'key' was fetched and the limit on the number of changes
+        it was fetched with, or None if there is no such result'''
+        raise NotImplementedError("Subclass should override get_info method")
+
+    def replay(self, key, cb):
+        '''Pass each row of the result stored under 'key' to
+        'cb', returning False if there is no such result'''
+        raise NotImplementedError("Subclass should override replay method")
+
+    def open_entry(self, key, variant, limit=None):
+        '''Return a writer for a new result to be stored under
+        'key', fetched with at most 'limit' changes. Lines of
+        command output are passed to its 'write' method,
+        followed by 'commit' on success or 'abort' on failure'''
+        raise NotImplementedError("Subclass should override open_entry method")
+
+    def load_objects(self, key):
+        '''Return a tuple of the time recorded with the objects
+        decoded from the result stored under 'key' and a list
+        of the objects, or None'''
+        raise NotImplementedError("Subclass should override load_objects method")
+
+    def save_objects(self, key, fetched, objects):
+        raise NotImplementedError("Subclass should override save_objects method")
+
+    def load_snapshot(self, key):
+        '''Return a tuple of the header of the snapshot stored
+        under 'key' and its rows, or None. The header is a dict
+        which always records when it was fetched'''
+        raise NotImplementedError("Subclass should override load_snapshot method")
+
+    def save_snapshot(self, key, variant, header, rows):
+        raise NotImplementedError("Subclass should override save_snapshot method")
+
+
+class CacheEntryFiles(object):
+
+    def __init__(self, backend, file, compress=True, limit=None):
+        self.backend = backend
+        self.file = file
+        self.limit = limit
+        self.tmpfile = "%s.%d.%d.tmp" % (file, os.getpid(),
+                                         threading.current_thread().ident)
+        # Registered so it gets purged if we crash before
+        # it can be committed or aborted
+        self.backend._add_file(self.tmpfile, 0)
+        self.fh = open(self.tmpfile, "wb")
+        if compress:
+            self.out = self.backend._compress(self.fh)
+        else:
+            self.out = self.fh
+
+    def write(self, line):
+        self.out.write(line)
+
+    def commit(self):
+        self.out.close()
+        self.fh.close()
+        size = os.path.getsize(self.tmpfile)
+        os.rename(self.tmpfile, self.file)
+        self.backend._remove_file(self.tmpfile)
+        self.backend._add_file(self.file, size, self.limit)
+
+    def abort(self):
+        self.out.close()
+        self.fh.close()
+        os.unlink(self.tmpfile)
+        self.backend._remove_file(self.tmpfile)
+
+
+class CacheBackendFiles(CacheBackend):
+    '''Stores each result as a file of JSON lines, exactly
+    as they were received from the server, optionally
+    compressed. A manifest tracks the size and last access
+    of each file, so that purging never has to scan the
+    whole directory'''
+
+    SUFFIXES = (".json", ".pickle", ".snapshot", ".tmp")
+
+    # How much longer than the cache lifetime files still being
+    # written are kept, as a slow query may take that long
+    TMP_GRACE = 24 * 60 * 60
+
+    COMPRESSION_NONE = "none"
+    COMPRESSION_GZIP = "gzip"
+    COMPRESSION_LZMA = "lzma"
+    COMPRESSION_ZSTD = "zstd"
+
+    # The leading bytes of each compressed format. Files are
+    # identified by these rather than by name, so changing
+    # the compression doesn't invalidate what's cached
+    MAGIC = [
+        (b"\x1f\x8b", COMPRESSION_GZIP),
+        (b"\xfd7zXZ\x00", COMPRESSION_LZMA),
+        (b"\x28\xb5\x2f\xfd", COMPRESSION_ZSTD),
+    ]
+
+    def __init__(self, cachedir, cachelifetime, snapshotlifetime, maxsize=None,
+                 compression=COMPRESSION_NONE):
+        super(CacheBackendFiles, self).__init__(cachedir, cachelifetime,
+                                                snapshotlifetime)
+        self.maxsize = maxsize
+        if not self._has_compression(compression):
+            raise Exception("Compression '%s' is not available" % compression)
+        self.compression = compression
+        self.manifest = CacheManifest(os.path.join(self.cachedir, "manifest.db"))
+        if self.manifest.created:
+            self._scan()
+
+    def _scan(self):
+        # Register any files left by a version of the cache
+        # that did not maintain the manifest
+        with CacheLock(os.path.join(self.cachedir, "lock")):
+            for file in os.listdir(self.cachedir):
+                if not file.endswith(CacheBackendFiles.SUFFIXES):
+                    continue
+                filepath = os.path.join(self.cachedir, file)
+                st = os.stat(filepath)
+                self.manifest.add(file, os.path.splitext(file)[1],
+                                  st.st_size, st.st_mtime)
+
+    def _add_file(self, file, size, limit=None):
+        name = os.path.basename(file)
+        self.manifest.add(name, os.path.splitext(name)[1], size, time.time(), limit)
+
+    def _remove_file(self, file):
+        self.manifest.remove(os.path.basename(file))
+
+    def _unlink_locked(self, name):
+        filepath = os.path.join(self.cachedir, name)
+        try:
+            os.unlink(filepath)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+        self.manifest.remove(name)
+
+    def _purge_locked(self, now):
+        # Snapshots are updated incrementally, so are
+        # still useful long after they have expired
+        for kind, lifetime in [(".json", self.cachelifetime),
+                               (".pickle", self.cachelifetime),
+                               (".tmp", self.cachelifetime + self.TMP_GRACE),
+                               (".snapshot", self.snapshotlifetime)]:
+            then = now - lifetime
+            LOG.debug("Looking for %s files in %s older than %d" % (kind, self.cachedir, then))
+            for name in self.manifest.get_expired(kind, then):
+                # Only left behind if whoever was fetching the
+                # entry has given up on it
+                if (kind == ".tmp" and
+                    self.lock_entry(name.split(".", 1)[0]).is_held()):
+                    continue
+                LOG.info("Purging outdated cache %s" % name)
+                self._unlink_locked(name)
+
+    def _evict_locked(self):
+        excess = self.manifest.get_total_size() - self.maxsize
+        while excess > 0:
+            entries = self.manifest.get_least_recent(100)
+            if len(entries) == 0:
+                break
+            for name, size in entries:
+                if excess <= 0:
+                    break
+                LOG.info("Evicting least recently used cache %s" % name)
+                self._unlink_locked(name)
+                excess = excess - size
+
+    def purge(self):
+        super(CacheBackendFiles, self).purge()
+
+        if self.maxsize is None or self.manifest.get_total_size() <= self.maxsize:
+            return
+        with self.purgelock:
+            with CacheLock(os.path.join(self.cachedir, "lock")):
+                self._evict_locked()
+
+    def _get_file(self, key, suffix):
+        return os.path.join(self.cachedir, key + suffix)
+
+    @staticmethod
+    def _has_compression(compression):
+        if compression in (CacheBackendFiles.COMPRESSION_NONE,
+                           CacheBackendFiles.COMPRESSION_GZIP):
+            return True
+        if compression == CacheBackendFiles.COMPRESSION_LZMA:
+            return lzma is not None
+        if compression == CacheBackendFiles.COMPRESSION_ZSTD:
+            return zstandard is not None
+        return False
+
+    def _compress(self, fh):
+        # Returns a writer which must be closed before 'fh'
+        if self.compression == CacheBackendFiles.COMPRESSION_GZIP:
+            return gzip.GzipFile(fileobj=fh, mode="wb", compresslevel=6)
+        elif self.compression == CacheBackendFiles.COMPRESSION_LZMA:
+            return lzma.LZMAFile(fh, "wb", preset=1)
+        elif self.compression == CacheBackendFiles.COMPRESSION_ZSTD:
+            return zstandard.ZstdCompressor().stream_writer(fh)
+        return fh
+
+    def _decompress(self, f):
+        # Returns None if the file needs a module we lack
+        magic = f.read(6)
+        f.seek(0)
+        for prefix, compression in CacheBackendFiles.MAGIC:
+            if not magic.startswith(prefix):
+                continue
+            if not self._has_compression(compression):
+                LOG.warning("Cannot read %s compressed cache %s" % (compression, f.name))
+                return None
+            if compression == CacheBackendFiles.COMPRESSION_GZIP:
+                return gzip.GzipFile(fileobj=f, mode="rb")
+            elif compression == CacheBackendFiles.COMPRESSION_LZMA:
+                return lzma.LZMAFile(f, "rb")
+            else:
+                return io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(f))
+
+        # Plain JSON, but mmap refuses to map an empty file
+        if os.fstat(f.fileno()).st_size == 0:
+            return io.BytesIO()
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def _replay_file(self, file, cb):
+        try:
+            f = open(file, "rb")
+        except IOError as e:
+            if e.errno == errno.ENOENT:
+                return False
+            raise
+
+        with f:
+            # Lines are decoded as they are read, so the
+            # whole file is never held in memory at once
+            data = self._decompress(f)
+            if data is None:
+                return False
+            try:
+                while True:
+                    line = data.readline()
+                    if not line:
+                        break
+                    try:
+                        dec = json.loads(line.decode("UTF-8"))
+                    except ValueError:
+                        LOG.exception("Failure decoding %s", line)
+                        continue
+                    cb(dec)
+            finally:
+                data.close()
+        return True
+
+    def get_info(self, key):
+        return self.manifest.get_info(key + ".json")
+
+    def replay(self, key, cb):
+        file = self._get_file(key, ".json")
+        if not self._replay_file(file, cb):
+            return False
+        self.manifest.touch(os.path.basename(file), time.time())
+        return True
+
+    def open_entry(self, key, variant, limit=None):
+        return CacheEntryFiles(self, self._get_file(key, ".json"), limit=limit)
+
+    def load_objects(self, key):
+        file = self._get_file(key, ".pickle")
+        try:
+            with open(file, "rb") as f:
+                objects = CachePickle.loads(f.read(), file)
+        except IOError as e:
+            if e.errno == errno.ENOENT:
+                return None
+            raise
+        except Exception:
+            LOG.exception("Failure loading %s", file)
+            return None
+        if objects is None:
+            return None
+        self.manifest.touch(os.path.basename(file), time.time())
+        return objects
+
+    def save_objects(self, key, fetched, objects):
+        # Already compact, and mostly decoded to save CPU time
+        entry = CacheEntryFiles(self, self._get_file(key, ".pickle"), compress=False)
+        try:
+            entry.write(CachePickle.dumps((fetched, objects)))
+            entry.commit()
+        except:
+            entry.abort()
+            raise
+
+    def load_snapshot(self, key):
+        file = self._get_file(key, ".snapshot")
+        rows = []
+        if not self._replay_file(file, rows.append):
+            return None
+        self.manifest.touch(os.path.basename(file), time.time())
+
+        if len(rows) == 0 or "fetched" not in rows[0]:
+            LOG.warning("Ignoring malformed snapshot %s" % file)
+            return None
+        return (rows[0], rows[1:])
+
+    def save_snapshot(self, key, variant, header, rows):
+        entry = CacheEntryFiles(self, self._get_file(key, ".snapshot"))
+        try:
+            entry.write((json.dumps(header) + "\n").encode("UTF-8"))
+            for row in rows:
+                entry.write((json.dumps(row) + "\n").encode("UTF-8"))
+            entry.commit()
+        except:
+            entry.abort()
+            raise
+
+
+class CacheEntrySQLite(object):
+
+    def __init__(self, backend, key, variant, limit):
+        self.backend = backend
+        self.key = key
+        self.variant = variant
+        self.limit = limit
+        self.rows = []
+
+    def write(self, line):
+        try:
+            self.rows.append(json.loads(line.decode("UTF-8")))
+        except ValueError:
+            LOG.exception("Failure decoding %s", line)
+
+    def commit(self):
+        self.backend.store(self.key, self.variant,
+                           CacheBackendSQLite.KIND_QUERY,
+                           time.time(), self.rows, self.limit)
+
+    def abort(self):
+        self.rows = None
+
+
+class CacheBackendSQLite(CacheBackend, CacheDatabase):
+    '''Stores changes, patch sets and approvals in their own
+    tables, keyed on change number, the variant of the query
+    flags and the time the change was last updated, so a
+    change that appears in the results of many queries is
+    only stored once. Each result is a list of references
+    to the exact version of the changes it contained, so
+    that fetching a newer version doesn't alter it'''
+
+    KIND_QUERY = "query"
+    KIND_SNAPSHOT = "snapshot"
+
+    SCHEMA = [
+        '''CREATE TABLE IF NOT EXISTS queries (
+               key TEXT PRIMARY KEY,
+               kind TEXT NOT NULL,
+               fetched REAL NOT NULL)''',
+        '''CREATE INDEX IF NOT EXISTS queries_fetched
+               ON queries (kind, fetched)''',
+        '''CREATE TABLE IF NOT EXISTS results (
+               key TEXT NOT NULL,
+               seq INTEGER NOT NULL,
+               number INTEGER,
+               variant TEXT,
+               updated INTEGER,
+               data TEXT,
+               PRIMARY KEY (key, seq))''',
+        '''CREATE INDEX IF NOT EXISTS results_change
+               ON results (number, variant, updated)''',
+        '''CREATE TABLE IF NOT EXISTS objects (
+               key TEXT PRIMARY KEY,
+               fetched REAL NOT NULL,
+               data BLOB NOT NULL)''',
+        '''CREATE TABLE IF NOT EXISTS changes (
+               number INTEGER NOT NULL,
+               variant TEXT NOT NULL,
+               lastUpdated INTEGER NOT NULL,
+               project TEXT,
+               status TEXT,
+               data TEXT NOT NULL,
+               PRIMARY KEY (number, variant, lastUpdated))''',
+        '''CREATE TABLE IF NOT EXISTS patchsets (
+               change INTEGER NOT NULL,
+               variant TEXT NOT NULL,
+               updated INTEGER NOT NULL,
+               field TEXT NOT NULL,
+               seq INTEGER NOT NULL,
+               number INTEGER,
+               data TEXT NOT NULL,
+               PRIMARY KEY (change, variant, updated, field, seq))''',
+        '''CREATE TABLE IF NOT EXISTS approvals (
+               change INTEGER NOT NULL,
+               variant TEXT NOT NULL,
+               updated INTEGER NOT NULL,
+               field TEXT NOT NULL,
+               patchset INTEGER NOT NULL,
+               seq INTEGER NOT NULL,
+               type TEXT,
+               value INTEGER,
+               grantedOn INTEGER,
+               username TEXT,
+               data TEXT NOT NULL,
+               PRIMARY KEY (change, variant, updated, field, patchset, seq))''',
+    ]
+
+    # Changes used to be keyed without the time they were
+    # last updated, and nothing else in the cache is worth
+    # keeping without them
+    VERSION = 1
+    DISCARD = ["queries", "results", "objects",
+               "changes", "patchsets", "approvals"]
+
+    COLUMNS = [
+        ("queries", "rowlimit", "INTEGER"),
+    ]
+
+    PATCH_FIELDS = ["patchSets", "currentPatchSet"]
+
+    def __init__(self, cachedir, cachelifetime, snapshotlifetime):
+        CacheBackend.__init__(self, cachedir, cachelifetime, snapshotlifetime)
+        CacheDatabase.__init__(self, os.path.join(self.cachedir, "cache.db"))
+
+    def _purge_locked(self, now):
+        with self._get_conn() as conn:
+            conn.execute("DELETE FROM queries WHERE "
+                         "(kind = ? AND fetched < ?) OR (kind = ? AND fetched < ?)",
+                         (CacheBackendSQLite.KIND_QUERY, now - self.cachelifetime,
+                          CacheBackendSQLite.KIND_SNAPSHOT, now - self.snapshotlifetime))
+            conn.execute("DELETE FROM results WHERE key NOT IN "
+                         "(SELECT key FROM queries)")
+            conn.execute("DELETE FROM objects WHERE ? || key NOT IN "
+                         "(SELECT key FROM queries)",
+                         (CacheBackendSQLite.KIND_QUERY + ":",))
+            # Versions of changes which no result refers to
+            for table, column, updated in [("changes", "number", "lastUpdated"),
+                                           ("patchsets", "change", "updated"),
+                                           ("approvals", "change", "updated")]:
+                conn.execute("DELETE FROM %s WHERE NOT EXISTS "
+                             "(SELECT 1 FROM results WHERE results.number = %s.%s "
+                             "AND results.variant = %s.variant "
+                             "AND results.updated = %s.%s)" %
+                             (table, table, column, table, table, updated))
+
+    def _store_change(self, conn, variant, row):
+        number = int(row["number"])
+        lastUpdated = row.get("lastUpdated") or 0
+
+        # Nothing to do if this version is already stored
+        cur = conn.execute("SELECT 1 FROM changes "
+                           "WHERE number = ? AND variant = ? AND lastUpdated = ?",
+                           (number, variant, lastUpdated))
+        if cur.fetchone() is not None:
+            return lastUpdated
+
+        data = dict(row)
+        patches = {}
+        for field in CacheBackendSQLite.PATCH_FIELDS:
+            if field in data:
+                patches[field] = data.pop(field)
+        if "currentPatchSet" in patches:
+            patches["currentPatchSet"] = [patches["currentPatchSet"]]
+
+        conn.execute("INSERT INTO changes VALUES (?, ?, ?, ?, ?, ?)",
+                     (number, variant, lastUpdated,
+                      row.get("project"), row.get("status"),
+                      json.dumps(data)))
+
+        for field, patchlist in patches.items():
+            for pseq, patch in enumerate(patchlist):
+                patch = dict(patch)
+                approvals = patch.pop("approvals", [])
+                conn.execute("INSERT INTO patchsets VALUES (?, ?, ?, ?, ?, ?, ?)",
+                             (number, variant, lastUpdated, field, pseq,
+                              int(patch.get("number", 0)),
+                              json.dumps(patch)))
+                for aseq, approval in enumerate(approvals):
+                    by = approval.get("by", {})
+                    conn.execute("INSERT INTO approvals VALUES "
+                                 "(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                                 (number, variant, lastUpdated, field, pseq, aseq,
+                                  approval.get("type"),
+                                  int(approval.get("value", 0)),
+                                  approval.get("grantedOn"),
+                                  by.get("username"),
+                                  json.dumps(approval)))
+        return lastUpdated
+
+    def store(self, key, variant, kind, fetched, rows, limit=None):
+        key = kind + ":" + key
+        with self._get_conn() as conn:
+            conn.execute("DELETE FROM results WHERE key = ?", (key,))
+            for seq, row in enumerate(rows):
+                if "number" in row and "project" in row:
+                    updated = self._store_change(conn, variant, row)
+                    conn.execute("INSERT INTO results VALUES (?, ?, ?, ?, ?, NULL)",
+                                 (key, seq, int(row["number"]), variant, updated))
+                else:
+                    conn.execute("INSERT INTO results VALUES (?, ?, NULL, NULL, NULL, ?)",
+                                 (key, seq, json.dumps(row)))
+            conn.execute("INSERT OR REPLACE INTO queries (key, kind, fetched, rowlimit) "
+                         "VALUES (?, ?, ?, ?)", (key, kind, fetched, limit))
+
+    def _load(self, key, kind):
+        key = kind + ":" + key
+        conn = self._get_conn()
+        cur = conn.execute("SELECT fetched FROM queries WHERE key = ? AND kind = ?",
+                           (key, kind))
+        query = cur.fetchone()
+        if query is None:
+            return None
+
+        approvals = {}
+        cur = conn.execute("SELECT a.change, a.field, a.patchset, a.data "
+                           "FROM approvals a JOIN results r "
+                           "ON a.change = r.number AND a.variant = r.variant "
+                           "AND a.updated = r.updated "
+                           "WHERE r.key = ? ORDER BY a.seq", (key,))
+        for change, field, patchset, data in cur:
+            approvals.setdefault((change, field, patchset), []).append(json.loads(data))
+
+        patches = {}
+        cur = conn.execute("SELECT p.change, p.field, p.seq, p.data "
+                           "FROM patchsets p JOIN results r "
+                           "ON p.change = r.number AND p.variant = r.variant "
+                           "AND p.updated = r.updated "
+                           "WHERE r.key = ? ORDER BY p.seq", (key,))
+        for change, field, seq, data in cur:
+            patch = json.loads(data)
+            if (change, field, seq) in approvals:
+                patch["approvals"] = approvals[(change, field, seq)]
+            patches.setdefault(change, {}).setdefault(field, []).append(patch)
+
+        rows = []
+        cur = conn.execute("SELECT r.data, c.number, c.data "
+                           "FROM results r LEFT JOIN changes c "
+                           "ON r.number = c.number AND r.variant = c.variant "
+                           "AND r.updated = c.lastUpdated "
+                           "WHERE r.key = ? ORDER BY r.seq", (key,))
+        for rowdata, number, changedata in cur:
+            if rowdata is not None:
+                rows.append(json.loads(rowdata))
+                continue
+            if changedata is None:
+                # Change was purged underneath the result
+                return None
+            row = json.loads(changedata)
+            for field, patchlist in patches.get(number, {}).items():
+                if field == "currentPatchSet":
+                    row[field] = patchlist[0]
+                else:
+                    row[field] = patchlist
+            rows.append(row)
+
+        return (query[0], rows)
+
+    def get_info(self, key):
+        cur = self._get_conn().execute("SELECT fetched, rowlimit FROM queries "
+                                       "WHERE key = ?",
+                                       (CacheBackendSQLite.KIND_QUERY + ":" + key,))
+        return cur.fetchone()
+
+    def replay(self, key, cb):
+        result = self._load(key, CacheBackendSQLite.KIND_QUERY)
+        if result is None:
+            return False
+        for row in result[1]:
+            cb(row)
+        return True
+
+    def open_entry(self, key, variant, limit=None):
+        return CacheEntrySQLite(self, key, variant, limit)
+
+    def load_objects(self, key):
+        cur = self._get_conn().execute("SELECT fetched, data FROM objects "
+                                       "WHERE key = ?", (key,))
+        row = cur.fetchone()
+        if row is None:
+            return None
+        try:
+            objects = CachePickle.loads(bytes(row[1]), self.dbfile)
+        except Exception:
+            LOG.exception("Failure loading objects for %s", key)
+            return None
+        if objects is None:
+            return None
+        return (row[0], objects)
+
+    def save_objects(self, key, fetched, objects):
+        data = CachePickle.dumps(objects)
+        with self._get_conn() as conn:
+            conn.execute("INSERT OR REPLACE INTO objects VALUES (?, ?, ?)",
+                         (key, fetched, sqlite3.Binary(data)))
+
+    def load_snapshot(self, key):
+        result = self._load(key, CacheBackendSQLite.KIND_SNAPSHOT)
+        if result is None:
+            return None
+
+        # The header is kept as the first row, but
+        # snapshots saved before it was added lack it
+        fetched, rows = result
+        if len(rows) > 0 and "fetched" in rows[0]:
+            return (rows[0], rows[1:])
+        return ({"fetched": fetched}, rows)
+
+    def save_snapshot(self, key, variant, header, rows):
+        self.store(key, variant, CacheBackendSQLite.KIND_SNAPSHOT,
+                   header["fetched"], [header] + rows)
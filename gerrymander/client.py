@@ -13,25 +13,71 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+import errno
 import logging
 import os
 import os.path
+import signal
 import subprocess
 import sys
 import json
 import hashlib
+import re
 import time
-import fcntl
+import shutil
+import tempfile
+import threading
+
+from gerrymander.cache import CacheLock
+from gerrymander.cache import CacheBackendFiles
+from gerrymander.cache import CacheBackendSQLite
 
 LOG = logging.getLogger(__name__)
 
+
+class ClientCancelled(Exception):
+    '''Raised by a callback to stop the command whose output
+    it is passed, once it needs no more of it. The command is
+    terminated, and nothing it output is cached'''
+    pass
+
+
 class ClientLive(object):
 
-    def __init__(self, hostname="review", port=None, username=None, keyfile=None):
+    # Whether load_snapshot/save_snapshot keep anything
+    incremental = False
+
+    # Whether queries must be answered from a local mirror
+    offline = False
+
+    # How queries ask for each page of results after the first.
+    # Either from the time the last change seen was updated, or
+    # from the number of changes seen so far, which makes the
+    # server skip over all of them again for every page
+    PAGING_KEYSET = "keyset"
+    PAGING_OFFSET = "offset"
+
+    # Seconds the master connection stays up once idle, in case
+    # close() is never called because the process was killed
+    CONTROL_PERSIST = 60
+
+    def __init__(self, hostname="review", port=None, username=None, keyfile=None,
+                 multiplex=False, paging=PAGING_KEYSET, prefetch=False):
         self.hostname = hostname
         self.port = port
         self.username = username
         self.keyfile = keyfile
+        self.multiplex = multiplex
+        self.paging = paging
+        self.prefetch = prefetch
+        self.controldir = None
+        self.controllock = threading.Lock()
+        self.stats = {
+            "commands": 0,
+            "handshake": 0.0,
+            "transfer": 0.0,
+        }
+        self.statslock = threading.Lock()
 
     def _run_async(self, argv):
 
@@ -48,9 +94,26 @@ class ClientLive(object):
                               preexec_fn=_preexec_fn)
         return sp
 
-    def _build_argv(self, cmdargv):
+    def _get_control_path(self):
+        # A private directory, so that no other user can hijack
+        # the master connection by pre-creating the socket.
+        # Threads running queries at once must all share it
+        with self.controllock:
+            if self.controldir is None:
+                self.controldir = tempfile.mkdtemp(prefix="gerrymander-ssh-")
+            return os.path.join(self.controldir, "control")
+
+    def _build_ssh_argv(self):
         argv = ['ssh']
         argv.extend(["-T", "-o", "BatchMode=yes", "-e", "none"])
+        if self.multiplex:
+            # The first command to run becomes the master and
+            # stays in the background until close() is called,
+            # or it has been idle for CONTROL_PERSIST seconds,
+            # so every later command skips the handshake
+            argv.extend(["-o", "ControlMaster=auto",
+                         "-o", "ControlPath=" + self._get_control_path(),
+                         "-o", "ControlPersist=%d" % self.CONTROL_PERSIST])
         if self.port:
             argv.extend(["-p", str(self.port)])
         if self.keyfile and os.path.isfile(self.keyfile):
@@ -59,24 +122,100 @@ class ClientLive(object):
             argv.extend(["%s@%s" % (self.username, self.hostname)])
         else:
             argv.extend([self.hostname])
+        return argv
+
+    def _build_argv(self, cmdargv):
+        argv = self._build_ssh_argv()
         argv.extend(["gerrit"])
         argv.extend(cmdargv)
         return argv
 
-    def _process(self, sp, argv, cb):
-        while True:
-            line = sp.stdout.readline()
-            if not line:
-                break
+    def _record_stats(self, start, first, end):
+        if first is None:
+            first = end
+        handshake = first - start
+        transfer = end - first
+        LOG.debug("Command took %0.3fs to first byte, %0.3fs to transfer" %
+                  (handshake, transfer))
+        with self.statslock:
+            self.stats["commands"] += 1
+            self.stats["handshake"] += handshake
+            self.stats["transfer"] += transfer
+
+    def close(self):
+        if self.stats["commands"] > 0:
+            LOG.info("Ran %d commands, %0.3fs waiting for first byte, %0.3fs transferring" %
+                     (self.stats["commands"],
+                      self.stats["handshake"],
+                      self.stats["transfer"]))
+
+        if self.controldir is None:
+            return
+
+        if os.path.exists(self._get_control_path()):
+            argv = self._build_ssh_argv()
+            argv[1:1] = ["-O", "exit"]
+            LOG.debug("Stopping master connection %s" % " ".join(argv))
             try:
-                dec = json.loads(line.decode("UTF-8"))
-                if not isinstance(dec, (dict)):
-                    raise TypeError("Expected decoded dict, not %s" % (type(dec)))
-                cb(dec)
-            except Exception:
-                LOG.exception("Failure processing %s", line)
+                subprocess.call(argv,
+                                stdout=open(os.devnull, "w"),
+                                stderr=open(os.devnull, "w"))
+            except OSError:
+                LOG.exception("could not stop master connection")
+        shutil.rmtree(self.controldir, ignore_errors=True)
+        self.controldir = None
 
+    def _process_row(self, row, cb):
+        try:
+            if not isinstance(row, (dict)):
+                raise TypeError("Expected decoded dict, not %s" % (type(row)))
+            cb(row)
+        except ClientCancelled:
+            raise
+        except Exception:
+            LOG.exception("Failure processing %s", row)
+
+    def _process_line(self, line, cb):
+        try:
+            dec = json.loads(line.decode("UTF-8"))
+        except Exception:
+            LOG.exception("Failure processing %s", line)
+            return
+        self._process_row(dec, cb)
+
+    def _terminate(self, sp):
+        # Kill the command along with anything it started, in the
+        # process group set up by _run_async, rather than reading
+        # the rest of its output
+        LOG.debug("Terminating command %d" % sp.pid)
+        try:
+            os.killpg(sp.pid, signal.SIGTERM)
+        except OSError as e:
+            if e.errno != errno.ESRCH:
+                raise
+        sp.stdout.close()
+        sp.stderr.close()
         sp.wait()
+
+    def _process(self, sp, argv, cb, start=None, tee=None):
+        first = None
+        try:
+            while True:
+                line = sp.stdout.readline()
+                if first is None:
+                    first = time.time()
+                if not line:
+                    break
+                if tee is not None:
+                    tee.write(line)
+                self._process_line(line, cb)
+        except:
+            self._terminate(sp)
+            raise
+
+        sp.wait()
+        if start is not None:
+            self._record_stats(start, first, time.time())
         if sp.returncode != 0:
             lines = []
             while True:
@@ -89,101 +228,512 @@ class ClientLive(object):
             raise Exception("Error running command %s: %s" %
                             (args, msg))
 
-    def run(self, cmdargv, cb):
+    def run_live(self, cmdargv, cb):
         argv = self._build_argv(cmdargv)
+        start = time.time()
         sp = self._run_async(argv)
-        return self._process(sp, argv, cb)
+        return self._process(sp, argv, cb, start)
 
+    def run(self, cmdargv, cb, decoder=None):
+        '''Run the command 'cmdargv', passing each row of output
+        to 'cb'. If 'decoder' is given, rows are passed through
+        it first, which lets caching clients keep its results'''
+        if decoder is not None:
+            def mycb(row):
+                cb(decoder(row))
+            return self.run_live(cmdargv, mycb)
+        return self.run_live(cmdargv, cb)
 
-class ClientCachingLock(object):
-    def __init__(self, lockfile):
-        self.lockfile = lockfile
+    def is_cached(self, cmdargv):
+        '''Determine if running 'cmdargv' would be answered
+        without contacting the server'''
+        return False
 
-    def __enter__(self):
-        self.lockfh = open(self.lockfile, "w")
-        fcntl.lockf(self.lockfh, fcntl.LOCK_EX)
+    def load_snapshot(self, cmdargv):
+        '''Load the complete set of changes previously saved for
+        the query 'cmdargv'. Returns a tuple of the time they were
+        fetched, the time the open changes among them were last
+        fetched in full, the list of changes, whether they have
+        expired and need updating, and whether the open changes
+        must be fetched again. Returns None if nothing is saved'''
+        return None
 
-    def __exit__(self, exc_type, exc_val, exc_tb):
-        try:
-            fcntl.lockf(self.lockfh, fcntl.LOCK_UN)
-            self.lockfh.close()
-            self.lockfh = None
-        except:
-            LOG.exception("could not release lock on %s" % self.lockfile)
+    def save_snapshot(self, cmdargv, fetched, validated, rows):
+        pass
+
+    def store(self, cmdargv, rows):
+        '''Keep 'rows' as the output of the command 'cmdargv', as
+        if it had been run, for caching clients to answer it with'''
+        pass
+
+    def load_plan(self, cmdargv):
+        '''Load the sample of the times the changes matching the
+        query 'cmdargv' were last updated, most recent first, as
+        saved by save_plan. Returns None if nothing is saved'''
+        return None
+
+    def save_plan(self, cmdargv, times):
+        pass
+
+
+class ClientOffline(ClientLive):
+    '''Never contacts the server. Queries are answered from
+    the changes in 'mirror' instead, by OperationQuery'''
+
+    offline = True
+
+    def __init__(self, mirror):
+        super(ClientOffline, self).__init__()
+        self.mirror = mirror
+
+    def run_live(self, cmdargv, cb):
+        raise Exception("Cannot run '%s' while offline" % " ".join(cmdargv))
+
+    def run(self, cmdargv, cb, decoder=None):
+        return self.run_live(cmdargv, cb)
+
+
+ClientCachingLock = CacheLock
 
 
 class ClientCaching(ClientLive):
 
+    BACKEND_FILES = "files"
+    BACKEND_SQLITE = "sqlite"
+
     def __init__(self, hostname="review", port=None, username=None, keyfile=None,
-                 cachedir="cache", cachelifetime=86400, refresh=False):
-        super(ClientCaching, self).__init__(hostname, port, username, keyfile)
+                 cachedir="cache", cachelifetime=86400, refresh=False,
+                 multiplex=False, incremental=False,
+                 snapshotlifetime=30 * 86400, backend=BACKEND_FILES,
+                 maxsize=None, stalelifetime=0,
+                 compression=CacheBackendFiles.COMPRESSION_NONE,
+                 paging=ClientLive.PAGING_KEYSET, prefetch=False):
+        super(ClientCaching, self).__init__(hostname, port, username, keyfile,
+                                            multiplex, paging, prefetch)
         self.cachedir = cachedir
         self.cachelifetime = cachelifetime
-        self.lastpurge = None
+        self.incremental = incremental
+        self.snapshotlifetime = max(cachelifetime, snapshotlifetime)
+        self.stalelifetime = stalelifetime
         self.refresh = refresh
+        self.backend = backend
+        self.maxsize = maxsize
+        self.compression = compression
+        self.refreshing = []
 
-        if not os.path.exists(self.cachedir):
-            os.makedirs(self.cachedir)
+        # Expired results are kept until they are too stale
+        # to be served even while refreshing them
+        if backend == ClientCaching.BACKEND_FILES:
+            self.cache = CacheBackendFiles(self.cachedir,
+                                           self.cachelifetime + self.stalelifetime,
+                                           self.snapshotlifetime,
+                                           maxsize, compression)
+        elif backend == ClientCaching.BACKEND_SQLITE:
+            self.cache = CacheBackendSQLite(self.cachedir,
+                                            self.cachelifetime + self.stalelifetime,
+                                            self.snapshotlifetime)
+        else:
+            raise Exception("Unknown cache backend '%s'" % backend)
 
-    def _purge_cache_locked(self):
-        now = time.time()
-        if self.lastpurge is not None and (now - self.lastpurge) < 60 * 60:
-            return
-        self.lastpurge = now
-
-        then = now - self.cachelifetime
-        LOG.debug("Looking for files in %s older than %d" % (self.cachedir, then))
-        for file in os.listdir(self.cachedir):
-            if file == "lock":
-                continue
-            filepath = os.path.join(self.cachedir, file)
-            mtime = os.path.getmtime(filepath)
-            LOG.debug("File %s has time %d" % (filepath, mtime))
-            if mtime < then:
-                LOG.info("Purging outdated cache %s" % filepath)
-                os.unlink(filepath)
-
-    def _purge_cache(self):
-        # XXX we really need to protect individual files
-        # against deletion while they're being read
-        lock = ClientCachingLock(os.path.join(self.cachedir, "lock"))
-        LOG.debug("acquiring lock for cache")
-        with lock as lock:
-            self._purge_cache_locked()
-
-    def run(self, cmdargv, cb):
-        self._purge_cache()
-        argv = self._build_argv(cmdargv)
-        args = " ".join(argv)
+    @staticmethod
+    def _split_query(query, op):
+        # Split 'query' at each occurrence of 'op' which is
+        # not inside parentheses or quotes
+        sep = " " + op + " "
+        parts = []
+        depth = 0
+        quoted = False
+        start = 0
+        i = 0
+        while i < len(query):
+            if query[i] == '"':
+                quoted = not quoted
+            elif not quoted:
+                if query[i] == "(":
+                    depth = depth + 1
+                elif query[i] == ")":
+                    depth = depth - 1
+                elif depth == 0 and query.startswith(sep, i):
+                    parts.append(query[start:i].strip())
+                    i = i + len(sep)
+                    start = i
+                    continue
+            i = i + 1
+        parts.append(query[start:].strip())
+        return [part for part in parts if part != ""]
+
+    @staticmethod
+    def _unwrap_clause(clause):
+        # Strip parentheses enclosing the whole of 'clause'
+        while clause.startswith("(") and clause.endswith(")"):
+            depth = 0
+            for i in range(len(clause)):
+                if clause[i] == "(":
+                    depth = depth + 1
+                elif clause[i] == ")":
+                    depth = depth - 1
+                if depth == 0:
+                    break
+            if i != len(clause) - 1:
+                break
+            clause = clause[1:-1].strip()
+        return clause
+
+    @staticmethod
+    def _get_or_clause(clause):
+        # The alternatives of 'clause' can be put in any order,
+        # unless one of them is itself a list of clauses ANDed
+        # together, in which case it is kept exactly as written
+        parts = [ClientCaching._unwrap_clause(part)
+                 for part in ClientCaching._split_query(clause, "OR")]
+        for part in parts:
+            if len(ClientCaching._split_query(part, "AND")) > 1:
+                return "( " + clause + " )"
+        return "( " + " OR ".join(sorted(set(parts))) + " )"
+
+    @staticmethod
+    def _get_query_clauses(query):
+        # AND binds tighter than OR, so only a query with no OR
+        # at the top level is a list of clauses ANDed together
+        query = ClientCaching._unwrap_clause(query)
+        if len(ClientCaching._split_query(query, "OR")) > 1:
+            return [ClientCaching._get_or_clause(query)]
+
+        clauses = []
+        for clause in ClientCaching._split_query(query, "AND"):
+            clause = ClientCaching._unwrap_clause(clause)
+            if len(ClientCaching._split_query(clause, "OR")) > 1:
+                clauses.append(ClientCaching._get_or_clause(clause))
+            elif len(ClientCaching._split_query(clause, "AND")) > 1:
+                clauses.extend(ClientCaching._get_query_clauses(clause))
+            else:
+                clauses.append(clause)
+        return clauses
+
+    @staticmethod
+    def _parse_query(cmdargv):
+        '''Split 'cmdargv' into the command, its flags, the clauses
+        of its query in canonical form, and its limit on the number
+        of changes, which is not included in the clauses'''
+        flags = []
+        words = []
+        args = iter(cmdargv[1:])
+        for arg in args:
+            if arg == "--start":
+                flags.append(arg + "=" + next(args))
+            elif arg.startswith("--"):
+                flags.append(arg)
+            else:
+                words.append(arg)
+        flags.sort()
+
+        limit = None
+        clauses = []
+        for clause in ClientCaching._get_query_clauses(" ".join(words)):
+            m = re.match(r"^limit:(\d+)$", clause)
+            if m is not None:
+                limit = int(m.group(1))
+            else:
+                clauses.append(clause)
+        return cmdargv[0], flags, sorted(set(clauses)), limit
+
+    def _get_cache_key(self, cmdargv):
+        # Only what determines the results goes in the key, so
+        # that equivalent queries find the same result however
+        # they were written. This leaves out the ssh options and
+        # the limit, which is recorded with the result instead
+        command, flags, clauses, limit = self._parse_query(cmdargv)
+        server = "%s@%s:%s" % (self.username or "", self.hostname.lower(),
+                               self.port or "")
+        args = "\n".join([server, command] + flags + clauses)
         m = hashlib.sha256()
         m.update(args.encode("UTF-8"))
-        LOG.debug("Finding cache for args '%s'" % args)
-        file = self.cachedir + "/" + m.hexdigest() + ".json"
-        if not os.path.exists(file) or self.refresh:
-            sp = self._run_async(argv)
+        LOG.debug("Finding cache for args '%s'" % " ".join(cmdargv))
+        return m.hexdigest()
+
+    def _get_cache_info(self, key, limit):
+        # A result fetched with a larger limit, or none at
+        # all, can answer a query with a smaller limit
+        info = self.cache.get_info(key)
+        if info is None or info[1] is None:
+            return info
+        if limit is None or limit > info[1]:
+            return None
+        return info
+
+    @staticmethod
+    def _get_limiting_cb(cb, limit):
+        # Passes only the first 'limit' changes of a result on
+        # to 'cb', with the stats adjusted to match
+        if limit is None:
+            return cb
+
+        class counter(object):
+            def __init__(self):
+                self.changes = 0
+                self.dropped = False
+
+        c = counter()
+        def limitcb(row):
+            if isinstance(row, dict) and "type" in row:
+                if row["type"] == "stats":
+                    row = dict(row)
+                    row["rowCount"] = c.changes
+                    if "moreChanges" in row:
+                        row["moreChanges"] = row["moreChanges"] or c.dropped
+                cb(row)
+            elif c.changes < limit:
+                c.changes = c.changes + 1
+                cb(row)
+            else:
+                c.dropped = True
+        return limitcb
+
+    @staticmethod
+    def _get_cache_variant(cmdargv):
+        # The flags which determine what data is included
+        # in each change record
+        flags = []
+        for arg in cmdargv:
+            if arg.startswith("--") and arg != "--start":
+                flags.append(arg)
+        flags.sort()
+        return " ".join(flags)
+
+    def is_cached(self, cmdargv):
+        if self.refresh:
+            return False
+        info = self._get_cache_info(self._get_cache_key(cmdargv),
+                                    self._parse_query(cmdargv)[3])
+        if info is None:
+            return False
+        return (time.time() - info[0]) < self.cachelifetime + self.stalelifetime
+
+    def load_snapshot(self, cmdargv):
+        if not self.incremental or self.refresh:
+            return None
+
+        self.cache.purge()
+        snapshot = self.cache.load_snapshot(self._get_cache_key(cmdargv))
+        if snapshot is None:
+            return None
+
+        # Closed changes are kept for as long as the snapshot
+        # is in use, but open ones are only trusted for the
+        # snapshot lifetime, in case an update was missed
+        header, rows = snapshot
+        fetched = header["fetched"]
+        validated = header.get("validated", fetched)
+        now = time.time()
+        expired = (now - fetched) >= self.cachelifetime
+        revalidate = (now - validated) >= self.snapshotlifetime
+        return (fetched, validated, rows, expired or revalidate, revalidate)
+
+    def save_snapshot(self, cmdargv, fetched, validated, rows):
+        if not self.incremental:
+            return
+
+        self.cache.save_snapshot(self._get_cache_key(cmdargv),
+                                 self._get_cache_variant(cmdargv),
+                                 {"fetched": fetched, "validated": validated},
+                                 rows)
+
+    def store(self, cmdargv, rows):
+        key = self._get_cache_key(cmdargv)
+        with self.cache.lock_entry(key):
+            entry = self.cache.open_entry(key, self._get_cache_variant(cmdargv),
+                                          self._parse_query(cmdargv)[3])
             try:
-                with open(file, "wb") as f:
-                    while True:
-                        line = sp.stdout.readline()
-                        if not line:
-                            break
-                        f.write(line)
+                for row in rows:
+                    entry.write((json.dumps(row) + "\n").encode("UTF-8"))
             except:
-                os.unlink(file)
+                entry.abort()
                 raise
+            entry.commit()
+
+    def _get_plan_key(self, cmdargv):
+        return self._get_cache_key(cmdargv) + "-plan"
+
+    def load_plan(self, cmdargv):
+        # Plans are kept as snapshots without any changes,
+        # and are purged once the snapshot lifetime passes
+        snapshot = self.cache.load_snapshot(self._get_plan_key(cmdargv))
+        if snapshot is None:
+            return None
+        header, rows = snapshot
+        return header.get("times")
+
+    def save_plan(self, cmdargv, times):
+        self.cache.save_snapshot(self._get_plan_key(cmdargv), "",
+                                 {"fetched": time.time(), "times": times},
+                                 [])
+
+    def _fetch(self, argv, key, variant, limit, cb, start=None):
+        # Stream the output to the callback as it arrives, while
+        # saving it alongside. It only replaces the cache entry
+        # once the command has completed successfully
+        entry = self.cache.open_entry(key, variant, limit)
+        try:
+            sp = self._run_async(argv)
+            self._process(sp, argv, cb, start, tee=entry)
+        except:
+            entry.abort()
+            raise
+        entry.commit()
+
+    def _get_settings(self):
+        # What another process needs to make an equivalent
+        # client, without a master connection, which belongs
+        # to this one and is shut down when it closes
+        return {
+            "hostname": self.hostname,
+            "port": self.port,
+            "username": self.username,
+            "keyfile": self.keyfile,
+            "cachedir": os.path.abspath(self.cachedir),
+            "cachelifetime": self.cachelifetime,
+            "snapshotlifetime": self.snapshotlifetime,
+            "stalelifetime": self.stalelifetime,
+            "backend": self.backend,
+            "maxsize": self.maxsize,
+            "compression": self.compression,
+        }
+
+    @staticmethod
+    def _revalidate_child(settings, cmdargv):
+        '''Fetch 'cmdargv' into the cache of a client made with
+        'settings', unless someone is already fetching it. This
+        is run in a process of its own by _revalidate'''
+        client = ClientCaching(**settings)
+        key = client._get_cache_key(cmdargv)
+        lock = client.cache.lock_entry(key)
+        if not lock.acquire(blocking=False):
+            return
+        try:
+            client._fetch(client._build_argv(cmdargv), key,
+                          client._get_cache_variant(cmdargv),
+                          client._parse_query(cmdargv)[3],
+                          lambda row: None)
+        finally:
+            lock.release()
+
+    def _revalidate(self, cmdargv, key):
+        # Nothing to do if someone is already fetching it
+        if self.cache.lock_entry(key).is_held():
+            return
+
+        # A new python process, rather than a fork, so that it
+        # inherits none of our file descriptors, such as the
+        # pipe to the pager, which would otherwise be held open
+        # until it finished. It gets a session of its own, so
+        # it is not killed along with our process group
+        env = dict(os.environ)
+        path = [os.path.dirname(os.path.dirname(os.path.abspath(__file__)))]
+        if env.get("PYTHONPATH"):
+            path.append(env["PYTHONPATH"])
+        env["PYTHONPATH"] = os.pathsep.join(path)
+        argv = [sys.executable, "-c",
+                "import json, sys\n"
+                "from gerrymander.client import ClientCaching\n"
+                "ClientCaching._revalidate_child(*json.loads(sys.argv[1]))",
+                json.dumps([self._get_settings(), cmdargv])]
+        devnull = open(os.devnull, "r+")
+        try:
+            sp = subprocess.Popen(argv,
+                                  stdin=devnull,
+                                  stdout=devnull,
+                                  stderr=devnull,
+                                  close_fds=True,
+                                  preexec_fn=os.setsid,
+                                  env=env)
+        finally:
+            devnull.close()
+
+        # Kept to be reaped once done, though left running if
+        # we exit first
+        self.refreshing = [old for old in self.refreshing
+                           if old.poll() is None] + [sp]
+
+    @staticmethod
+    def _get_decoding_cb(cb, decoder, decoded):
+        # Passes decoded rows to 'cb', keeping them in 'decoded'
+        def decodecb(row):
+            obj = decoder(row)
+            decoded.append(obj)
+            cb(obj)
+        return decodecb
+
+    def _replay(self, key, fetched, cb, decoder):
+        if decoder is None:
+            def rowcb(row):
+                self._process_row(row, cb)
+            return self.cache.replay(key, rowcb)
+
+        # Decoding is the bulk of the work of replaying a large
+        # result, so the decoded objects are kept too. They are
+        # only valid for the exact result they were built from
+        objects = self.cache.load_objects(key)
+        if objects is not None and objects[0] == fetched:
+            for obj in objects[1]:
+                try:
+                    cb(obj)
+                except ClientCancelled:
+                    raise
+                except Exception:
+                    LOG.exception("Failure processing %s", obj)
+            return True
+
+        decoded = []
+        decodecb = self._get_decoding_cb(cb, decoder, decoded)
+        def rowcb(row):
+            self._process_row(row, decodecb)
+        if not self.cache.replay(key, rowcb):
+            return False
+        if fetched is not None:
+            self.cache.save_objects(key, fetched, decoded)
+        return True
+
+    def run(self, cmdargv, cb, decoder=None):
+        self.cache.purge()
+        argv = self._build_argv(cmdargv)
+        key = self._get_cache_key(cmdargv)
+        variant = self._get_cache_variant(cmdargv)
+        limit = self._parse_query(cmdargv)[3]
+        limitcb = self._get_limiting_cb(cb, limit)
+
+        # Results which have expired may still be served for a
+        # while, as long as they are refreshed in the background
+        # ready for the next time they are wanted
+        info = None
+        if not self.refresh:
+            info = self._get_cache_info(key, limit)
+        if info is not None:
+            age = time.time() - info[0]
+            if (age < self.cachelifetime + self.stalelifetime and
+                self._replay(key, info[0], limitcb, decoder)):
+                if age >= self.cachelifetime:
+                    LOG.debug("Refreshing stale cache %s in background" % key)
+                    self._revalidate(cmdargv, key)
+                return
+
+        # Only one thread or process fetches each key at a
+        # time. Anyone else wanting it waits and then shares
+        # the result, even when refreshing, since it will be
+        # no older than the time they asked for it
+        with self.cache.lock_entry(key) as lock:
+            if lock.waited:
+                info = self._get_cache_info(key, limit)
+                if info is not None and self._replay(key, info[0], limitcb, decoder):
+                    return
+
+            if decoder is None:
+                self._fetch(argv, key, variant, limit, cb, time.time())
+                return
 
-            sp.wait()
-            if sp.returncode != 0:
-                os.unlink(file)
-                lines = []
-                while True:
-                    line = sp.stderr.readline()
-                    if not line:
-                        break
-                    lines.append(line.decode("UTF-8"))
-                msg = "".join(lines)
-                raise Exception("Error running command %s: %s" %
-                                (args, msg))
-
-        sp = self._run_async(["cat", file])
-        self._process(sp, argv, cb)
+            decoded = []
+            self._fetch(argv, key, variant, limit,
+                        self._get_decoding_cb(cb, decoder, decoded),
+                        time.time())
+            info = self.cache.get_info(key)
+            if info is not None:
+                self.cache.save_objects(key, info[0], decoded)
@@ -15,8 +15,12 @@
 
 from gerrymander.client import ClientLive
 from gerrymander.client import ClientCaching
+from gerrymander.client import ClientOffline
+from gerrymander.cache import CacheBackendFiles
 from gerrymander.operations import OperationQuery
 from gerrymander.operations import OperationWatch
+from gerrymander.operations import OperationMirrorSync
+from gerrymander.mirror import Mirror
 from gerrymander.reports import ReportOutput
 from gerrymander.reports import ReportPatchReviewStats
 from gerrymander.reports import ReportPatchReviewRate
@@ -95,6 +99,17 @@ class CommandConfig(object):
         value = self.config.get(section, name)
         return list(map(lambda x: x.strip(), value.split(",")))
 
+    def get_option_size(self, section, name, defvalue=None):
+        if not self.config.has_option(section, name):
+            return defvalue
+        value = self.config.get(section, name).strip()
+        scale = 1
+        for suffix in ["K", "M", "G"]:
+            scale = scale * 1024
+            if value.upper().endswith(suffix):
+                return int(value[:-1]) * scale
+        return int(value)
+
     def get_option_bool(self, section, name, defvalue=None):
         if not self.config.has_option(section, name):
             return defvalue
@@ -123,6 +138,24 @@ class CommandConfig(object):
             return None
         return self.config.get("server", "keyfile")
 
+    def get_server_multiplex(self):
+        return self.get_option_bool("server", "multiplex", False)
+
+    def get_server_paging(self):
+        return self.get_option_string("server", "paging", ClientLive.PAGING_KEYSET)
+
+    def get_server_prefetch(self):
+        return self.get_option_bool("server", "prefetch", False)
+
+    def get_server_max_concurrency(self):
+        return self.get_option_int("server", "max-concurrency", 1)
+
+    def get_server_shards(self):
+        return self.get_option_int("server", "shards", 1)
+
+    def get_server_batch(self):
+        return self.get_option_int("server", "batch", 1)
+
     def get_cache_longlifetime(self):
         if not self.config.has_option("cache", "longlifetime"):
             return 86400
@@ -133,11 +166,35 @@ class CommandConfig(object):
             return 300
         return int(self.config.get("cache", "shortlifetime"))
 
+    def get_cache_stalelifetime(self):
+        return self.get_option_int("cache", "stalelifetime", 0)
+
+    def get_cache_incremental(self):
+        return self.get_option_bool("cache", "incremental", False)
+
+    def get_cache_backend(self):
+        return self.get_option_string("cache", "backend", ClientCaching.BACKEND_FILES)
+
+    def get_cache_compression(self):
+        return self.get_option_string("cache", "compression",
+                                      CacheBackendFiles.COMPRESSION_NONE)
+
+    def get_cache_maxsize(self):
+        return self.get_option_size("cache", "maxsize", None)
+
     def get_cache_directory(self):
         if not self.config.has_option("cache", "directory"):
             return os.path.expanduser("~/.gerrymander.d/cache")
         return os.path.expanduser(self.config.get("cache", "directory"))
 
+    def get_mirror_directory(self):
+        if not self.config.has_option("mirror", "directory"):
+            return os.path.expanduser("~/.gerrymander.d/mirror")
+        return os.path.expanduser(self.config.get("mirror", "directory"))
+
+    def get_mirror_offline(self):
+        return self.get_option_bool("mirror", "offline", False)
+
     def get_organization_groups(self):
         if not self.config.has_option("organization", "groups"):
             return []
@@ -225,7 +282,10 @@ class Command(object):
         return ClientLive(config.get_server_hostname(),
                           config.get_server_port(),
                           config.get_server_username(),
-                          config.get_server_keyfile())
+                          config.get_server_keyfile(),
+                          config.get_server_multiplex(),
+                          config.get_server_paging(),
+                          config.get_server_prefetch())
 
     def run(self, config, client, options):
         raise NotImplementedError("Subclass should override run method")
@@ -235,8 +295,10 @@ class Command(object):
             start_pager()
         try:
             client = self.get_client(config, options)
-
-            self.run(config, client, options)
+            try:
+                self.run(config, client, options)
+            finally:
+                client.close()
         finally:
             if self.pager:
                 stop_pager()
@@ -259,13 +321,22 @@ class CommandCaching(Command):
         self.add_option(parser, config,
                         "--refresh", action="store_true",
                         help="Force refresh of the query cache")
+        self.add_option(parser, config,
+                        "--offline", action="store_true",
+                        default=config.get_mirror_offline(),
+                        help="Answer queries from the local mirror only")
 
     def get_client(self, config, options):
-        if options.no_cache:
+        if options.offline:
+            return ClientOffline(Mirror(config.get_mirror_directory()))
+        elif options.no_cache:
             return ClientLive(config.get_server_hostname(),
                               config.get_server_port(),
                               config.get_server_username(),
-                              config.get_server_keyfile())
+                              config.get_server_keyfile(),
+                              config.get_server_multiplex(),
+                              config.get_server_paging(),
+                              config.get_server_prefetch())
         else:
             if self.longcache:
                 return ClientCaching(config.get_server_hostname(),
@@ -274,7 +345,15 @@ class CommandCaching(Command):
                                      config.get_server_keyfile(),
                                      os.path.join(config.get_cache_directory(), "long"),
                                      config.get_cache_longlifetime(),
-                                     options.refresh)
+                                     options.refresh,
+                                     config.get_server_multiplex(),
+                                     config.get_cache_incremental(),
+                                     backend=config.get_cache_backend(),
+                                     maxsize=config.get_cache_maxsize(),
+                                     stalelifetime=config.get_cache_stalelifetime(),
+                                     compression=config.get_cache_compression(),
+                                     paging=config.get_server_paging(),
+                                     prefetch=config.get_server_prefetch())
             else:
                 return ClientCaching(config.get_server_hostname(),
                                      config.get_server_port(),
@@ -282,7 +361,36 @@ class CommandCaching(Command):
                                      config.get_server_keyfile(),
                                      os.path.join(config.get_cache_directory(), "short"),
                                      config.get_cache_shortlifetime(),
-                                     options.refresh)
+                                     options.refresh,
+                                     config.get_server_multiplex(),
+                                     config.get_cache_incremental(),
+                                     backend=config.get_cache_backend(),
+                                     maxsize=config.get_cache_maxsize(),
+                                     stalelifetime=config.get_cache_stalelifetime(),
+                                     compression=config.get_cache_compression(),
+                                     paging=config.get_server_paging(),
+                                     prefetch=config.get_server_prefetch())
+
+
+class CommandConcurrent(Command):
+
+    def __init__(self, name, help):
+        super(CommandConcurrent, self).__init__(name, help)
+
+    def add_options(self, parser, config):
+        super(CommandConcurrent, self).add_options(parser, config)
+        self.add_option(parser, config,
+                        "-j", "--jobs", default=config.get_server_max_concurrency(),
+                        type=int,
+                        help="Run up to N gerrit queries in parallel")
+        self.add_option(parser, config,
+                        "--shards", default=config.get_server_shards(),
+                        type=int,
+                        help="Split each gerrit query into N shards run in parallel")
+        self.add_option(parser, config,
+                        "--batch", default=config.get_server_batch(),
+                        type=int,
+                        help="Combine queries for up to N projects into one")
 
 
 class CommandProject(Command):
@@ -454,6 +562,42 @@ class CommandWatch(CommandProject):
         return watch.run(cb)
 
 
+class CommandMirror(CommandProject):
+
+    def __init__(self, name="mirror", help="Manage the local mirror of changes"):
+        super(CommandMirror, self).__init__(name, help)
+
+        self.pager = False
+
+    def add_options(self, parser, config):
+        super(CommandMirror, self).add_options(parser, config)
+
+        self.add_option(parser, config,
+                        "action", default=None,
+                        choices=["sync"],
+                        help="Fetch changes updated since the last sync")
+
+    def run(self, config, client, options):
+        mirror = Mirror(config.get_mirror_directory())
+
+        # Without any projects, sync all the configured groups
+        # or else just the ones already in the mirror
+        projects = self.get_projects(config, options)
+        if len(projects) == 0:
+            for group in config.get_organization_groups():
+                projects.extend(config.get_group_projects(group))
+        if len(projects) == 0:
+            projects = mirror.get_projects()
+        if len(projects) == 0:
+            raise Exception("No projects to mirror, use --project or --group")
+
+        def cb(project, count):
+            print ("%s: %d changes updated" % (project, count))
+
+        sync = OperationMirrorSync(client, mirror, projects)
+        sync.run(cb)
+
+
 class CommandReport(Command):
 
     def __init__(self, name, help):
@@ -533,7 +677,7 @@ class CommandReportTable(CommandReport):
         report.display(options.mode)
 
 
-class CommandPatchReviewStats(CommandProject, CommandCaching, CommandReportTable):
+class CommandPatchReviewStats(CommandProject, CommandCaching, CommandConcurrent, CommandReportTable):
 
     def __init__(self, name="patchreviewstats", help="Statistics on patch review approvals"):
         super(CommandPatchReviewStats, self).__init__(name, help)
@@ -564,13 +708,16 @@ class CommandPatchReviewStats(CommandProject, CommandCaching, CommandReportTable
                                       self.get_projects(config, options, True),
                                       int(options.days),
                                       teams,
-                                      usecolor=options.color)
+                                      usecolor=options.color,
+                                      jobs=options.jobs,
+                                      shards=options.shards,
+                                      batch=options.batch)
 
     def run(self, config, client, options):
         return super(CommandPatchReviewStats, self).run(config, client, options)
 
 
-class CommandPatchReviewRate(CommandProject, CommandCaching, CommandReportTable):
+class CommandPatchReviewRate(CommandProject, CommandCaching, CommandConcurrent, CommandReportTable):
 
     def __init__(self, name="patchreviewrate", help="Daily review rate averaged per week"):
         super(CommandPatchReviewRate, self).__init__(name, help)
@@ -593,13 +740,16 @@ class CommandPatchReviewRate(CommandProject, CommandCaching, CommandReportTable)
         return ReportPatchReviewRate(client,
                                      self.get_projects(config, options, True),
                                      teams,
-                                     usecolor=options.color)
+                                     usecolor=options.color,
+                                     jobs=options.jobs,
+                                     shards=options.shards,
+                                     batch=options.batch)
 
     def run(self, config, client, options):
         return super(CommandPatchReviewRate, self).run(config, client, options)
 
 
-class CommandOpenReviewStats(CommandProject, CommandCaching, CommandReportTable):
+class CommandOpenReviewStats(CommandProject, CommandCaching, CommandConcurrent, CommandReportTable):
 
     def __init__(self, name="openreviewstats", help="Statistics on open patch reviews"):
         super(CommandOpenReviewStats, self).__init__(name, help)
@@ -625,7 +775,10 @@ class CommandOpenReviewStats(CommandProject, CommandCaching, CommandReportTable)
                                      options.branch,
                                      options.topic,
                                      int(options.days),
-                                     usecolor=options.color)
+                                     usecolor=options.color,
+                                     jobs=options.jobs,
+                                     shards=options.shards,
+                                     batch=options.batch)
 
     def run(self, config, client, options):
         if options.limit is None:
@@ -967,11 +1120,9 @@ class CommandComments(CommandCaching):
         else:
             bots = config.get_organization_bots()
 
-        def mycb(change):
+        for change in query.iter(limit=1):
             self.format_change(change, bots, options.color, options.current, int(options.patch))
 
-        query.run(mycb, limit=1)
-
 
 class CommandTool(object):
 
@@ -1014,6 +1165,7 @@ class CommandTool(object):
         self.add_command(subparser, config, CommandOpenReviewStats)
         self.add_command(subparser, config, CommandChanges)
         self.add_command(subparser, config, CommandComments)
+        self.add_command(subparser, config, CommandMirror)
 
     def add_config_commands(self, subparser, config):
         aliases = config.get_command_aliases()
@@ -0,0 +1,243 @@
+#
+# Copyright (C) 2014 Red Hat, Inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import bisect
+import re
+
+from gerrymander.model import ModelUser
+
+
+class IndexChange(object):
+    '''Maps the owner, reviewers, votes, project, branch, topic
+    and status of a set of changes to the numbers of the changes
+    which have them. Changes with some combination of them can
+    then be found with set operations, rather than by looking at
+    every patch and approval of every change'''
+
+    # Terms whose values are plain fields of the change
+    TERM_PROJECT = "project"
+    TERM_BRANCH = "branch"
+    TERM_TOPIC = "topic"
+    TERM_STATUS = "status"
+    # Terms whose values are the (action, value) of a vote
+    # on the current patch
+    TERM_CURRENT_APPROVAL = "current-approval"
+
+    # Terms whose values are users. Votes recorded without
+    # a user are indexed under a user of None
+    TERM_OWNER = "owner"
+    TERM_REVIEWER = "reviewer"
+    TERM_CURRENT_REVIEWER = "current-reviewer"
+    TERM_COMMENTER = "commenter"
+
+    USER_TERMS = [TERM_OWNER, TERM_REVIEWER,
+                  TERM_CURRENT_REVIEWER, TERM_COMMENTER]
+
+    def __init__(self, changes=[]):
+        # Term -> value -> set of change numbers
+        self.terms = {}
+        # Change number -> list of (term, value) it is indexed under
+        self.entries = {}
+
+        for change in changes:
+            self.add(change)
+
+    @staticmethod
+    def _get_user_key(user):
+        if user is None:
+            return None
+        return (user.name, user.email, user.username)
+
+    @staticmethod
+    def _get_entries(change):
+        entries = set()
+        entries.add((IndexChange.TERM_PROJECT, change.project))
+        entries.add((IndexChange.TERM_BRANCH, change.branch))
+        entries.add((IndexChange.TERM_TOPIC, change.topic))
+        entries.add((IndexChange.TERM_STATUS, change.status))
+        if change.owner is not None:
+            entries.add((IndexChange.TERM_OWNER,
+                         IndexChange._get_user_key(change.owner)))
+
+        for patch in change.patches:
+            for approval in patch.approvals:
+                entries.add((IndexChange.TERM_REVIEWER,
+                             IndexChange._get_user_key(approval.user)))
+
+        current = change.get_current_patch()
+        if current is not None:
+            for approval in current.approvals:
+                entries.add((IndexChange.TERM_CURRENT_REVIEWER,
+                             IndexChange._get_user_key(approval.user)))
+                entries.add((IndexChange.TERM_CURRENT_APPROVAL,
+                             (approval.action, approval.value)))
+
+        for comment in change.comments:
+            if comment.reviewer is not None:
+                entries.add((IndexChange.TERM_COMMENTER,
+                             IndexChange._get_user_key(comment.reviewer)))
+        return entries
+
+    def add(self, change):
+        '''Index 'change', replacing whatever was indexed
+        for an earlier copy of it'''
+        self.remove(change.number)
+        entries = self._get_entries(change)
+        for term, value in entries:
+            values = self.terms.setdefault(term, {})
+            values.setdefault(value, set()).add(change.number)
+        self.entries[change.number] = list(entries)
+
+    def remove(self, number):
+        entries = self.entries.pop(number, [])
+        for term, value in entries:
+            numbers = self.terms[term][value]
+            numbers.discard(number)
+            if len(numbers) == 0:
+                del self.terms[term][value]
+
+    def get_all(self):
+        '''Get the numbers of every indexed change'''
+        return set(self.entries.keys())
+
+    def find(self, term, values):
+        '''Get the numbers of the changes indexed under
+        any of 'values' for 'term' '''
+        found = set()
+        index = self.terms.get(term, {})
+        for value in values:
+            found.update(index.get(value, set()))
+        return found
+
+    def find_users(self, term, match):
+        '''Get the numbers of the changes indexed under any user
+        for 'term' for which 'match' is True. 'match' is passed
+        a ModelUser, or None for votes recorded without a user'''
+        found = set()
+        for key, numbers in self.terms.get(term, {}).items():
+            user = None
+            if key is not None:
+                user = ModelUser(key[0], key[1], key[2])
+            if match(user):
+                found.update(numbers)
+        return found
+
+
+class IndexPath(object):
+    '''Maps the paths of the files in the current patch of a set
+    of changes to the numbers of the changes which touch them.
+    Each distinct path is only matched once, however many changes
+    touch it, and patterns anchored to a literal prefix are only
+    matched against the paths which start with it'''
+
+    # Characters which end the literal prefix of a pattern
+    SPECIAL = ".^$*+?{}[]\\|()"
+
+    # Characters which make the character before them optional
+    QUANTIFIERS = "*?{"
+
+    def __init__(self, changes=[]):
+        # Path -> set of change numbers
+        self.paths = {}
+        # Change number -> list of paths it is indexed under
+        self.entries = {}
+        # All the paths in order, built when first needed
+        self.sorted = None
+
+        for change in changes:
+            self.add(change)
+
+    def add(self, change):
+        '''Index 'change', replacing whatever was indexed
+        for an earlier copy of it'''
+        self.remove(change.number)
+        paths = set()
+        patch = change.get_current_patch()
+        if patch is not None:
+            for file in patch.files:
+                if file.path is not None:
+                    paths.add(file.path)
+        for path in paths:
+            if path not in self.paths:
+                self.paths[path] = set()
+                self.sorted = None
+            self.paths[path].add(change.number)
+        self.entries[change.number] = list(paths)
+
+    def remove(self, number):
+        for path in self.entries.pop(number, []):
+            numbers = self.paths[path]
+            numbers.discard(number)
+            if len(numbers) == 0:
+                del self.paths[path]
+                self.sorted = None
+
+    @staticmethod
+    def _get_prefix(pattern):
+        # The literal text every match must start with, or
+        # None if the pattern can match anywhere in the path
+        if not pattern.startswith("^") or "|" in pattern:
+            return None
+        prefix = ""
+        for i in range(1, len(pattern)):
+            if pattern[i] in IndexPath.SPECIAL:
+                if pattern[i] in IndexPath.QUANTIFIERS:
+                    prefix = prefix[:-1]
+                break
+            prefix = prefix + pattern[i]
+        return prefix
+
+    def _get_paths(self, prefix):
+        if self.sorted is None:
+            self.sorted = sorted(self.paths.keys())
+        start = bisect.bisect_left(self.sorted, prefix)
+        end = start
+        while end < len(self.sorted) and self.sorted[end].startswith(prefix):
+            end = end + 1
+        return self.sorted[start:end]
+
+    @staticmethod
+    def _compile(patterns):
+        # A single regex for all of them is much quicker than
+        # trying each in turn, unless they can't be combined
+        try:
+            union = re.compile("|".join(["(?:%s)" % pattern for pattern in patterns]))
+            return [union]
+        except re.error:
+            return [re.compile(pattern) for pattern in patterns]
+
+    def find(self, patterns):
+        '''Get the numbers of the changes touching any path
+        which matches any of the regexes in 'patterns' '''
+        found = set()
+        unanchored = []
+        for pattern in patterns:
+            prefix = self._get_prefix(pattern)
+            if prefix is None:
+                unanchored.append(pattern)
+                continue
+            regex = re.compile(pattern)
+            for path in self._get_paths(prefix):
+                if regex.search(path):
+                    found.update(self.paths[path])
+
+        if len(unanchored) > 0:
+            regexes = self._compile(unanchored)
+            for path, numbers in self.paths.items():
+                for regex in regexes:
+                    if regex.search(path):
+                        found.update(numbers)
+                        break
+        return found
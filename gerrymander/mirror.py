@@ -0,0 +1,131 @@
+#
+# Copyright (C) 2014 Red Hat, Inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import errno
+import json
+import logging
+import os
+import sqlite3
+
+from gerrymander.cache import CacheDatabase
+from gerrymander.cache import CachePickle
+from gerrymander.index import IndexChange
+from gerrymander.model import ModelChange
+
+LOG = logging.getLogger(__name__)
+
+
+class Mirror(CacheDatabase):
+    '''A local copy of every change in a set of projects, with
+    all their patch sets, approvals, files, comments and
+    reviewers. After the first sync of a project, only the
+    changes updated since the previous sync need to be fetched'''
+
+    # Mirrors synced before reviewers were kept are
+    # emptied, so that the next sync fetches everything
+    VERSION = 1
+    DISCARD = ["projects", "changes", "indexes"]
+
+    SCHEMA = [
+        '''CREATE TABLE IF NOT EXISTS projects (
+               name TEXT PRIMARY KEY,
+               synced REAL NOT NULL)''',
+        '''CREATE TABLE IF NOT EXISTS changes (
+               number INTEGER PRIMARY KEY,
+               project TEXT NOT NULL,
+               updated INTEGER NOT NULL,
+               data TEXT NOT NULL)''',
+        '''CREATE INDEX IF NOT EXISTS changes_project
+               ON changes (project, updated)''',
+        '''CREATE TABLE IF NOT EXISTS indexes (
+               name TEXT PRIMARY KEY,
+               data BLOB NOT NULL)''',
+    ]
+
+    def __init__(self, directory):
+        try:
+            os.makedirs(directory)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        super(Mirror, self).__init__(os.path.join(directory, "mirror.db"))
+
+    def get_synced(self, project):
+        '''Get the time 'project' was last synced, or None
+        if it is not in the mirror'''
+        row = self._get_conn().execute(
+            "SELECT synced FROM projects WHERE name = ?",
+            (project,)).fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+    def get_projects(self):
+        cur = self._get_conn().execute("SELECT name FROM projects ORDER BY name")
+        return [row[0] for row in cur]
+
+    def _load_index(self, conn):
+        row = conn.execute("SELECT data FROM indexes WHERE name = 'changes'").fetchone()
+        if row is not None:
+            index = CachePickle.loads(bytes(row[0]), self.dbfile)
+            if index is not None:
+                return index
+
+        # Mirrors synced before the index existed, or
+        # whose index was saved by another version
+        LOG.debug("Building index of mirrored changes")
+        index = IndexChange()
+        for row in conn.execute("SELECT data FROM changes"):
+            index.add(ModelChange.from_json(json.loads(row[0])))
+        return index
+
+    def _save_index(self, conn, index):
+        conn.execute("INSERT OR REPLACE INTO indexes VALUES ('changes', ?)",
+                     (sqlite3.Binary(CachePickle.dumps(index)),))
+
+    def load_index(self):
+        '''Get an IndexChange of every change in the mirror'''
+        with self._get_conn() as conn:
+            return self._load_index(conn)
+
+    def update(self, project, synced, rows):
+        '''Replace the copies of the changes in 'rows' and
+        record that 'project' is up to date as of 'synced'.
+        Nothing is changed unless all of it succeeds'''
+        with self._get_conn() as conn:
+            index = self._load_index(conn)
+            for row in rows:
+                conn.execute("INSERT OR REPLACE INTO changes VALUES (?, ?, ?, ?)",
+                             (int(row["number"]), row["project"],
+                              row.get("lastUpdated", 0), json.dumps(row)))
+                index.add(ModelChange.from_json(row))
+            conn.execute("INSERT OR REPLACE INTO projects VALUES (?, ?)",
+                         (project, synced))
+            self._save_index(conn, index)
+
+    def load(self, projects=None, numbers=None):
+        '''Yield the changes in 'projects', or in every project
+        if None, most recently updated first like the server. If
+        'numbers' is given, only changes in it are yielded'''
+        sql = "SELECT number, data FROM changes"
+        params = []
+        if projects is not None:
+            sql = sql + " WHERE project IN (%s)" % ", ".join(["?"] * len(projects))
+            params = list(projects)
+        sql = sql + " ORDER BY updated DESC, number DESC"
+        for row in self._get_conn().execute(sql, params):
+            if numbers is not None and row[0] not in numbers:
+                continue
+            yield json.loads(row[1])
@@ -24,6 +24,11 @@ class ModelUser(ModelBase):
         self.email = email
         self.username = username
 
+    def has_identity(self, identity):
+        '''Determine if 'identity' is the name, email
+        address or username of the user'''
+        return identity in [self.name, self.email, self.username]
+
     def is_in_list(self, users):
         if self.name is not None and self.name in users:
             return True
@@ -249,7 +254,8 @@ class ModelChange(ModelBase):
 
     def __init__(self, project, branch, topic, id, number, subject, owner, url,
                  createdOn, lastUpdated, status,
-                 patches = [], comments = [], depends = None):
+                 patches = [], comments = [], depends = None, sortkey = None,
+                 message = None, reviewers = None):
         self.project = project
         self.branch = branch
         self.topic = topic
@@ -270,6 +276,11 @@ class ModelChange(ModelBase):
         self.patches = patches
         self.comments = comments
         self.depends = depends
+        self.sortkey = sortkey
+        self.message = message
+        # Everyone added as a reviewer, only known if
+        # queried with --all-reviewers
+        self.reviewers = reviewers
 
     def get_current_patch(self):
         if len(self.patches) == 0:
@@ -373,6 +384,9 @@ class ModelChange(ModelBase):
         patches = []
         for p in data.get("patchSets", []):
             patches.append(ModelPatch.from_json(p))
+        # Queried with only --current-patch-set
+        if len(patches) == 0 and "currentPatchSet" in data:
+            patches.append(ModelPatch.from_json(data["currentPatchSet"]))
 
         user = None
         if "owner" in data:
@@ -386,6 +400,10 @@ class ModelChange(ModelBase):
         for c in data.get("comments", []):
             comments.append(ModelComment.from_json(c))
 
+        reviewers = None
+        if "allReviewers" in data:
+            reviewers = [ModelUser.from_json(r) for r in data["allReviewers"]]
+
         depends = None
         dependsChange = data.get("dependsOn")
         if dependsChange is not None and len(dependsChange) > 0:
@@ -405,7 +423,10 @@ class ModelChange(ModelBase):
                            data.get("status", None),
                            patches,
                            comments,
-                           depends)
+                           depends,
+                           data.get("sortKey", None),
+                           data.get("commitMessage", None),
+                           reviewers)
 
 
 class ModelEvent(ModelBase):
@@ -13,15 +13,89 @@
 # License for the specific language governing permissions and limitations
 # under the License.
 
+from gerrymander.client import ClientCancelled
 from gerrymander.model import ModelChange
 from gerrymander.model import ModelEvent
+from gerrymander.index import IndexChange
+
+import itertools
+import logging
+import re
+import threading
+import time
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+LOG = logging.getLogger(__name__)
 
 
 class OperationBase(object):
 
+    # Number of items iter() fetches ahead of its consumer
+    ITER_BUFFER = 500
+
     def __init__(self, client):
         self.client = client
 
+    @staticmethod
+    def _iterate(run, size):
+        '''Call 'run' on another thread, passing it a callback
+        for each item, and a function which returns True once
+        no more items are wanted. Yields each item passed to the
+        callback, of which at most 'size' are held at a time'''
+        class state(object):
+            def __init__(self):
+                self.cancelled = False
+                self.error = None
+
+        s = state()
+        items = queue.Queue(size)
+        done = object()
+
+        def put(item):
+            while not s.cancelled:
+                try:
+                    items.put(item, timeout=0.1)
+                    return
+                except queue.Full:
+                    pass
+            raise ClientCancelled()
+
+        def worker():
+            try:
+                run(put, lambda: s.cancelled)
+            except ClientCancelled:
+                pass
+            except Exception as e:
+                s.error = e
+            try:
+                put(done)
+            except ClientCancelled:
+                pass
+
+        thread = threading.Thread(target=worker)
+        thread.daemon = True
+        thread.start()
+        try:
+            while True:
+                item = items.get()
+                if item is done:
+                    break
+                yield item
+        finally:
+            # If the consumer stopped early, the command is killed
+            # as soon as it outputs anything more, which could be
+            # a long time for a stream of events, so it is not
+            # waited for
+            s.cancelled = True
+        thread.join()
+
+        if s.error is not None:
+            raise s.error
+
 
 class OperationQuery(OperationBase):
     PATCHES_NONE = "none"
@@ -35,8 +109,59 @@ class OperationQuery(OperationBase):
     STATUS_OPEN = "open"
     STATUS_CLOSED = "closed"
 
+    # Terms whose value can never change for an existing
+    # change, so a change can not drop out of the results
+    # of a query that only uses these
+    IMMUTABLE_TERMS = ["project", "branch", "change", "owner"]
+
+    # Values of the 'status' field of changes which
+    # are not expected to be updated again
+    CLOSED_STATUSES = ["MERGED", "ABANDONED"]
+
+    # Terms which matches() can evaluate locally. Reviewers
+    # can only be matched when queried with --all-reviewers,
+    # as otherwise changes only list those who voted
+    MATCH_TERMS = ["project", "branch", "topic", "status",
+                   "owner", "reviewer", "message", "change"]
+
+    # Terms which can be checked against the changes in the
+    # results of a broader query, instead of by the server
+    LOCAL_TERMS = ["owner", "reviewer", "branch", "topic", "status"]
+
+    # Values of the 'status' field matched by each value
+    # of the 'status' term which can be evaluated locally
+    LOCAL_STATUSES = {
+        STATUS_OPEN: ["NEW", "SUBMITTED", "DRAFT"],
+        STATUS_SUBMITTED: ["SUBMITTED"],
+        STATUS_MERGED: ["MERGED"],
+        STATUS_ABANDONED: ["ABANDONED"],
+        STATUS_CLOSED: ["MERGED", "ABANDONED"],
+    }
+
+    # Number of changes to ask for at a time
+    PAGE_SIZE = 500
+
+    # Allowance for clock skew against the server when
+    # asking for changes updated since the last fetch
+    SINCE_SLACK = 5 * 60
+
+    # Shards of a query split by time cover this much of the
+    # recent past between them, when no previous run recorded
+    # when its changes were updated. The oldest shard always
+    # covers all the time before the rest
+    SHARD_SPAN = 365 * 86400
+
+    # The times shards are split at are rounded down to this,
+    # so repeated runs ask the same queries and hit the cache
+    SHARD_ROUNDING = 86400
+
+    # Number of update times of the changes kept from each
+    # run, for balancing the shards of the next one
+    SHARD_SAMPLES = 100
+
     def __init__(self, client, terms={}, rawquery=None, patches=PATCHES_NONE,
-                 approvals=False, files=False, comments=False, deps=False):
+                 approvals=False, files=False, comments=False, deps=False,
+                 reviewers=False):
         OperationBase.__init__(self, client)
         self.terms = terms
         self.rawquery = rawquery
@@ -45,6 +170,10 @@ class OperationQuery(OperationBase):
         self.files = files
         self.comments = comments
         self.deps = deps
+        self.reviewers = reviewers
+        # The (after, before) times of the changes wanted,
+        # either of which may be None, for a shard of a query
+        self.window = None
 
         if self.patches == OperationQuery.PATCHES_NONE:
             if self.approvals:
@@ -52,7 +181,8 @@ class OperationQuery(OperationBase):
             if self.files:
                 raise Exception("files cannot be requested without patches")
 
-    def get_args(self, limit=None, offset=None, sortkey=None):
+    def get_args(self, limit=None, offset=None, sortkey=None, since=None,
+                 before=None):
         args = ["query", "--format=JSON"]
         if self.patches == OperationQuery.PATCHES_CURRENT:
             args.append("--current-patch-set")
@@ -67,6 +197,8 @@ class OperationQuery(OperationBase):
             args.append("--comments")
         if self.deps:
             args.append("--dependencies")
+        if self.reviewers:
+            args.append("--all-reviewers")
 
         clauses = []
         if offset is not None:
@@ -77,6 +209,17 @@ class OperationQuery(OperationBase):
             clauses.append("limit:" + str(limit))
         if sortkey is not None:
             clauses.append("resume_sortkey:" + sortkey)
+        if since is not None:
+            age = int(time.time() - since) + OperationQuery.SINCE_SLACK
+            clauses.append("-age:%ds" % age)
+        if self.window is not None:
+            if self.window[0] is not None:
+                clauses.append('after:"%s"' % self._format_time(self.window[0]))
+            if self.window[1] is not None and (before is None or
+                                               self.window[1] < before):
+                before = self.window[1]
+        if before is not None:
+            clauses.append('before:"%s"' % self._format_time(before))
         if self.rawquery is not None:
             clauses.append("(" + self.rawquery + ")")
         terms = list(self.terms.keys())
@@ -104,66 +247,896 @@ class OperationQuery(OperationBase):
         args.append(" AND ".join(clauses))
         return args
 
-    def run(self, cb, limit=None):
+    @staticmethod
+    def _format_time(when):
+        return time.strftime("%Y-%m-%d %H:%M:%S +0000", time.gmtime(when))
+
+    def is_incremental(self):
+        '''Determine if the results of this query can be kept up
+        to date by merging in the changes updated since they were
+        last fetched'''
+        if self.rawquery is not None:
+            return False
+        for term in self.terms.keys():
+            if term in OperationQuery.IMMUTABLE_TERMS:
+                continue
+            if len(self.terms[term]) > 0:
+                return False
+        return True
+
+    @staticmethod
+    def _decode(row):
+        # Rows describing the results, rather than changes,
+        # are left for _run_rows to interpret
+        if "type" in row:
+            return row
+        return ModelChange.from_json(row)
+
+    def _run_rows(self, cb, limit=None, since=None, live=False, decoder=None):
+        if not self.client.prefetch:
+            return self._run_pages(cb, limit, since, live, decoder)
+
+        # Pages are fetched on another thread, which runs up to
+        # a page ahead of the changes passed to 'cb', so that the
+        # next page is on its way while this one is processed
+        def run(put, stopped):
+            self._run_pages(put, limit, since, live, decoder, stopped)
+
+        rows = self._iterate(run, OperationQuery.PAGE_SIZE)
+        try:
+            for row in rows:
+                try:
+                    cb(row)
+                except ClientCancelled:
+                    raise
+                except Exception:
+                    LOG.exception("Failure processing %s", row)
+        finally:
+            rows.close()
+
+    def _run_pages(self, cb, limit=None, since=None, live=False, decoder=None,
+                   stopped=None, cached=False):
+        # With 'cached' set, stop short of any page which is not
+        # in the cache, returning False instead of True
         class tracker(object):
             def __init__(self):
                 self.gotany = True
                 self.count = 0
                 self.sortkey = None
                 self.has_more = False
+                self.more = None
+                self.keyset = False
+                self.page = 0
+                self.before = None
+                self.failed = None
+                self.updated = None
+                self.recent = {}
+
+        def run(args, cb):
+            if not live:
+                return self.client.run(args, cb, decoder)
+            if decoder is None:
+                return self.client.run_live(args, cb)
+            return self.client.run_live(args, lambda row: cb(decoder(row)))
 
         c = tracker()
+        c.keyset = self.client.paging == self.client.PAGING_KEYSET
         def mycb(line):
-            if 'rowCount' in line:
-                # New gerrit sets 'moreChanges'
-                if 'moreChanges' in line:
-                    c.has_more = line['moreChanges']
-                return
+            if isinstance(line, dict):
+                if 'rowCount' in line:
+                    # New gerrit sets 'moreChanges'
+                    if 'moreChanges' in line:
+                        c.has_more = line['moreChanges']
+                        c.more = c.has_more
+                    return
 
-            if 'type' in line and line['type'] == "error":
-                raise Exception(line['message'])
+                if 'type' in line and line['type'] == "error":
+                    if c.before is not None:
+                        c.failed = line['message']
+                        return
+                    raise Exception(line['message'])
+
+                sortkey = line.get("sortKey")
+                number = int(line["number"])
+                updated = line.get("lastUpdated")
+            else:
+                sortkey = line.sortkey
+                number = line.number
+                updated = line.lastUpdated
+
+            # Changes updated within a second of the last one of
+            # the page before are asked for again, so that none
+            # are missed if the server has finer grained times
+            c.page = c.page + 1
+            if number in c.recent:
+                return
+            if updated is not None:
+                if updated != c.updated:
+                    c.updated = updated
+                    c.recent = dict([(other, when) for other, when in c.recent.items()
+                                     if when <= updated + 1])
+                c.recent[number] = updated
 
-            change = ModelChange.from_json(line)
             # Old gerrit sets 'sortKey'
-            if "sortKey" in line:
-                c.sortkey = line["sortKey"]
+            if sortkey is not None:
+                c.sortkey = sortkey
             c.gotany = True
             c.count = c.count + 1
-            cb(change)
+            cb(line)
 
-        if limit is None:
-            while c.gotany:
-                c.gotany = False
-                offset = None
-                if c.has_more:
-                    offset = c.count
-                self.client.run(self.get_args(500, offset, c.sortkey), mycb)
+        while limit is None or c.count < limit:
+            if stopped is not None and stopped():
+                break
+
+            want = OperationQuery.PAGE_SIZE
+            if limit is not None and limit - c.count < want:
+                want = limit - c.count
+
+            offset = None
+            c.before = None
+            if c.keyset and c.count > 0:
+                c.before = c.updated + 1
+            elif c.has_more:
+                offset = c.count
+            c.gotany = False
+            c.more = None
+            c.page = 0
+            c.failed = None
+            args = self.get_args(want, offset, c.sortkey, since, c.before)
+            if cached and not self.client.is_cached(args):
+                return False
+            run(args, mycb)
+
+            if c.failed is not None:
+                LOG.debug("Paging by offset, as the server failed with %s" % c.failed)
+                c.keyset = False
+                c.has_more = True
+                continue
+
+            # Old gerrit pages with 'sortKey' instead, and
+            # without times there is nothing to page by
+            if c.sortkey or c.updated is None:
+                c.keyset = False
+            if c.keyset:
+                if c.more is False or (c.more is None and c.page < want):
+                    break
+                if not c.gotany:
+                    LOG.debug("Paging by offset, as the server repeated a page")
+                    c.keyset = False
+                    c.has_more = True
+            else:
+                if not c.gotany:
+                    break
                 if not c.sortkey and not c.has_more:
                     break
+        return True
+
+    def _run_incremental(self, cb):
+        key = self.get_args()
+        snapshot = self.client.load_snapshot(key)
+        now = time.time()
+
+        rows = {}
+        def rowcb(row):
+            rows[row["number"]] = row
+
+        validated = now
+        if snapshot is not None:
+            fetched, validated, oldrows, expired, revalidate = snapshot
+            for row in oldrows:
+                if revalidate and row.get("status") not in OperationQuery.CLOSED_STATUSES:
+                    continue
+                rows[row["number"]] = row
+
+            if expired:
+                LOG.debug("Merging changes updated since %d" % fetched)
+                self._run_rows(rowcb, since=fetched, live=True)
+                snapshot = None
+            if revalidate:
+                # The delta picks up changes which were closed
+                # since, so only those still open are missing
+                LOG.debug("Fetching all open changes again")
+                openterms = dict(self.terms)
+                openterms["status"] = [OperationQuery.STATUS_OPEN]
+                query = OperationQuery(self.client, openterms, self.rawquery,
+                                       self.patches, self.approvals, self.files,
+                                       self.comments, self.deps, self.reviewers)
+                query._run_rows(rowcb, live=True)
+                validated = now
         else:
-            while c.count < limit and c.gotany:
-                want = limit - c.count
-                if want > 500:
-                    want = 500
-                c.gotany = False
-                offset = None
-                if c.has_more:
-                    offset = c.count
-                self.client.run(self.get_args(want, offset, c.sortkey), mycb)
-                if not c.sortkey and not c.has_more:
+            self._run_rows(rowcb, live=True)
+
+        # Gerrit returns the most recently updated changes first
+        merged = sorted(rows.values(),
+                        key=lambda row: (row.get("lastUpdated", 0),
+                                         int(row["number"])),
+                        reverse=True)
+        if snapshot is None:
+            self.client.save_snapshot(key, now, validated, merged)
+
+        for row in merged:
+            cb(ModelChange.from_json(row))
+
+    @staticmethod
+    def _get_term_values(values):
+        # Split off the leading "!" which negates them all
+        if len(values) > 0 and values[0] == "!":
+            return True, [value.strip('"') for value in values[1:]]
+        return False, [value.strip('"') for value in values]
+
+    def _can_match_term(self, term, reviewers=None):
+        if reviewers is None:
+            reviewers = self.reviewers
+        negate, values = self._get_term_values(self.terms[term])
+        # Empty terms are left out of the query entirely
+        if len(values) == 0:
+            return True
+        if term not in OperationQuery.MATCH_TERMS:
+            return False
+        if term == "reviewer" and not reviewers:
+            return False
+        for value in values:
+            # What the server makes of empty values, such
+            # as a topic of "", is not an exact match
+            if value == "":
+                return False
+            if term in ["owner", "reviewer"]:
+                # Changes do not record account ids
+                if value == "self" or value.isdigit():
+                    return False
+            if term == "status" and value not in OperationQuery.LOCAL_STATUSES:
+                return False
+        return True
+
+    @staticmethod
+    def _match_value(term, value, change):
+        if term == "owner":
+            return change.owner is not None and change.owner.has_identity(value)
+        elif term == "reviewer":
+            if change.reviewers is None:
+                return False
+            for reviewer in change.reviewers:
+                if reviewer.has_identity(value):
+                    return True
+            return False
+        elif term == "status":
+            return change.status in OperationQuery.LOCAL_STATUSES[value]
+        elif term == "message":
+            # The server matches words anywhere in the commit
+            # message, but may only have sent the subject
+            text = change.message
+            if text is None:
+                text = change.subject
+            return text is not None and value.lower() in text.lower()
+        elif term == "change":
+            return value == str(change.number) or value == change.id
+        else:
+            actual = getattr(change, term)
+            if actual is None:
+                return False
+            # The server accepts branches with or without
+            # the refs/heads/ prefix
+            if term == "branch" and actual.startswith("refs/heads/"):
+                actual = actual[len("refs/heads/"):]
+            # Like the server, a leading ^ means a regex,
+            # which must match the whole of the value
+            if value.startswith("^"):
+                pattern = "(?:%s)$" % value[1:].rstrip("$")
+                if re.match(pattern, actual) is not None:
+                    return True
+                return (term == "branch" and
+                        re.match(pattern, "refs/heads/" + actual) is not None)
+            if term == "branch" and value.startswith("refs/heads/"):
+                value = value[len("refs/heads/"):]
+            return actual == value
+
+    def _match_term(self, term, change):
+        negate, values = self._get_term_values(self.terms[term])
+        if len(values) == 0:
+            return True
+        for value in values:
+            if self._match_value(term, value, change):
+                return not negate
+        return negate
+
+    def can_match(self):
+        '''Determine if matches() can evaluate every part of
+        the query locally'''
+        if self.rawquery is not None:
+            return False
+        for term in self.terms.keys():
+            if not self._can_match_term(term):
+                return False
+        return True
+
+    def matches(self, change):
+        '''Determine if 'change' would be in the results of
+        the query, without asking the server. This is only
+        possible if can_match() is True'''
+        if not self.can_match():
+            raise Exception("Query cannot be evaluated locally")
+        for term in self.terms.keys():
+            if not self._match_term(term, change):
+                return False
+        return True
+
+    def _trim_row(self, row, keepreviewers=False):
+        # Rows from the mirror, or from a query asking for more,
+        # have extra details about a change, so leave out what
+        # the server would not have sent for this query
+        row = dict(row)
+        if not self.comments:
+            row.pop("comments", None)
+        if not self.deps:
+            row.pop("dependsOn", None)
+            row.pop("neededBy", None)
+        if not self.reviewers and not keepreviewers:
+            row.pop("allReviewers", None)
+
+        current = row.pop("currentPatchSet", None)
+        allpatches = row.pop("patchSets", None)
+        if allpatches is None:
+            allpatches = []
+            if current is not None:
+                allpatches = [current]
+
+        patches = []
+        for patch in allpatches:
+            patch = dict(patch)
+            # The current patch always has its approvals
+            if not self.approvals and self.patches == OperationQuery.PATCHES_ALL:
+                patch.pop("approvals", None)
+            if not self.files:
+                patch.pop("files", None)
+            if not self.comments:
+                patch.pop("comments", None)
+            patches.append(patch)
+
+        if self.patches == OperationQuery.PATCHES_ALL:
+            row["patchSets"] = patches
+        elif self.patches == OperationQuery.PATCHES_CURRENT and len(patches) > 0:
+            row["currentPatchSet"] = patches[-1]
+        return row
+
+    def _get_mirror_projects(self):
+        # Only plain project names narrow down which
+        # changes in the mirror need to be looked at
+        negate, values = self._get_term_values(self.terms.get("project", []))
+        if negate or len(values) == 0:
+            return None
+        for value in values:
+            if value.startswith("^"):
+                return None
+        return values
+
+    def _find_candidates(self, index):
+        # Use the index to narrow down the changes worth
+        # decoding to those matching the terms it covers
+        numbers = None
+        for term in sorted(self.terms.keys()):
+            negate, values = self._get_term_values(self.terms[term])
+            if negate or len(values) == 0:
+                continue
+            if term in ["project", "branch", "topic"]:
+                if len([value for value in values if value.startswith("^")]) > 0:
+                    continue
+                found = index.find(term, values)
+            elif term == "status":
+                statuses = []
+                for value in values:
+                    statuses.extend(OperationQuery.LOCAL_STATUSES[value])
+                found = index.find(IndexChange.TERM_STATUS, statuses)
+            elif term == "owner":
+                def match(user):
+                    if user is None:
+                        return False
+                    for value in values:
+                        if user.has_identity(value):
+                            return True
+                    return False
+                found = index.find_users(IndexChange.TERM_OWNER, match)
+            else:
+                continue
+
+            if numbers is None:
+                numbers = found
+            else:
+                numbers = numbers & found
+        return numbers
+
+    def _run_offline(self, cb, limit=None):
+        # The mirror lists everyone added as a reviewer, so
+        # reviewers can be matched whatever the query asks for
+        if self.rawquery is not None:
+            raise Exception("Query cannot be answered from the mirror")
+        for term in self.terms.keys():
+            if not self._can_match_term(term, reviewers=True):
+                raise Exception("Query cannot be answered from the mirror")
+
+        mirror = self.client.mirror
+        projects = self._get_mirror_projects()
+        if projects is None:
+            if len(mirror.get_projects()) == 0:
+                raise Exception("The mirror is empty, run 'gerrymander mirror sync'")
+        else:
+            for project in projects:
+                if mirror.get_synced(project) is None:
+                    raise Exception("Project '%s' is not in the mirror" % project)
+
+        count = 0
+        keepreviewers = "reviewer" in self.terms
+        numbers = self._find_candidates(mirror.load_index())
+        for row in mirror.load(projects, numbers):
+            if limit is not None and count >= limit:
+                break
+            change = ModelChange.from_json(self._trim_row(row, keepreviewers))
+            matched = True
+            for term in self.terms.keys():
+                if not self._match_term(term, change):
+                    matched = False
                     break
+            if not matched:
+                continue
+            if not self.reviewers:
+                change.reviewers = None
+            count = count + 1
+            cb(change)
+
+    def _get_superset_flags(self, dropped):
+        # The flags of queries whose results have everything
+        # this query needs, preferring those asking for least
+        wanted = [self.patches, self.approvals, self.files,
+                  self.comments, self.deps,
+                  self.reviewers or "reviewer" in dropped]
+        patches = [self.patches]
+        if self.patches == OperationQuery.PATCHES_NONE:
+            patches.append(OperationQuery.PATCHES_CURRENT)
+        if self.patches != OperationQuery.PATCHES_ALL:
+            patches.append(OperationQuery.PATCHES_ALL)
+        options = [patches] + [[True] if value else [False, True]
+                               for value in wanted[1:]]
+
+        flags = []
+        for candidate in itertools.product(*options):
+            if (candidate[0] == OperationQuery.PATCHES_NONE and
+                (candidate[1] or candidate[2])):
+                continue
+            # Only the current patch comes with its votes,
+            # unless all approvals are asked for
+            if (self.patches == OperationQuery.PATCHES_CURRENT and
+                candidate[0] == OperationQuery.PATCHES_ALL and
+                not candidate[1]):
+                continue
+            flags.append(list(candidate))
+        return sorted(flags, key=lambda candidate: len(
+            [1 for have, want in zip(candidate, wanted) if have != want]))
+
+    def _find_superset(self):
+        # Look for a broader query, with some of the terms which
+        # can be checked locally left out, or asking for more
+        # details of each change, whose results are cached,
+        # preferring those which leave out the fewest terms
+        if self.rawquery is not None:
+            return None
+        if self.client.is_cached(self.get_args(OperationQuery.PAGE_SIZE)):
+            return None
+
+        # Reviewers are checked against all of them, as listed
+        # by a broader query asking for --all-reviewers
+        droppable = [term for term in sorted(self.terms.keys())
+                     if (term in OperationQuery.LOCAL_TERMS and
+                         len(self._get_term_values(self.terms[term])[1]) > 0 and
+                         self._can_match_term(term, reviewers=True))]
+        for count in range(0, len(droppable) + 1):
+            for dropped in itertools.combinations(droppable, count):
+                terms = {}
+                for term in self.terms.keys():
+                    if term in dropped:
+                        continue
+                    if len(self._get_term_values(self.terms[term])[1]) > 0:
+                        terms[term] = self.terms[term]
+                if len(terms) == 0:
+                    continue
+                for flags in self._get_superset_flags(dropped):
+                    query = OperationQuery(self.client, terms, None, *flags)
+                    if self.client.is_cached(query.get_args(OperationQuery.PAGE_SIZE)):
+                        return query, dropped
+        return None
+
+    def _store_pages(self, rows):
+        # Save 'rows', every change this query matches in the
+        # order the server returns them, as the result of each
+        # page _run_pages would ask for, so that running this
+        # query later is answered without contacting the server
+        keyset = self.client.paging == self.client.PAGING_KEYSET
+        for row in rows:
+            if "sortKey" in row or (keyset and row.get("lastUpdated") is None):
+                return
+
+        start = 0
+        offset = None
+        before = None
+        seen = set()
+        while True:
+            page = rows[start:start + OperationQuery.PAGE_SIZE]
+            more = start + len(page) < len(rows)
+            self.client.store(self.get_args(OperationQuery.PAGE_SIZE, offset,
+                                            before=before),
+                              page + [{"type": "stats", "rowCount": len(page),
+                                       "moreChanges": more}])
+            if not more:
+                break
+
+            new = [row for row in page if row["number"] not in seen]
+            seen.update([row["number"] for row in new])
+            # Like _run_pages, page by offset once a page by
+            # time turns up nothing new
+            if len(new) == 0:
+                keyset = False
+            if keyset:
+                # From the first change updated within a second
+                # of the last new one on this page
+                before = new[-1]["lastUpdated"] + 1
+                while rows[start]["lastUpdated"] > before:
+                    start = start + 1
+            else:
+                start = len(seen)
+                offset = start
+                before = None
+
+    def _get_shard(self, terms, window):
+        query = OperationQuery(self.client, terms, self.rawquery,
+                               self.patches, self.approvals, self.files,
+                               self.comments, self.deps, self.reviewers)
+        query.window = window
+        return query
+
+    def _get_shards(self, shards):
+        # Queries naming several projects are split between them,
+        # any others into windows of time, balanced to hold about
+        # as many changes each going by the previous run
+        projects = self.terms.get("project", [])
+        if len(projects) > 1 and projects[0] != "!":
+            shards = min(shards, len(projects))
+            return [self._get_shard(dict(self.terms, project=projects[i::shards]), None)
+                    for i in range(shards)], False
+
+        times = self.client.load_plan(self.get_args())
+        if times is None or len(times) < shards:
+            now = time.time()
+            cuts = [now - OperationQuery.SHARD_SPAN * i / (shards - 1)
+                    for i in range(1, shards)]
+        else:
+            cuts = [times[len(times) * i // shards] for i in range(1, shards)]
+
+        rounding = OperationQuery.SHARD_ROUNDING
+        cuts = sorted(set([int(cut // rounding) * rounding for cut in cuts]),
+                      reverse=True)
+        queries = []
+        before = None
+        for after in cuts + [None]:
+            queries.append(self._get_shard(self.terms, (after, before)))
+            before = after
+        return queries, True
+
+    def _run_sharded(self, cb, shards):
+        queries, bytime = self._get_shards(shards)
+        LOG.debug("Running query as %d shards" % len(queries))
+
+        class result(object):
+            def __init__(self):
+                self.changes = []
+                self.error = None
+                self.done = threading.Event()
+
+        # Set if the consumer stops early, to stop every shard
+        cancelled = threading.Event()
+
+        def worker(query, res):
+            def rowcb(change):
+                if cancelled.is_set():
+                    raise ClientCancelled()
+                res.changes.append(change)
+            try:
+                query._run_rows(rowcb, decoder=OperationQuery._decode)
+            except ClientCancelled:
+                pass
+            except Exception as e:
+                res.error = e
+            res.done.set()
+
+        results = []
+        for query in queries:
+            res = result()
+            thread = threading.Thread(target=worker, args=(query, res))
+            thread.daemon = True
+            thread.start()
+            results.append(res)
+
+        # Shards by time are in order of most recently updated
+        # first, like the server returns changes, but shards by
+        # project must all be merged. Changes updated when one
+        # window of time ends and the next starts are in both,
+        # as are any updated since an older shard was fetched,
+        # in which case the newest copy comes first
+        seen = set()
+        changes = []
+        times = []
+        try:
+            for res in results:
+                res.done.wait()
+                if res.error is not None:
+                    raise res.error
+                for change in res.changes:
+                    if change.number in seen:
+                        continue
+                    seen.add(change.number)
+                    if bytime:
+                        if change.lastUpdated is not None:
+                            times.append(change.lastUpdated)
+                        cb(change)
+                    else:
+                        changes.append(change)
+                res.changes = None
+        except:
+            cancelled.set()
+            raise
+
+        if not bytime:
+            changes.sort(key=lambda change: (change.lastUpdated or 0, change.number),
+                         reverse=True)
+            for change in changes:
+                cb(change)
+            return
+
+        times.sort(reverse=True)
+        if len(times) > OperationQuery.SHARD_SAMPLES:
+            times = [times[len(times) * i // OperationQuery.SHARD_SAMPLES]
+                     for i in range(OperationQuery.SHARD_SAMPLES)]
+        self.client.save_plan(self.get_args(), times)
+
+    def iter(self, limit=None, shards=1):
+        '''Run the query, yielding each change, with the same
+        arguments as run(). The query runs ahead of the consumer
+        by up to ITER_BUFFER changes, and the consumer may stop
+        at any point'''
+        return self._iterate(lambda put, stopped: self.run(put, limit, shards),
+                             OperationBase.ITER_BUFFER)
+
+    def run(self, cb, limit=None, shards=1):
+        '''Run the query, passing each change to 'cb'. Unless a
+        'limit' is given, it may be split into up to 'shards'
+        shards which run in parallel. 'cb' may raise
+        ClientCancelled to stop the query once it has enough'''
+        try:
+            self._run(cb, limit, shards)
+        except ClientCancelled:
+            LOG.debug("Query cancelled by consumer")
         return 0
 
+    def _run(self, cb, limit, shards):
+        if self.client.offline:
+            self._run_offline(cb, limit)
+            return
+
+        if (limit is None and
+            self.client.incremental and
+            self.is_incremental()):
+            self._run_incremental(cb)
+            return
+
+        superset = None
+        if limit is None:
+            superset = self._find_superset()
+        if superset is not None:
+            query, dropped = superset
+            LOG.debug("Checking %s locally against cached results" % ", ".join(dropped))
+            # Nothing is passed on until every page of the broader
+            # query has been found in the cache, as any one of them
+            # may have expired before its turn came
+            # Changes from a query asking for more are trimmed to
+            # what this one asks for, bar the reviewers until they
+            # have been checked. They are decoded here, as the
+            # decoded objects cached for the broader query would
+            # have everything it asked for
+            decoder = OperationQuery._decode
+            if query.get_args()[:-1] != self.get_args()[:-1]:
+                decoder = None
+            keepreviewers = "reviewer" in dropped
+            matched = []
+            def subsetcb(change):
+                if decoder is None:
+                    change = ModelChange.from_json(
+                        self._trim_row(change, keepreviewers))
+                for term in dropped:
+                    if not self._match_term(term, change):
+                        return
+                if decoder is None and not self.reviewers:
+                    change.reviewers = None
+                matched.append(change)
+            if query._run_pages(subsetcb, decoder=decoder, cached=True):
+                for change in matched:
+                    cb(change)
+                return
+            LOG.debug("Not every page of the broader query is cached")
+
+        # Results cached from running the query whole are
+        # replayed, rather than fetching every shard again
+        if (limit is None and shards > 1 and
+            not self.client.is_cached(self.get_args(OperationQuery.PAGE_SIZE))):
+            self._run_sharded(cb, shards)
+            return
+
+        self._run_rows(cb, limit, decoder=OperationQuery._decode)
+
+
+class OperationQueryBatch(OperationBase):
+    '''Runs several queries which differ only in the single
+    project they name as one query naming all the projects,
+    then splits its results back up between them. The results
+    of each query are saved as if it had been run by itself,
+    so that it can be answered from the cache afterwards'''
+
+    def __init__(self, client, queries):
+        OperationBase.__init__(self, client)
+        self.queries = queries
+
+    @staticmethod
+    def _get_project(query):
+        # The project named by a query which can be batched
+        if query.rawquery is not None or query.window is not None:
+            return None
+        if query.client.offline:
+            return None
+        if query.client.incremental and query.is_incremental():
+            return None
+        projects = query.terms.get("project", [])
+        if len(projects) != 1 or projects[0] == "!" or projects[0].startswith("^"):
+            return None
+        return projects[0].strip('"')
+
+    @staticmethod
+    def _get_batch_key(query):
+        # What else must be the same for queries to be batched
+        terms = [(term, tuple(values)) for term, values in query.terms.items()
+                 if term != "project"]
+        return (query.client, tuple(sorted(terms)), query.patches,
+                query.approvals, query.files, query.comments, query.deps,
+                query.reviewers)
+
+    @staticmethod
+    def group(queries, size):
+        '''Replace runs of consecutive queries in 'queries' which
+        can be batched together with an OperationQueryBatch of
+        up to 'size' of them'''
+        grouped = []
+        batch = []
+
+        def flush():
+            if len(batch) > 1:
+                grouped.append(OperationQueryBatch(batch[0].client, list(batch)))
+            else:
+                grouped.extend(batch)
+            del batch[:]
+
+        for query in queries:
+            if size <= 1 or OperationQueryBatch._get_project(query) is None:
+                flush()
+                grouped.append(query)
+                continue
+            if len(batch) > 0 and (len(batch) >= size or
+                                   (OperationQueryBatch._get_batch_key(query) !=
+                                    OperationQueryBatch._get_batch_key(batch[0]))):
+                flush()
+            batch.append(query)
+        flush()
+        return grouped
+
+    def run(self, cb, limit=None, shards=1):
+        '''Run all the queries, passing the changes of each one
+        to 'cb' in turn, the same as running them one by one'''
+        if limit is not None:
+            raise Exception("Batched queries cannot have a limit")
+        try:
+            self._run(cb, shards)
+        except ClientCancelled:
+            LOG.debug("Queries cancelled by consumer")
+        return 0
+
+    def _run(self, cb, shards):
+
+        # Those with cached results are best answered from them
+        pending = [query for query in self.queries
+                   if not self.client.is_cached(query.get_args(OperationQuery.PAGE_SIZE))]
+        rows = {}
+        if len(pending) > 1:
+            projects = [self._get_project(query) for query in pending]
+            for project in projects:
+                rows[project] = []
+            terms = dict(pending[0].terms)
+            terms["project"] = [query.terms["project"][0] for query in pending]
+            batched = OperationQuery(self.client, terms,
+                                     patches=pending[0].patches,
+                                     approvals=pending[0].approvals,
+                                     files=pending[0].files,
+                                     comments=pending[0].comments,
+                                     deps=pending[0].deps,
+                                     reviewers=pending[0].reviewers)
+            LOG.debug("Running queries for %s as one" % ", ".join(projects))
+            def rowcb(row):
+                if row.get("project") in rows:
+                    rows[row["project"]].append(row)
+            batched._run_rows(rowcb, live=True)
+
+        for query in self.queries:
+            project = self._get_project(query)
+            if project not in rows:
+                query._run(cb, None, shards)
+                continue
+            query._store_pages(rows[project])
+            for row in rows[project]:
+                try:
+                    cb(ModelChange.from_json(row))
+                except ClientCancelled:
+                    raise
+                except Exception:
+                    LOG.exception("Failure processing %s", row)
+
+
+class OperationMirrorSync(OperationBase):
+
+    def __init__(self, client, mirror, projects):
+        OperationBase.__init__(self, client)
+        self.mirror = mirror
+        self.projects = projects
+
+    def run(self, cb):
+        '''Bring each project in the mirror up to date, passing
+        its name and the number of changes fetched to 'cb'. The
+        first sync of a project fetches all of its changes'''
+        for project in self.projects:
+            synced = self.mirror.get_synced(project)
+            now = time.time()
+            query = OperationQuery(self.client,
+                                   {
+                                       "project": [project],
+                                   },
+                                   patches=OperationQuery.PATCHES_ALL,
+                                   approvals=True,
+                                   files=True,
+                                   comments=True,
+                                   deps=True,
+                                   reviewers=True)
+            rows = []
+            if synced is None:
+                LOG.debug("Fetching all changes in %s" % project)
+            else:
+                LOG.debug("Fetching changes in %s updated since %d" % (project, synced))
+            query._run_rows(rows.append, since=synced, live=True)
+            self.mirror.update(project, now, rows)
+            cb(project, len(rows))
+
 
 class OperationWatch(OperationBase):
 
     def __init__(self, client):
         OperationBase.__init__(self, client)
 
+    def iter(self):
+        '''Yield each event as it arrives. Up to ITER_BUFFER
+        events are held while the consumer is busy'''
+        return self._iterate(lambda put, stopped: self.run(put),
+                             OperationBase.ITER_BUFFER)
+
     def run(self, cb):
+        '''Pass each event to 'cb' as it arrives, until 'cb'
+        raises ClientCancelled'''
         def mycb(line):
             event = ModelEvent.from_json(line)
             if event:
                 cb(event)
 
-        return self.client.run(["stream-events"], mycb)
+        try:
+            return self.client.run(["stream-events"], mycb)
+        except ClientCancelled:
+            LOG.debug("Watch cancelled by consumer")
@@ -18,13 +18,17 @@ import collections
 import prettytable
 import logging
 import time
-import re
 import json
 import sys
+import threading
 import xml.dom.minidom
 
 from gerrymander.operations import OperationQuery
+from gerrymander.operations import OperationQueryBatch
 from gerrymander.model import ModelApproval
+from gerrymander.model import ModelChange
+from gerrymander.index import IndexChange
+from gerrymander.index import IndexPath
 from gerrymander.format import format_date
 from gerrymander.format import format_delta
 from gerrymander.format import format_title
@@ -391,6 +395,64 @@ class Report(object):
 
     def __init__(self, client):
         self.client = client
+        self.jobs = 1
+        self.shards = 1
+        self.batch = 1
+
+    def run_queries(self, queries, cb):
+        '''Run all 'queries', passing each change to 'cb'. Up
+        to 'self.jobs' queries are run in parallel, but changes
+        are always passed to 'cb' in the order of the 'queries'
+        list, so the result is the same as running them serially.
+        Each query is itself split into 'self.shards' shards, while
+        up to 'self.batch' queries for different projects may be
+        combined into one'''
+        queries = OperationQueryBatch.group(queries, self.batch)
+        if self.jobs <= 1 or len(queries) <= 1:
+            for query in queries:
+                query.run(cb, shards=self.shards)
+            return
+
+        class result(object):
+            def __init__(self):
+                self.changes = []
+                self.error = None
+                self.done = threading.Event()
+
+        results = [result() for query in queries]
+        pending = list(range(len(queries)))
+        pendinglock = threading.Lock()
+
+        def worker():
+            while True:
+                with pendinglock:
+                    if len(pending) == 0:
+                        return
+                    idx = pending.pop(0)
+                try:
+                    queries[idx].run(results[idx].changes.append,
+                                     shards=self.shards)
+                except Exception as e:
+                    results[idx].error = e
+                results[idx].done.set()
+
+        workers = []
+        for i in range(min(self.jobs, len(queries))):
+            thread = threading.Thread(target=worker)
+            thread.daemon = True
+            thread.start()
+            workers.append(thread)
+
+        for res in results:
+            res.done.wait()
+            if res.error is not None:
+                raise res.error
+            for change in res.changes:
+                cb(change)
+            res.changes = None
+
+        for thread in workers:
+            thread.join()
 
     def generate(self):
         raise NotImplementedError("Subclass must override generate method")
@@ -473,7 +535,8 @@ class ReportPatchReviewStats(ReportTable):
         ReportOutputColumn("ratio", "+/-", ratio_mapfunc, format="%0.0lf%%", align=ReportOutputColumn.ALIGN_RIGHT),
     ]
 
-    def __init__(self, client, projects, maxagedays=30, teams={}, usecolor=False):
+    def __init__(self, client, projects, maxagedays=30, teams={}, usecolor=False,
+                 jobs=1, shards=1, batch=1):
         super(ReportPatchReviewStats, self).__init__(client,
                                                      ReportPatchReviewStats.COLUMNS,
                                                      sort="reviews", reverse=True)
@@ -481,6 +544,9 @@ class ReportPatchReviewStats(ReportTable):
         self.teams = teams
         self.maxagedays = maxagedays
         self.usecolor = usecolor
+        self.jobs = jobs
+        self.shards = shards
+        self.batch = batch
 
     def generate(self):
         # We could query all projects at once, but if we do them
@@ -489,22 +555,22 @@ class ReportPatchReviewStats(ReportTable):
         # combinations
         reviews = []
         cutoff = time.time() - (self.maxagedays * 24 * 60 * 60)
+        queries = []
         for project in self.projects:
-            query = OperationQuery(self.client,
-                                   {
-                                       "project": [project],
-                                   },
-                                   patches=OperationQuery.PATCHES_ALL,
-                                   approvals=True)
+            queries.append(OperationQuery(self.client,
+                                          {
+                                              "project": [project],
+                                          },
+                                          patches=OperationQuery.PATCHES_ALL,
+                                          approvals=True))
 
+        def querycb(change):
+            for patch in change.patches:
+                for approval in patch.approvals:
+                    if approval.is_newer_than(cutoff):
+                        reviews.append(approval)
 
-            def querycb(change):
-                for patch in change.patches:
-                    for approval in patch.approvals:
-                        if approval.is_newer_than(cutoff):
-                            reviews.append(approval)
-
-            query.run(querycb)
+        self.run_queries(queries, querycb)
 
         reviewers = {}
         for review in reviews:
@@ -649,13 +715,17 @@ class ReportPatchReviewRate(ReportTable):
         ReportOutputColumn("week52", "52 weeks", week_mapfunc, align=ReportOutputColumn.ALIGN_LEFT, format="%0.2f"),
      ]
 
-    def __init__(self, client, projects, teams={}, usecolor=False):
+    def __init__(self, client, projects, teams={}, usecolor=False, jobs=1,
+                 shards=1, batch=1):
         super(ReportPatchReviewRate, self).__init__(client,
                                                     ReportPatchReviewRate.COLUMNS,
                                                     sort="total", reverse=True)
         self.projects = projects
         self.teams = teams
         self.usecolor = usecolor
+        self.jobs = jobs
+        self.shards = shards
+        self.batch = batch
 
     def generate(self):
         # We could query all projects at once, but if we do them
@@ -664,42 +734,42 @@ class ReportPatchReviewRate(ReportTable):
         # combinations
         reviewers = {}
         now = time.time()
+        queries = []
         for project in self.projects:
-            query = OperationQuery(self.client,
-                                   {
-                                       "project": [project],
-                                   },
-                                   patches=OperationQuery.PATCHES_ALL,
-                                   approvals=True)
-
+            queries.append(OperationQuery(self.client,
+                                          {
+                                              "project": [project],
+                                          },
+                                          patches=OperationQuery.PATCHES_ALL,
+                                          approvals=True))
 
-            def querycb(change):
-                for patch in change.patches:
-                    for approval in patch.approvals:
-                        if approval.action == ModelApproval.ACTION_VERIFIED:
-                            continue
+        def querycb(change):
+            for patch in change.patches:
+                for approval in patch.approvals:
+                    if approval.action == ModelApproval.ACTION_VERIFIED:
+                        continue
 
-                        user = approval.user
-                        if user is None or user.username is None:
-                            continue
-                        username = user.username
+                    user = approval.user
+                    if user is None or user.username is None:
+                        continue
+                    username = user.username
 
-                        if username not in reviewers:
-                            reviewers[username] = { "total": 0}
+                    if username not in reviewers:
+                        reviewers[username] = { "total": 0}
 
-                        agesecs = approval.get_age(now)
-                        ageweeks = int(agesecs / (60 * 60 * 24 * 7)) + 1
-                        key = "week%d" % ageweeks
+                    agesecs = approval.get_age(now)
+                    ageweeks = int(agesecs / (60 * 60 * 24 * 7)) + 1
+                    key = "week%d" % ageweeks
 
-                        if key not in reviewers[username]:
-                            reviewers[username][key] = 0
+                    if key not in reviewers[username]:
+                        reviewers[username][key] = 0
 
-                        reviewers[username][key] = reviewers[username][key] + 1
+                    reviewers[username][key] = reviewers[username][key] + 1
 
-                        if ageweeks <= 52:
-                            reviewers[username]["total"] = reviewers[username]["total"] + 1
+                    if ageweeks <= 52:
+                        reviewers[username]["total"] = reviewers[username]["total"] + 1
 
-            query.run(querycb)
+        self.run_queries(queries, querycb)
 
         table = self.new_table("Daily review rates per week")
 
@@ -860,52 +930,84 @@ class ReportBaseChange(ReportTable):
 
 class ReportChangeList(ReportBaseChange):
 
+    # Columns showing the votes on the current patch
+    VOTE_COLUMNS = ["approvals", "tests", "reviews", "workflow"]
+
     def __init__(self, client, usecolor, title,
                  query_terms, patches, files=None, rawquery=None,
-                 deps=False):
+                 deps=False, reviewers=False):
         super(ReportChangeList, self).__init__(client, usecolor)
         self.title = title
         self.query_terms = query_terms
+        # The patches whose votes select() or filter() look at
         self.patches = patches
         self.rawquery = rawquery
         self.files = files
         self.deps = deps
+        # Whether to list everyone added as a reviewer, so
+        # the reviewer term can be checked locally
+        self.reviewers = reviewers
 
     def filter(self, change):
         return True
 
+    def select(self, index, changes):
+        '''Get the numbers of the 'changes' to include in the
+        report. Subclasses can override this to pick them with
+        set operations on 'index', instead of calling filter()
+        on every change'''
+        return set([change.number for change in changes
+                    if self.filter(change)])
+
+    def get_query_patches(self):
+        '''Work out the least patch data to ask for, to show the
+        visible columns, sort on the sort column and select the
+        changes, returning the 'patches' and 'approvals' arguments
+        for OperationQuery. The votes on the current patch come
+        with it, but votes on older patches need all of them'''
+        if self.patches == OperationQuery.PATCHES_ALL:
+            return OperationQuery.PATCHES_ALL, True
+
+        if (self.patches == OperationQuery.PATCHES_CURRENT or
+            self.sort in ReportChangeList.VOTE_COLUMNS or
+            (self.files is not None and len(self.files) > 0)):
+            return OperationQuery.PATCHES_CURRENT, False
+        for col in self.columns:
+            if col.visible and col.key in ReportChangeList.VOTE_COLUMNS:
+                return OperationQuery.PATCHES_CURRENT, False
+        return OperationQuery.PATCHES_NONE, False
+
     def generate(self):
+        patches, approvals = self.get_query_patches()
         query = OperationQuery(self.client,
                                self.query_terms,
                                rawquery=self.rawquery,
-                               patches=self.patches,
-                               approvals=True,
-                               files=(self.files is not None),
-                               deps=self.deps)
-
-        def match_files(change):
-            if len(self.files) == 0:
-                return True
-            for filere in self.files:
-                for file in change.get_current_patch().files:
-                    if re.search(filere, file.path):
-                        return True
-            return False
+                               patches=patches,
+                               approvals=approvals,
+                               files=(self.files is not None and
+                                      len(self.files) > 0),
+                               deps=self.deps,
+                               reviewers=self.reviewers)
 
         table = self.new_table(self.title)
 
+        changes = []
+        query.run(changes.append)
+
+        selected = self.select(IndexChange(changes), changes)
+        if self.files is not None and len(self.files) > 0:
+            selected = selected & IndexPath(changes).find(self.files)
+        changes = [change for change in changes
+                   if change.number in selected]
+
         if not self.deps:
-            def querycb(change):
-                if self.filter(change) and match_files(change):
-                    table.add_row(change)
-            query.run(querycb)
+            for change in changes:
+                table.add_row(change)
         else:
             # Index all changes by change id
             nodes = {}
-            def querycb(change):
-                if self.filter(change) and match_files(change):
-                    nodes[change.id] = TreeNode(change, [])
-            query.run(querycb)
+            for change in changes:
+                nodes[change.id] = TreeNode(change, [])
 
             # Create a hierarchy of changes by dependency
             root = []
@@ -950,15 +1052,17 @@ class ReportChanges(ReportChangeList):
         }
         super(ReportChanges, self).__init__(client, usecolor, "Changes",
                                             query_terms,
-                                            OperationQuery.PATCHES_CURRENT,
+                                            OperationQuery.PATCHES_NONE,
                                             files=files,
-                                            rawquery=rawquery, deps=deps)
+                                            rawquery=rawquery, deps=deps,
+                                            reviewers=len(reviewers) > 0)
 
 
 class ReportToDoList(ReportChangeList):
 
     def __init__(self, client, projects=[], branches=[],
-                 files=[], topics=[], reviewers=[], usecolor=False, deps=False):
+                 files=[], topics=[], reviewers=[], usecolor=False, deps=False,
+                 patches=OperationQuery.PATCHES_CURRENT):
         query_terms = {
             "project": projects,
             "status": [ OperationQuery.STATUS_OPEN ],
@@ -969,8 +1073,36 @@ class ReportToDoList(ReportChangeList):
         super(ReportToDoList, self).__init__(client, usecolor,
                                              "Changes To Do List",
                                              query_terms,
-                                             OperationQuery.PATCHES_ALL,
-                                             files, deps=deps)
+                                             patches,
+                                             files, deps=deps,
+                                             reviewers=True)
+
+    @staticmethod
+    def find_owned(index, users):
+        '''Get the changes owned by any of 'users' '''
+        return index.find_users(IndexChange.TERM_OWNER,
+                                lambda user: (user is not None and
+                                              ModelChange.is_user_in_list(users, user)))
+
+    @staticmethod
+    def find_current_reviewed(index, users):
+        '''Get the changes whose current patch has been
+        reviewed by any of 'users' '''
+        return index.find_users(IndexChange.TERM_CURRENT_REVIEWER,
+                                lambda user: user is not None and user.is_in_list(users))
+
+    @staticmethod
+    def find_other_reviewed(index, users):
+        '''Get the changes with any patch reviewed by
+        anyone not in 'users' '''
+        return index.find_users(IndexChange.TERM_REVIEWER,
+                                lambda user: user is None or not user.is_in_list(users))
+
+    @staticmethod
+    def find_current_approval(index, action, value):
+        '''Get the changes whose current patch has a vote
+        of type 'action' and 'value' '''
+        return index.find(IndexChange.TERM_CURRENT_APPROVAL, [(action, value)])
 
 
 class ReportToDoListMine(ReportToDoList):
@@ -992,12 +1124,10 @@ class ReportToDoListMine(ReportToDoList):
                                                  deps=deps)
         self.username = username
 
-    def filter(self, change):
-        if change.has_owner([self.username]):
-            return False
-        if not change.has_current_reviewers([self.username]):
-            return True
-        return False
+    def select(self, index, changes):
+        return (index.get_all() -
+                self.find_owned(index, [self.username]) -
+                self.find_current_reviewed(index, [self.username]))
 
 
 class ReportToDoListOthers(ReportToDoList):
@@ -1015,20 +1145,18 @@ class ReportToDoListOthers(ReportToDoList):
                                                    files=files,
                                                    topics=topics,
                                                    usecolor=usecolor,
-                                                   deps=deps)
+                                                   deps=deps,
+                                                   patches=OperationQuery.PATCHES_ALL)
         self.bots = bots
         self.username = username
 
-    def filter(self, change):
+    def select(self, index, changes):
         # allchanges contains changes where 'username' has
         # not reviewed any version of the patch. We want to
         # filter out changes which only have bots, or have
         # no reviewers at all.
-        if change.has_owner([self.username]):
-            return False
-        if change.has_any_other_reviewers(self.bots):
-            return True
-        return False
+        return (self.find_other_reviewed(index, self.bots) -
+                self.find_owned(index, [self.username]))
 
 
 class ReportToDoListAnyones(ReportToDoList):
@@ -1045,18 +1173,15 @@ class ReportToDoListAnyones(ReportToDoList):
                                                     files=files,
                                                     topics=topics,
                                                     usecolor=usecolor,
-                                                    deps=deps)
+                                                    deps=deps,
+                                                    patches=OperationQuery.PATCHES_ALL)
         self.bots = bots
         self.username = username
 
-    def filter(self, change):
-        if change.has_owner([self.username]):
-            return False
-        if change.has_current_reviewers([self.username]):
-            return False
-        if change.has_any_other_reviewers(self.bots):
-            return True
-        return False
+    def select(self, index, changes):
+        return (self.find_other_reviewed(index, self.bots) -
+                self.find_owned(index, [self.username]) -
+                self.find_current_reviewed(index, [self.username]))
 
 
 class ReportToDoListNoones(ReportToDoList):
@@ -1073,16 +1198,15 @@ class ReportToDoListNoones(ReportToDoList):
                                                    files=files,
                                                    topics=topics,
                                                    usecolor=usecolor,
-                                                   deps=deps)
+                                                   deps=deps,
+                                                   patches=OperationQuery.PATCHES_ALL)
         self.bots = bots
         self.username = username
 
-    def filter(self, change):
-        if change.has_owner([self.username]):
-            return False
-        if not change.has_any_other_reviewers(self.bots):
-            return True
-        return False
+    def select(self, index, changes):
+        return (index.get_all() -
+                self.find_owned(index, [self.username]) -
+                self.find_other_reviewed(index, self.bots))
 
 
 class ReportToDoListApprovable(ReportToDoList):
@@ -1103,21 +1227,18 @@ class ReportToDoListApprovable(ReportToDoList):
         self.username = username
         self.strict = strict
 
-    def filter(self, change):
-        if change.has_owner([self.username]):
-            return False
-        if (change.has_current_approval(ModelApproval.ACTION_REVIEWED, 2) and
-            not change.has_current_approval(ModelApproval.ACTION_WORKFLOW, -1) and
-            not change.has_current_approval(ModelApproval.ACTION_WORKFLOW, 1) and
-            not change.has_current_approval(ModelApproval.ACTION_REVIEWED, -2) and
-            not change.has_current_reviewers([self.username])):
+    def select(self, index, changes):
+        selected = (self.find_current_approval(index, ModelApproval.ACTION_REVIEWED, 2) -
+                    self.find_current_approval(index, ModelApproval.ACTION_WORKFLOW, -1) -
+                    self.find_current_approval(index, ModelApproval.ACTION_WORKFLOW, 1) -
+                    self.find_current_approval(index, ModelApproval.ACTION_REVIEWED, -2) -
+                    self.find_current_reviewed(index, [self.username]) -
+                    self.find_owned(index, [self.username]))
 
-            if (self.strict and
-                change.has_current_approval(ModelApproval.ACTION_REVIEWED, -1)):
-                return False
-
-            return True
-        return False
+        if self.strict:
+            selected = (selected -
+                        self.find_current_approval(index, ModelApproval.ACTION_REVIEWED, -1))
+        return selected
 
 
 class ReportToDoListExpirable(ReportToDoList):
@@ -1145,12 +1266,16 @@ class ReportToDoListExpirable(ReportToDoList):
 
 class ReportOpenReviewStats(ReportBaseChange):
 
-    def __init__(self, client, projects, branch="master", topic="", days=7, usecolor=False):
+    def __init__(self, client, projects, branch="master", topic="", days=7, usecolor=False,
+                 jobs=1, shards=1, batch=1):
         super(ReportOpenReviewStats, self).__init__(client, usecolor)
         self.projects = projects
         self.branch = branch
         self.topic = topic
         self.days = days
+        self.jobs = jobs
+        self.shards = shards
+        self.batch = batch
 
     @staticmethod
     def average_age(changes, ages):
@@ -1199,42 +1324,42 @@ class ReportOpenReviewStats(ReportBaseChange):
         wait_reviewer = []
         wait_submitter = []
         changes = {}
+        queries = []
         for project in self.projects:
-            query = OperationQuery(self.client,
-                                   {
-                                       "project": [project],
-                                       "status": [OperationQuery.STATUS_OPEN],
-                                       "branch": [self.branch],
-                                       "topic": [self.topic],
-                                   },
-                                   patches=OperationQuery.PATCHES_ALL,
-                                   approvals=True)
-
-
-            def querycb(change):
-                if change.status != "NEW":
-                    return
-
-                now = time.time()
-                current = change.get_current_patch()
-                first = change.get_first_patch()
-                nonnacked = change.get_reviewer_not_nacked_patch()
-
-                changes[change.id] = change
-
-                if current.is_nacked():
-                    wait_submitter.append(change.id)
-                else:
-                    wait_reviewer.append(change.id)
+            queries.append(OperationQuery(self.client,
+                                          {
+                                              "project": [project],
+                                              "status": [OperationQuery.STATUS_OPEN],
+                                              "branch": [self.branch],
+                                              "topic": [self.topic],
+                                          },
+                                          patches=OperationQuery.PATCHES_ALL,
+                                          approvals=True))
+
+        def querycb(change):
+            if change.status != "NEW":
+                return
+
+            now = time.time()
+            current = change.get_current_patch()
+            first = change.get_first_patch()
+            nonnacked = change.get_reviewer_not_nacked_patch()
+
+            changes[change.id] = change
+
+            if current.is_nacked():
+                wait_submitter.append(change.id)
+            else:
+                wait_reviewer.append(change.id)
 
-                agecurrent[change.id] = current.get_age(now)
-                agefirst[change.id] = first.get_age(now)
-                if nonnacked:
-                    agenonnacked[change.id] = nonnacked.get_age(now)
-                else:
-                    agenonnacked[change.id] = 0
+            agecurrent[change.id] = current.get_age(now)
+            agefirst[change.id] = first.get_age(now)
+            if nonnacked:
+                agenonnacked[change.id] = nonnacked.get_age(now)
+            else:
+                agenonnacked[change.id] = 0
 
-            query.run(querycb)
+        self.run_queries(queries, querycb)
 
         compound = ReportOutputCompound()
         summary = ReportOutputList([
@@ -0,0 +1,193 @@
+#
+# Copyright (C) 2014 Red Hat, Inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import json
+import os
+import pickle
+import shutil
+import sqlite3
+import tempfile
+import time
+import unittest
+
+from gerrymander.cache import CacheBackendFiles
+from gerrymander.cache import CacheBackendSQLite
+
+
+class TestGerrymanderCache(unittest.TestCase):
+
+    def setUp(self):
+        self.cachedir = tempfile.mkdtemp(prefix="gerrymander-cache-")
+
+    def tearDown(self):
+        shutil.rmtree(self.cachedir)
+
+    def store(self, cache, key, size):
+        entry = cache.open_entry(key, "")
+        entry.write(b'{"pad": "' + b"x" * (size - 12) + b'"}\n')
+        entry.commit()
+
+    def has_entry(self, cache, key):
+        return os.path.exists(os.path.join(self.cachedir, key + ".json"))
+
+    def test_scan_existing(self):
+        with open(os.path.join(self.cachedir, "old.json"), "w") as f:
+            f.write("{}\n")
+        cache = CacheBackendFiles(self.cachedir, 3600, 3600)
+        self.assertEqual(cache.manifest.get_total_size(), 3)
+
+    def test_manifest_upgrade(self):
+        conn = sqlite3.connect(os.path.join(self.cachedir, "manifest.db"))
+        conn.execute("CREATE TABLE entries (name TEXT PRIMARY KEY, kind TEXT NOT NULL, "
+                     "size INTEGER NOT NULL, atime REAL NOT NULL, mtime REAL NOT NULL)")
+        conn.commit()
+        conn.close()
+
+        cache = CacheBackendFiles(self.cachedir, 3600, 3600)
+        entry = cache.open_entry("limited", "", 50)
+        entry.commit()
+        self.assertEqual(cache.get_info("limited")[1], 50)
+
+    def test_purge_expired(self):
+        cache = CacheBackendFiles(self.cachedir, 3600, 3600)
+        self.store(cache, "old", 100)
+        self.store(cache, "new", 100)
+        cache.manifest.add("old.json", ".json", 100, time.time() - 7200)
+
+        cache.purge()
+        self.assertFalse(self.has_entry(cache, "old"))
+        self.assertTrue(self.has_entry(cache, "new"))
+        self.assertEqual(cache.manifest.get_total_size(), 100)
+
+    def test_purge_writing(self):
+        cache = CacheBackendFiles(self.cachedir, 3600, 3600)
+        now = time.time()
+        with cache.lock_entry("slow"):
+            entry = cache.open_entry("slow", "")
+            entry.write(b"{}\n")
+            cache._purge_locked(now + 3600 + cache.TMP_GRACE + 60)
+            entry.commit()
+        self.assertTrue(self.has_entry(cache, "slow"))
+
+        # Abandoned by a writer which crashed
+        entry = cache.open_entry("crashed", "")
+        cache._purge_locked(now + 3600 + 60)
+        self.assertTrue(os.path.exists(entry.tmpfile))
+        cache._purge_locked(now + 3600 + cache.TMP_GRACE + 60)
+        self.assertFalse(os.path.exists(entry.tmpfile))
+
+    def test_evict_lru(self):
+        cache = CacheBackendFiles(self.cachedir, 3600, 3600, maxsize=250)
+        now = time.time()
+        for key in ["a", "b", "c"]:
+            self.store(cache, key, 100)
+        cache.manifest.touch("a.json", now + 100)
+        cache.manifest.touch("b.json", now + 300)
+        cache.manifest.touch("c.json", now + 200)
+
+        cache.purge()
+        self.assertFalse(self.has_entry(cache, "a"))
+        self.assertTrue(self.has_entry(cache, "b"))
+        self.assertTrue(self.has_entry(cache, "c"))
+        self.assertEqual(cache.manifest.get_total_size(), 200)
+
+    def test_abort(self):
+        cache = CacheBackendFiles(self.cachedir, 3600, 3600)
+        entry = cache.open_entry("partial", "")
+        entry.write(b"{}\n")
+        entry.abort()
+        self.assertFalse(cache.replay("partial", lambda row: None))
+        self.assertEqual(cache.manifest.get_total_size(), 0)
+
+    def test_objects_format(self):
+        cache = CacheBackendFiles(self.cachedir, 3600, 3600)
+        cache.save_objects("objects", 100, [1, 2])
+        self.assertEqual(cache.load_objects("objects"), (100, [1, 2]))
+
+        # Pickled by a version which did not tag the format
+        file = os.path.join(self.cachedir, "objects.pickle")
+        with open(file, "wb") as f:
+            f.write(pickle.dumps((100, [1, 2])))
+        self.assertIsNone(cache.load_objects("objects"))
+
+        # Anyone else could make it run arbitrary code
+        cache.save_objects("objects", 100, [1, 2])
+        os.chmod(file, 0o666)
+        self.assertIsNone(cache.load_objects("objects"))
+
+    def load_sqlite(self, cache, key):
+        return cache._load(key, CacheBackendSQLite.KIND_QUERY)[1]
+
+    def test_sqlite_versions(self):
+        cache = CacheBackendSQLite(self.cachedir, 3600, 3600)
+        def change(updated, value):
+            return {"project": "nova", "number": "1", "lastUpdated": updated,
+                    "patchSets": [{"number": "1", "approvals": [
+                        {"type": "Code-Review", "value": value}]}]}
+        now = time.time()
+        cache.store("old", "", CacheBackendSQLite.KIND_QUERY, now - 7200,
+                    [change(10, "1")])
+        cache.store("new", "", CacheBackendSQLite.KIND_QUERY, now,
+                    [change(20, "-1")])
+
+        # Each result keeps the version of the change it was fetched with
+        self.assertEqual(self.load_sqlite(cache, "old"), [change(10, "1")])
+        self.assertEqual(self.load_sqlite(cache, "new"), [change(20, "-1")])
+
+        cache.purge()
+        self.assertIsNone(cache._load("old", CacheBackendSQLite.KIND_QUERY))
+        self.assertEqual(self.load_sqlite(cache, "new"), [change(20, "-1")])
+        conn = cache._get_conn()
+        for table in ["changes", "patchsets", "approvals"]:
+            self.assertEqual(conn.execute("SELECT COUNT(*) FROM %s" % table).fetchone()[0], 1)
+
+    def test_sqlite_upgrade(self):
+        conn = sqlite3.connect(os.path.join(self.cachedir, "cache.db"))
+        conn.execute("CREATE TABLE changes (number INTEGER NOT NULL, variant TEXT NOT NULL, "
+                     "lastUpdated INTEGER, project TEXT, status TEXT, data TEXT NOT NULL, "
+                     "PRIMARY KEY (number, variant))")
+        conn.commit()
+        conn.close()
+
+        cache = CacheBackendSQLite(self.cachedir, 3600, 3600)
+        rows = [{"project": "nova", "number": "1", "lastUpdated": 10}]
+        cache.store("query", "", CacheBackendSQLite.KIND_QUERY, time.time(), rows)
+        self.assertEqual(self.load_sqlite(cache, "query"), rows)
+
+    def test_compression(self):
+        rows = [{"number": str(i), "subject": "change %d" % i} for i in range(100)]
+        for compression in ["none", "gzip", "lzma", "zstd"]:
+            if not CacheBackendFiles._has_compression(compression):
+                continue
+            cache = CacheBackendFiles(self.cachedir, 3600, 3600,
+                                      compression=compression)
+            entry = cache.open_entry(compression, "")
+            for row in rows:
+                entry.write((json.dumps(row) + "\n").encode("UTF-8"))
+            entry.commit()
+
+            # Readable whatever compression is now configured
+            for reader in [cache, CacheBackendFiles(self.cachedir, 3600, 3600)]:
+                got = []
+                self.assertTrue(reader.replay(compression, got.append))
+                self.assertEqual(got, rows)
+
+    def test_compression_unavailable(self):
+        self.assertRaises(Exception, CacheBackendFiles,
+                          self.cachedir, 3600, 3600, compression="bogus")
+
+
+if __name__ == '__main__':
+    unittest.main()
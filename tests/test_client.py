@@ -0,0 +1,719 @@
+#
+# Copyright (C) 2014 Red Hat, Inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import json
+import os
+import select
+import shutil
+import stat
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+from gerrymander.client import ClientLive, ClientCaching, ClientOffline
+from gerrymander.client import ClientCancelled
+from gerrymander.index import IndexChange
+from gerrymander.mirror import Mirror
+from gerrymander.model import ModelChange
+from gerrymander.operations import OperationQuery
+from gerrymander.operations import OperationQueryBatch
+from gerrymander.operations import OperationMirrorSync
+
+# Stands in for 'ssh' on $PATH. Every invocation is logged, and
+# any query prints the rows from the 'rows' file next to it
+FAKE_SSH = '''#!%(python)s
+import os
+import sys
+import time
+
+here = os.path.dirname(os.path.abspath(__file__))
+with open(os.path.join(here, "log"), "a") as f:
+    f.write(" ".join(sys.argv[1:]) + "\\n")
+with open(os.path.join(here, "pid"), "w") as f:
+    f.write(str(os.getpid()))
+
+args = sys.argv[1:]
+if "-O" in args:
+    sys.exit(0)
+
+for arg in args:
+    if arg.startswith("ControlPath="):
+        open(arg[len("ControlPath="):], "w").close()
+
+if "gerrit" not in args:
+    sys.exit(1)
+
+if os.path.exists(os.path.join(here, "delay")):
+    start = time.time()
+    time.sleep(float(open(os.path.join(here, "delay")).read()))
+    with open(os.path.join(here, "times"), "a") as f:
+        f.write("%%f %%f\\n" %% (start, time.time()))
+
+with open(os.path.join(here, "rows")) as f:
+    sys.stdout.write(f.read())
+
+if os.path.exists(os.path.join(here, "hang")):
+    sys.stdout.flush()
+    time.sleep(float(open(os.path.join(here, "hang")).read()))
+
+if os.path.exists(os.path.join(here, "fail")):
+    sys.stderr.write("fatal: query failed\\n")
+    sys.exit(1)
+'''
+
+
+class FakeGerrit(object):
+
+    def __init__(self):
+        self.bindir = tempfile.mkdtemp(prefix="gerrymander-test-")
+        path = os.path.join(self.bindir, "ssh")
+        with open(path, "w") as f:
+            f.write(FAKE_SSH % {"python": sys.executable})
+        os.chmod(path, stat.S_IRWXU)
+        self.set_rows([])
+
+        self.oldpath = os.environ["PATH"]
+        os.environ["PATH"] = self.bindir + os.pathsep + self.oldpath
+
+    def set_rows(self, rows):
+        with open(os.path.join(self.bindir, "rows"), "w") as f:
+            for row in rows:
+                f.write(json.dumps(row) + "\n")
+
+    def set_fail(self, fail):
+        failfile = os.path.join(self.bindir, "fail")
+        if fail:
+            open(failfile, "w").close()
+        elif os.path.exists(failfile):
+            os.unlink(failfile)
+
+    def set_delay(self, delay):
+        with open(os.path.join(self.bindir, "delay"), "w") as f:
+            f.write(str(delay))
+
+    def set_hang(self, hang):
+        with open(os.path.join(self.bindir, "hang"), "w") as f:
+            f.write(str(hang))
+
+    def get_pid(self):
+        with open(os.path.join(self.bindir, "pid")) as f:
+            return int(f.read())
+
+    def get_times(self):
+        with open(os.path.join(self.bindir, "times")) as f:
+            return [list(map(float, line.split())) for line in f]
+
+    def get_calls(self):
+        logfile = os.path.join(self.bindir, "log")
+        if not os.path.exists(logfile):
+            return []
+        with open(logfile) as f:
+            return [line.split() for line in f]
+
+    def cleanup(self):
+        os.environ["PATH"] = self.oldpath
+        shutil.rmtree(self.bindir)
+
+
+ROWS = [
+    {"project": "nova", "number": "1", "status": "NEW", "lastUpdated": 20,
+     "topic": "bug/1",
+     "allReviewers": [{"name": "Dan", "username": "dan"}],
+     "patchSets": [
+         {"number": "1", "createdOn": 5},
+         {"number": "2", "createdOn": 15,
+          "approvals": [
+              {"type": "Code-Review", "value": "-1", "grantedOn": 18,
+               "by": {"name": "Dan", "username": "dan"}},
+              {"type": "Verified", "value": "1", "grantedOn": 16,
+               "by": {"name": "Jenkins", "username": "jenkins"}},
+          ]},
+     ]},
+    {"project": "nova", "number": "2", "status": "MERGED", "lastUpdated": 10},
+    {"type": "stats", "rowCount": 2, "moreChanges": False},
+]
+
+
+class TestGerrymanderClient(unittest.TestCase):
+
+    backend = ClientCaching.BACKEND_FILES
+
+    def setUp(self):
+        self.gerrit = FakeGerrit()
+        self.gerrit.set_rows(ROWS)
+        self.cachedir = tempfile.mkdtemp(prefix="gerrymander-cache-")
+
+    def tearDown(self):
+        self.gerrit.cleanup()
+        shutil.rmtree(self.cachedir)
+
+    def run_client(self, client, cmdargv=["query", "project:nova"]):
+        rows = []
+        client.run(cmdargv, rows.append)
+        return rows
+
+    def test_live(self):
+        client = ClientLive()
+        self.assertEqual(self.run_client(client), ROWS)
+        self.assertEqual(client.stats["commands"], 1)
+        client.close()
+
+    def test_multiplex(self):
+        client = ClientLive(multiplex=True)
+        self.run_client(client)
+        self.run_client(client)
+
+        controldir = client.controldir
+        client.close()
+        self.assertFalse(os.path.exists(controldir))
+
+        calls = self.gerrit.get_calls()
+        self.assertEqual(len(calls), 3)
+        for call in calls:
+            self.assertIn("ControlPath=" + os.path.join(controldir, "control"), call)
+            self.assertIn("ControlPersist=60", call)
+        self.assertEqual(calls[2][0:2], ["-O", "exit"])
+        self.assertEqual(client.stats["commands"], 2)
+
+    def test_multiplex_threads(self):
+        client = ClientLive(multiplex=True)
+        mkdtemp = tempfile.mkdtemp
+
+        def slow_mkdtemp(*args, **kwargs):
+            time.sleep(0.05)
+            return mkdtemp(*args, **kwargs)
+
+        paths = []
+        with mock.patch.object(tempfile, "mkdtemp", side_effect=slow_mkdtemp) as patched:
+            threads = [threading.Thread(target=lambda: paths.append(client._get_control_path()))
+                       for idx in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertEqual(patched.call_count, 1)
+        self.assertEqual(len(set(paths)), 1)
+        client.close()
+
+    def test_caching(self):
+        client = ClientCaching(cachedir=self.cachedir, backend=self.backend)
+        self.assertEqual(self.run_client(client), ROWS)
+        self.assertEqual(self.run_client(client), ROWS)
+        self.assertEqual(len(self.gerrit.get_calls()), 1)
+
+    def test_caching_warm_no_subprocess(self):
+        client = ClientCaching(cachedir=self.cachedir, backend=self.backend)
+        self.run_client(client)
+
+        with mock.patch.object(subprocess, "Popen") as popen:
+            self.assertEqual(self.run_client(client), ROWS)
+            self.assertEqual(popen.call_count, 0)
+
+    def test_caching_multiplex(self):
+        client = ClientCaching(cachedir=self.cachedir, backend=self.backend, multiplex=True)
+        self.run_client(client)
+        client.close()
+
+        client = ClientCaching(cachedir=self.cachedir, backend=self.backend, multiplex=True)
+        self.assertEqual(self.run_client(client), ROWS)
+        client.close()
+        self.assertEqual(len([call for call in self.gerrit.get_calls()
+                              if "gerrit" in call]), 1)
+
+    def test_caching_failure(self):
+        self.gerrit.set_fail(True)
+        client = ClientCaching(cachedir=self.cachedir, backend=self.backend)
+        rows = []
+        self.assertRaises(Exception, client.run, ["query", "project:nova"], rows.append)
+        # Rows seen before the failure were streamed to the callback,
+        # but nothing may be left behind in the cache
+        self.assertEqual(rows, ROWS)
+        key = client._get_cache_key(["query", "project:nova"])
+        self.assertFalse(client.cache.replay(key, rows.append))
+        self.assertFalse([file for file in os.listdir(self.cachedir)
+                          if file.endswith((".json", ".tmp"))])
+
+        self.gerrit.set_fail(False)
+        self.assertEqual(self.run_client(client), ROWS)
+        self.assertEqual(len(self.gerrit.get_calls()), 2)
+
+    def test_caching_cancel(self):
+        # The command is killed rather than waited for, and what
+        # it output beforehand is not cached
+        self.gerrit.set_hang(30)
+        client = ClientCaching(cachedir=self.cachedir, backend=self.backend)
+        changes = []
+        def cb(change):
+            changes.append(change)
+            raise ClientCancelled()
+
+        start = time.time()
+        OperationQuery(client, {"project": ["nova"]}).run(cb)
+        self.assertLess(time.time() - start, 10)
+        self.assertEqual([change.number for change in changes], [1])
+        self.assertFalse([file for file in os.listdir(self.cachedir)
+                          if file.endswith((".json", ".tmp"))])
+        key = client._get_cache_key(["query", "--format=JSON", "limit:500 AND ( project:nova )"])
+        self.assertIsNone(client.cache.get_info(key))
+        self.assertRaises(OSError, os.kill, self.gerrit.get_pid(), 0)
+
+    def test_caching_empty(self):
+        self.gerrit.set_rows([])
+        client = ClientCaching(cachedir=self.cachedir, backend=self.backend)
+        self.assertEqual(self.run_client(client), [])
+        self.assertEqual(self.run_client(client), [])
+
+    def run_concurrent(self, queries):
+        # A separate client per thread, as if they were
+        # separate processes sharing the cache directory
+        results = [None] * len(queries)
+
+        def worker(idx):
+            client = ClientCaching(cachedir=self.cachedir, backend=self.backend)
+            results[idx] = self.run_client(client, queries[idx])
+
+        threads = [threading.Thread(target=worker, args=(idx,))
+                   for idx in range(len(queries))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_caching_single_flight(self):
+        self.gerrit.set_delay(0.5)
+        results = self.run_concurrent([["query", "project:nova"]] * 4)
+        self.assertEqual(results, [ROWS] * 4)
+        self.assertEqual(len(self.gerrit.get_calls()), 1)
+        self.assertEqual(os.listdir(os.path.join(self.cachedir, "locks")), [])
+
+    def test_caching_parallel_keys(self):
+        self.gerrit.set_delay(0.5)
+        self.run_concurrent([["query", "project:nova"],
+                             ["query", "project:glance"]])
+        self.assertEqual(len(self.gerrit.get_calls()), 2)
+        # Both commands were running at the same time
+        times = self.gerrit.get_times()
+        self.assertLess(max([start for start, end in times]),
+                        min([end for start, end in times]))
+
+    def wait_revalidate(self, calls):
+        for i in range(200):
+            if (len(self.gerrit.get_calls()) >= calls and
+                os.listdir(os.path.join(self.cachedir, "locks")) == []):
+                return
+            time.sleep(0.05)
+        self.fail("background refresh did not complete")
+
+    def test_stale_while_revalidate(self):
+        client = ClientCaching(cachedir=self.cachedir, backend=self.backend,
+                               stalelifetime=3600)
+        self.run_client(client)
+
+        newrows = ROWS[1:]
+        self.gerrit.set_rows(newrows)
+        client.cachelifetime = 0
+        self.assertEqual(self.run_client(client), ROWS)
+        self.wait_revalidate(2)
+
+        client.cachelifetime = 3600
+        self.assertEqual(self.run_client(client), newrows)
+        self.assertEqual(len(self.gerrit.get_calls()), 2)
+
+    def test_revalidate_fds(self):
+        client = ClientCaching(cachedir=self.cachedir, backend=self.backend,
+                               stalelifetime=3600)
+        self.run_client(client)
+
+        # Stands in for the pipe to the pager, which must not
+        # be held open by the refresh
+        readfd, writefd = os.pipe()
+        if hasattr(os, "set_inheritable"):
+            os.set_inheritable(writefd, True)
+        self.gerrit.set_delay(2)
+        client.cachelifetime = 0
+        self.run_client(client)
+        os.close(writefd)
+
+        ready = select.select([readfd], [], [], 1)[0]
+        self.assertEqual(ready, [readfd])
+        self.assertEqual(os.read(readfd, 1), b"")
+        os.close(readfd)
+        self.wait_revalidate(2)
+
+    def test_stale_too_old(self):
+        client = ClientCaching(cachedir=self.cachedir, backend=self.backend,
+                               stalelifetime=0)
+        self.run_client(client)
+
+        newrows = ROWS[1:]
+        self.gerrit.set_rows(newrows)
+        client.cachelifetime = 0
+        self.assertEqual(self.run_client(client), newrows)
+        self.assertEqual(len(self.gerrit.get_calls()), 2)
+
+    def test_caching_canonical_key(self):
+        keyfile = os.path.join(self.cachedir, "id_rsa")
+        open(keyfile, "w").close()
+        client = ClientCaching(cachedir=self.cachedir, backend=self.backend)
+        self.run_client(client, ["query", "--format=JSON", "--patch-sets",
+                                 "( project:nova OR project:glance ) AND ( status:open )"])
+
+        # Differs in keyfile, flag order and clause order
+        client = ClientCaching(hostname="REVIEW", keyfile=keyfile,
+                               cachedir=self.cachedir, backend=self.backend)
+        self.assertEqual(self.run_client(client, ["query", "--patch-sets", "--format=JSON",
+                                                  "status:open AND (project:glance OR project:nova)"]),
+                         ROWS)
+        self.assertEqual(len(self.gerrit.get_calls()), 1)
+
+        self.run_client(client, ["query", "--format=JSON", "project:nova"])
+        self.assertEqual(len(self.gerrit.get_calls()), 2)
+
+    def test_canonical_precedence(self):
+        def clauses(query):
+            return ClientCaching._parse_query(["query", query])[2]
+
+        # AND binds tighter than OR
+        self.assertNotEqual(clauses("status:open OR status:merged AND project:x"),
+                            clauses("( status:open OR status:merged ) AND project:x"))
+        self.assertEqual(clauses("( status:open OR status:merged ) AND project:x"),
+                         clauses("project:x AND (status:merged OR status:open)"))
+        self.assertEqual(clauses("status:open OR status:merged AND project:x"),
+                         ["( status:open OR status:merged AND project:x )"])
+        self.assertEqual(clauses("(a AND b) AND (c OR d OR c)"),
+                         ["( c OR d )", "a", "b"])
+
+    def test_caching_limit_superset(self):
+        client = ClientCaching(cachedir=self.cachedir, backend=self.backend)
+        self.assertEqual(self.run_client(client, ["query", "limit:500 AND project:nova"]),
+                         ROWS)
+        self.assertEqual(self.run_client(client, ["query", "project:nova AND limit:1"]),
+                         [ROWS[0], {"type": "stats", "rowCount": 1, "moreChanges": True}])
+        self.assertEqual(len(self.gerrit.get_calls()), 1)
+
+        # A larger limit can't be answered from a smaller one
+        self.run_client(client, ["query", "project:nova AND limit:600"])
+        self.assertEqual(len(self.gerrit.get_calls()), 2)
+
+    def test_caching_objects(self):
+        client = ClientCaching(cachedir=self.cachedir, backend=self.backend)
+        query = OperationQuery(client, {"project": ["nova"]})
+
+        def run_query():
+            changes = []
+            query.run(changes.append)
+            return [(change.number, change.status) for change in changes]
+
+        self.assertEqual(run_query(), [(1, "NEW"), (2, "MERGED")])
+        # Built from the JSON on the first hit, then reused
+        self.assertEqual(run_query(), [(1, "NEW"), (2, "MERGED")])
+        with mock.patch.object(ModelChange, "from_json") as from_json:
+            self.assertEqual(run_query(), [(1, "NEW"), (2, "MERGED")])
+            self.assertEqual(from_json.call_count, 0)
+
+        # Never outlive the JSON they were built from
+        self.gerrit.set_rows(ROWS[1:])
+        client.refresh = True
+        self.assertEqual(run_query(), [(2, "MERGED")])
+        client.refresh = False
+        self.assertEqual(run_query(), [(2, "MERGED")])
+        self.assertEqual(len(self.gerrit.get_calls()), 2)
+
+    def test_query_subsumption(self):
+        client = ClientCaching(cachedir=self.cachedir, backend=self.backend)
+        terms = {"project": ["nova"], "status": ["open"]}
+
+        def run_query(extra):
+            query = OperationQuery(client, dict(terms, **extra),
+                                   patches=OperationQuery.PATCHES_ALL,
+                                   approvals=True)
+            changes = []
+            query.run(changes.append)
+            return [change.number for change in changes]
+
+        self.assertEqual(run_query({}), [1, 2])
+        self.assertEqual(run_query({"topic": ["bug/1"]}), [1])
+        self.assertEqual(run_query({"topic": ["!", "bug/1"],
+                                    "branch": []}), [2])
+        self.assertEqual(run_query({"owner": ["dan"]}), [])
+        self.assertEqual(len(self.gerrit.get_calls()), 1)
+
+        # Needs the server to know who 'self' is, who has been
+        # added as a reviewer, and what an empty topic means
+        run_query({"owner": ["self"]})
+        run_query({"reviewer": ["dan"]})
+        run_query({"topic": [""]})
+        self.assertEqual(len(self.gerrit.get_calls()), 4)
+
+    def test_query_subsumption_flags(self):
+        client = ClientCaching(cachedir=self.cachedir, backend=self.backend)
+        terms = {"project": ["nova"], "status": ["open"]}
+
+        def run_query(extra, **kwargs):
+            query = OperationQuery(client, dict(terms, **extra), **kwargs)
+            changes = []
+            query.run(changes.append)
+            return changes
+
+        changes = run_query({}, patches=OperationQuery.PATCHES_ALL,
+                            approvals=True, reviewers=True)
+        self.assertEqual(len(changes[0].patches), 2)
+        self.assertEqual(len(changes[0].reviewers), 1)
+
+        # Reviewers are checked against all those listed
+        for extra, expected in [({"reviewer": ["dan"]}, [1]),
+                                ({"reviewer": ["!", "dan"]}, [2])]:
+            changes = run_query(extra, patches=OperationQuery.PATCHES_CURRENT,
+                                reviewers=True)
+            self.assertEqual([change.number for change in changes], expected)
+
+        # Details which were not asked for are left out
+        changes = run_query({}, patches=OperationQuery.PATCHES_CURRENT)
+        self.assertEqual([change.number for change in changes], [1, 2])
+        self.assertEqual(len(changes[0].patches), 1)
+        self.assertEqual(len(changes[0].patches[0].approvals), 2)
+        self.assertIsNone(changes[0].reviewers)
+        changes = run_query({"reviewer": ["dan"]})
+        self.assertEqual([change.number for change in changes], [1])
+        self.assertEqual(len(changes[0].patches), 0)
+        self.assertIsNone(changes[0].reviewers)
+        self.assertEqual(len(self.gerrit.get_calls()), 1)
+
+        # Asking for more than was cached needs the server
+        run_query({}, patches=OperationQuery.PATCHES_ALL,
+                  approvals=True, files=True)
+        self.assertEqual(len(self.gerrit.get_calls()), 2)
+
+    def test_incremental(self):
+        client = ClientCaching(cachedir=self.cachedir, backend=self.backend, incremental=True)
+        query = OperationQuery(client, {"project": ["nova"]})
+
+        def run_query():
+            changes = []
+            query.run(changes.append)
+            return [(change.number, change.status) for change in changes]
+
+        self.assertEqual(run_query(), [(1, "NEW"), (2, "MERGED")])
+        self.assertEqual(run_query(), [(1, "NEW"), (2, "MERGED")])
+        self.assertEqual(len(self.gerrit.get_calls()), 1)
+
+        self.gerrit.set_rows([
+            {"project": "nova", "number": "1", "status": "MERGED", "lastUpdated": 40},
+            {"project": "nova", "number": "3", "status": "NEW", "lastUpdated": 30},
+            {"type": "stats", "rowCount": 2, "moreChanges": False},
+        ])
+        client.cachelifetime = 0
+        self.assertEqual(run_query(), [(1, "MERGED"), (3, "NEW"), (2, "MERGED")])
+        calls = self.gerrit.get_calls()
+        self.assertEqual(len(calls), 2)
+        self.assertNotIn("-age:", " ".join(calls[0]))
+        self.assertIn("-age:", " ".join(calls[1]))
+
+    def test_incremental_revalidate(self):
+        client = ClientCaching(cachedir=self.cachedir, backend=self.backend, incremental=True)
+        query = OperationQuery(client, {"project": ["nova"]})
+        query.run(lambda change: None)
+
+        # Open changes are fetched again, while closed ones
+        # are kept from the snapshot
+        self.gerrit.set_rows([
+            {"project": "nova", "number": "3", "status": "NEW", "lastUpdated": 30},
+            {"type": "stats", "rowCount": 1, "moreChanges": False},
+        ])
+        client.snapshotlifetime = 0
+        changes = []
+        query.run(changes.append)
+        self.assertEqual([(change.number, change.status) for change in changes],
+                         [(3, "NEW"), (2, "MERGED")])
+
+        calls = self.gerrit.get_calls()
+        self.assertEqual(len(calls), 3)
+        self.assertIn("-age:", " ".join(calls[1]))
+        self.assertIn("status:open", " ".join(calls[2]))
+
+    def test_incremental_mutable_terms(self):
+        client = ClientCaching(cachedir=self.cachedir, backend=self.backend, incremental=True)
+        query = OperationQuery(client, {"project": ["nova"],
+                                        "status": ["open"]})
+        self.assertFalse(query.is_incremental())
+        query.run(lambda change: None)
+        self.assertFalse([file for file in os.listdir(self.cachedir)
+                          if file.endswith(".snapshot")])
+
+    def test_shard_plan(self):
+        client = ClientCaching(cachedir=self.cachedir, backend=self.backend)
+        argv = ["query", "project:nova"]
+        self.assertIsNone(client.load_plan(argv))
+        client.save_plan(argv, [100, 90, 80])
+
+        client = ClientCaching(cachedir=self.cachedir, backend=self.backend)
+        self.assertEqual(client.load_plan(argv), [100, 90, 80])
+        self.assertIsNone(client.load_plan(["query", "project:glance"]))
+
+    def test_batch(self):
+        self.gerrit.set_rows([
+            {"project": "nova", "number": "3", "lastUpdated": 30},
+            {"project": "glance", "number": "2", "lastUpdated": 20},
+            {"project": "nova", "number": "1", "lastUpdated": 10},
+            {"type": "stats", "rowCount": 3, "moreChanges": False},
+        ])
+        client = ClientCaching(cachedir=self.cachedir, backend=self.backend)
+        queries = [OperationQuery(client, {"project": [project]})
+                   for project in ["nova", "glance", "swift"]]
+        batch = OperationQueryBatch.group(queries, 5)
+        self.assertEqual(len(batch), 1)
+        changes = []
+        batch[0].run(changes.append)
+        self.assertEqual([change.number for change in changes], [3, 1, 2])
+        calls = self.gerrit.get_calls()
+        self.assertEqual(len(calls), 1)
+        self.assertIn("project:nova OR project:glance OR project:swift",
+                      " ".join(calls[0]))
+
+        # Each project's results were saved by themselves
+        for query, numbers in zip(queries, [[3, 1], [2], []]):
+            changes = []
+            query.run(changes.append)
+            self.assertEqual([change.number for change in changes], numbers)
+        self.assertEqual(len(self.gerrit.get_calls()), 1)
+
+
+class TestGerrymanderMirror(unittest.TestCase):
+
+    def setUp(self):
+        self.gerrit = FakeGerrit()
+        self.gerrit.set_rows(ROWS)
+        self.mirrordir = tempfile.mkdtemp(prefix="gerrymander-mirror-")
+        self.mirror = Mirror(self.mirrordir)
+
+    def tearDown(self):
+        self.gerrit.cleanup()
+        shutil.rmtree(self.mirrordir)
+
+    def sync(self):
+        synced = []
+        sync = OperationMirrorSync(ClientLive(), self.mirror, ["nova"])
+        sync.run(lambda project, count: synced.append((project, count)))
+        return synced
+
+    def run_offline(self, terms, **kwargs):
+        changes = []
+        query = OperationQuery(ClientOffline(self.mirror), terms, **kwargs)
+        query.run(changes.append)
+        return changes
+
+    def test_sync(self):
+        self.assertEqual(self.sync(), [("nova", 2)])
+        self.assertIsNotNone(self.mirror.get_synced("nova"))
+
+        # Later syncs only ask for what was updated since
+        self.gerrit.set_rows([
+            {"project": "nova", "number": "1", "status": "MERGED", "lastUpdated": 30},
+            {"type": "stats", "rowCount": 1, "moreChanges": False},
+        ])
+        self.assertEqual(self.sync(), [("nova", 1)])
+        calls = self.gerrit.get_calls()
+        self.assertEqual(len(calls), 2)
+        self.assertIn("--patch-sets", calls[0])
+        self.assertIn("--files", calls[0])
+        self.assertIn("--all-reviewers", calls[0])
+        self.assertNotIn("-age:", " ".join(calls[0]))
+        self.assertIn("-age:", " ".join(calls[1]))
+
+        self.assertEqual([(row["number"], row["status"])
+                          for row in self.mirror.load(["nova"])],
+                         [("1", "MERGED"), ("2", "MERGED")])
+        self.assertEqual(self.mirror.load_index().find(IndexChange.TERM_STATUS,
+                                                       ["MERGED"]),
+                         set([1, 2]))
+
+    def test_offline(self):
+        self.sync()
+
+        with mock.patch.object(subprocess, "Popen") as popen:
+            changes = self.run_offline({"project": ["nova"],
+                                        "status": [OperationQuery.STATUS_OPEN]},
+                                       patches=OperationQuery.PATCHES_ALL,
+                                       approvals=True)
+            self.assertEqual(popen.call_count, 0)
+        self.assertEqual([change.number for change in changes], [1])
+        self.assertEqual(len(changes[0].patches), 2)
+        self.assertEqual(len(changes[0].patches[1].approvals), 2)
+
+        # Only what the server would have sent is included
+        changes = self.run_offline({"change": ["1"]})
+        self.assertEqual(changes[0].patches, [])
+
+        self.assertEqual([change.number for change in
+                          self.run_offline({"project": ["^n.*"]})], [1, 2])
+
+    def test_offline_reviewers(self):
+        self.sync()
+
+        # As asked for by the to-do lists of 'dan'
+        for reviewers, expected in [(["dan"], [1]), (["!", "dan"], [])]:
+            changes = self.run_offline({"project": ["nova"],
+                                        "status": [OperationQuery.STATUS_OPEN],
+                                        "reviewer": reviewers},
+                                       patches=OperationQuery.PATCHES_CURRENT,
+                                       reviewers=True)
+            self.assertEqual([change.number for change in changes], expected)
+
+        changes = self.run_offline({"reviewer": ["dan"]})
+        self.assertEqual([change.number for change in changes], [1])
+        self.assertIsNone(changes[0].reviewers)
+
+    def test_resync_old(self):
+        self.sync()
+        conn = self.mirror._get_conn()
+        conn.execute("PRAGMA user_version = 0")
+        conn.commit()
+
+        # Mirrors from before reviewers were kept start over
+        self.assertIsNone(Mirror(self.mirrordir).get_synced("nova"))
+
+    def test_offline_unavailable(self):
+        self.sync()
+        self.assertRaises(Exception, self.run_offline, {"project": ["glance"]})
+        self.assertRaises(Exception, self.run_offline, {"label": ["Code-Review+2"]})
+        self.assertRaises(Exception, ClientOffline(self.mirror).run,
+                          ["query", "project:nova"], lambda row: None)
+
+
+class TestGerrymanderClientSQLite(TestGerrymanderClient):
+
+    backend = ClientCaching.BACKEND_SQLITE
+
+    def test_shared_changes(self):
+        client = ClientCaching(cachedir=self.cachedir, backend=self.backend)
+        self.run_client(client, ["query", "--patch-sets", "project:nova"])
+        self.run_client(client, ["query", "--patch-sets", "owner:dan"])
+        conn = client.cache._get_conn()
+        self.assertEqual(conn.execute("SELECT COUNT(*) FROM results").fetchone()[0], 6)
+        self.assertEqual(conn.execute("SELECT COUNT(*) FROM changes").fetchone()[0], 2)
+        self.assertEqual(conn.execute("SELECT COUNT(*) FROM approvals").fetchone()[0], 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,130 @@
+#
+# Copyright (C) 2014 Red Hat, Inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import pickle
+import unittest
+
+from gerrymander.index import IndexChange
+from gerrymander.index import IndexPath
+from gerrymander.model import ModelChange
+
+
+def make_change(number, owner, status="NEW", votes=[], oldvotes=[]):
+    def make_votes(votes):
+        return [{"type": "Code-Review", "value": str(value), "grantedOn": 10,
+                 "by": {"name": user, "username": user}}
+                for user, value in votes]
+
+    return ModelChange.from_json({
+        "project": "nova",
+        "branch": "master",
+        "number": str(number),
+        "status": status,
+        "owner": {"name": owner, "username": owner},
+        "patchSets": [
+            {"number": "1", "createdOn": 5, "approvals": make_votes(oldvotes)},
+            {"number": "2", "createdOn": 15, "approvals": make_votes(votes)},
+        ],
+    })
+
+
+def is_user(username):
+    return lambda user: user is not None and user.username == username
+
+
+class TestGerrymanderIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.index = IndexChange([
+            make_change(1, "alice", votes=[("bob", 2)]),
+            make_change(2, "bob", oldvotes=[("alice", -1)]),
+            make_change(3, "alice", status="MERGED"),
+        ])
+
+    def test_find(self):
+        self.assertEqual(self.index.get_all(), set([1, 2, 3]))
+        self.assertEqual(self.index.find(IndexChange.TERM_STATUS, ["NEW"]),
+                         set([1, 2]))
+        self.assertEqual(self.index.find(IndexChange.TERM_PROJECT, ["nova", "glance"]),
+                         set([1, 2, 3]))
+        self.assertEqual(self.index.find(IndexChange.TERM_CURRENT_APPROVAL,
+                                         [("Code-Review", 2)]),
+                         set([1]))
+
+    def test_find_users(self):
+        self.assertEqual(self.index.find_users(IndexChange.TERM_OWNER, is_user("alice")),
+                         set([1, 3]))
+        self.assertEqual(self.index.find_users(IndexChange.TERM_REVIEWER, is_user("alice")),
+                         set([2]))
+        self.assertEqual(self.index.find_users(IndexChange.TERM_CURRENT_REVIEWER,
+                                               is_user("alice")),
+                         set())
+
+    def test_update(self):
+        self.index.add(make_change(2, "bob", status="ABANDONED"))
+        self.assertEqual(self.index.find(IndexChange.TERM_STATUS, ["NEW"]), set([1]))
+        self.assertEqual(self.index.find(IndexChange.TERM_STATUS, ["ABANDONED"]),
+                         set([2]))
+        self.assertEqual(self.index.find_users(IndexChange.TERM_REVIEWER,
+                                               is_user("alice")),
+                         set())
+
+        self.index.remove(1)
+        self.assertEqual(self.index.get_all(), set([2, 3]))
+        self.assertEqual(self.index.find(IndexChange.TERM_STATUS, ["NEW"]), set())
+
+        index = pickle.loads(pickle.dumps(self.index))
+        self.assertEqual(index.terms, self.index.terms)
+
+
+class TestGerrymanderIndexPath(unittest.TestCase):
+
+    def setUp(self):
+        def make_change(number, files, oldfiles=[]):
+            return ModelChange.from_json({
+                "number": str(number),
+                "patchSets": [
+                    {"number": "1", "files": [{"file": file} for file in oldfiles]},
+                    {"number": "2", "files": [{"file": file} for file in files]},
+                ],
+            })
+
+        self.index = IndexPath([
+            make_change(1, ["nova/virt/libvirt/driver.py", "nova/tests/test_libvirt.py"]),
+            make_change(2, ["nova/compute/manager.py"], ["nova/virt/xenapi/driver.py"]),
+            make_change(3, ["doc/source/index.rst", "nova/virt/driver.py"]),
+        ])
+
+    def test_prefix(self):
+        self.assertEqual(IndexPath._get_prefix("^nova/virt/.*"), "nova/virt/")
+        self.assertEqual(IndexPath._get_prefix("^nova/virtx?/"), "nova/virt")
+        self.assertEqual(IndexPath._get_prefix("^doc|^nova"), None)
+        self.assertEqual(IndexPath._get_prefix("driver"), None)
+
+    def test_find(self):
+        self.assertEqual(self.index.find(["^nova/virt/"]), set([1, 3]))
+        self.assertEqual(self.index.find(["driver.py$"]), set([1, 3]))
+        self.assertEqual(self.index.find(["manager", "^doc/"]), set([2, 3]))
+        self.assertEqual(self.index.find(["xenapi"]), set())
+        self.assertEqual(self.index.find(["(a)\\1", "(?i)MANAGER"]), set([2]))
+
+    def test_update(self):
+        self.index.remove(3)
+        self.assertEqual(self.index.find(["^nova/virt/"]), set([1]))
+        self.assertNotIn("doc/source/index.rst", self.index.paths)
+
+
+if __name__ == '__main__':
+    unittest.main()
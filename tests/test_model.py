@@ -151,3 +151,26 @@ class TestGerrymanderModel(unittest.TestCase):
         self.assertEqual(type(change.patches[0].approvals[0].user), ModelUser)
         self.assertEqual(change.patches[0].approvals[0].user.name, "Jenkins")
         self.assertEqual(change.patches[0].approvals[0].user.username, "jenkins")
+
+    def test_json_current_patch(self):
+        data = json.loads(JSON_CHANGE)
+        patches = data.pop("patchSets")
+        data["currentPatchSet"] = patches[-1]
+        change = ModelChange.from_json(data)
+
+        self.assertEqual(len(change.patches), 1)
+        self.assertEqual(change.get_current_patch().number, 2)
+        self.assertEqual(len(change.get_current_patch().approvals),
+                         len(patches[-1].get("approvals", [])))
+
+    def test_json_reviewers(self):
+        data = json.loads(JSON_CHANGE)
+        self.assertIsNone(ModelChange.from_json(data).reviewers)
+
+        data["allReviewers"] = [{"name": "Dan Smith",
+                                 "email": "dms@danplanet.com",
+                                 "username": "danms"}]
+        change = ModelChange.from_json(data)
+        self.assertEqual(len(change.reviewers), 1)
+        self.assertEqual(type(change.reviewers[0]), ModelUser)
+        self.assertEqual(change.reviewers[0].username, "danms")
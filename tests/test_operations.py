@@ -0,0 +1,433 @@
+#
+# Copyright (C) 2014 Red Hat, Inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import calendar
+import re
+import time
+import unittest
+
+try:
+    from unittest import mock
+except ImportError:
+    import mock
+
+from gerrymander.client import ClientLive
+from gerrymander.model import ModelChange
+from gerrymander.operations import OperationBase
+from gerrymander.operations import OperationQuery
+from gerrymander.operations import OperationQueryBatch
+from gerrymander.operations import OperationWatch
+
+
+CHANGE = ModelChange.from_json({
+    "project": "openstack/nova",
+    "branch": "stable/icehouse",
+    "topic": "bug/1234",
+    "number": "85556",
+    "subject": "Fix the libvirt discard option",
+    "owner": {"name": "Boh Ricky", "email": "boh.ricky@gmail.com",
+              "username": "boh.ricky"},
+    "status": "NEW",
+    "patchSets": [
+        {"number": "1", "createdOn": 1396715237,
+         "approvals": [
+             {"type": "Code-Review", "value": "-1", "grantedOn": 1396715281,
+              "by": {"name": "Daniel Berrange", "username": "berrange"}},
+         ]},
+    ],
+    "comments": [
+        {"message": "Looks good", "timestamp": 1396715290,
+         "reviewer": {"name": "Dan Smith", "username": "danms"}},
+    ],
+})
+
+
+class PagingClient(ClientLive):
+    '''Pages through 'changes' like the server, which has
+    them sorted with the most recently updated first'''
+
+    def __init__(self, changes, paging=ClientLive.PAGING_KEYSET, before=True,
+                 prefetch=False, delay=0, fail=False):
+        super(PagingClient, self).__init__(paging=paging, prefetch=prefetch)
+        self.changes = changes
+        self.before = before
+        self.delay = delay
+        self.fail = fail
+        self.calls = []
+        self.times = []
+        self.plan = None
+        self.stored = {}
+
+    def run_live(self, cmdargv, cb):
+        self.calls.append(cmdargv)
+        start = time.time()
+        time.sleep(self.delay)
+        self.times.append((start, time.time()))
+        if self.fail:
+            raise Exception("Connection closed")
+        query = cmdargv[-1]
+        limit = int(re.search(r"limit:(\d+)", query).group(1))
+        start = 0
+        if "--start" in cmdargv:
+            start = int(cmdargv[cmdargv.index("--start") + 1])
+
+        changes = self.changes
+        projects = re.findall(r"project:(\S+)", query)
+        if len(projects) > 0:
+            changes = [change for change in changes
+                       if change["project"] in projects]
+        m = re.search(r'after:"([^"]+)"', query)
+        if m is not None:
+            after = calendar.timegm(time.strptime(m.group(1),
+                                                  "%Y-%m-%d %H:%M:%S +0000"))
+            changes = [change for change in changes
+                       if change["lastUpdated"] >= after]
+        m = re.search(r'before:"([^"]+)"', query)
+        if m is not None:
+            if not self.before:
+                cb({"type": "error", "message": "Unsupported query: before"})
+                return
+            before = calendar.timegm(time.strptime(m.group(1),
+                                                   "%Y-%m-%d %H:%M:%S +0000"))
+            changes = [change for change in changes
+                       if change["lastUpdated"] <= before]
+
+        page = changes[start:start + limit]
+        for change in page:
+            cb(change)
+        cb({"type": "stats", "rowCount": len(page),
+            "moreChanges": start + limit < len(changes)})
+
+    def run(self, cmdargv, cb, decoder=None):
+        rows = self.stored.get(" ".join(cmdargv[2:]))
+        if rows is None:
+            return super(PagingClient, self).run(cmdargv, cb, decoder)
+        for row in rows:
+            if decoder is not None:
+                row = decoder(row)
+            cb(row)
+
+    def is_cached(self, cmdargv):
+        return " ".join(cmdargv[2:]) in self.stored
+
+    def store(self, cmdargv, rows):
+        self.stored[" ".join(cmdargv[2:])] = rows
+
+    def load_plan(self, cmdargv):
+        return self.plan
+
+    def save_plan(self, cmdargv, times):
+        self.plan = times
+
+
+def make_changes(times):
+    return [{"project": "nova", "number": str(idx + 1), "lastUpdated": updated}
+            for idx, updated in enumerate(times)]
+
+
+class TestGerrymanderOperations(unittest.TestCase):
+
+    def query(self, terms, **kwargs):
+        kwargs.setdefault("patches", OperationQuery.PATCHES_ALL)
+        kwargs.setdefault("approvals", True)
+        return OperationQuery(ClientLive(), terms, **kwargs)
+
+    def assertMatches(self, terms, expected):
+        query = self.query(terms)
+        self.assertTrue(query.can_match())
+        self.assertEqual(query.matches(CHANGE), expected)
+
+    def test_match_terms(self):
+        self.assertMatches({"project": ["openstack/nova"]}, True)
+        self.assertMatches({"project": ["openstack/glance"]}, False)
+        self.assertMatches({"project": ["^openstack/.*"]}, True)
+        self.assertMatches({"project": ["^openstack/nova$"]}, True)
+        self.assertMatches({"project": ["^openstack/no"]}, False)
+        self.assertMatches({"project": ["^openstack/nova|openstack/glance"]}, True)
+        self.assertMatches({"branch": ["master", "stable/icehouse"]}, True)
+        self.assertMatches({"topic": ["bug/1234"]}, True)
+        self.assertMatches({"status": [OperationQuery.STATUS_OPEN]}, True)
+        self.assertMatches({"status": [OperationQuery.STATUS_CLOSED]}, False)
+        self.assertMatches({"owner": ["boh.ricky@gmail.com"]}, True)
+        self.assertMatches({"owner": ['"Boh Ricky"']}, True)
+        self.assertMatches({"message": ["libvirt"]}, True)
+        self.assertMatches({"message": ["xen"]}, False)
+
+    def test_match_combined(self):
+        self.assertMatches({"project": ["openstack/nova"],
+                            "topic": ["!", "bug/1234"]}, False)
+        self.assertMatches({"project": ["openstack/nova"],
+                            "owner": ["!", "berrange", "danms"],
+                            "topic": []}, True)
+        self.assertMatches({"project": ["openstack/nova"],
+                            "status": [OperationQuery.STATUS_MERGED]}, False)
+
+    def test_match_branch_prefix(self):
+        self.assertMatches({"branch": ["refs/heads/stable/icehouse"]}, True)
+        self.assertMatches({"branch": ["^refs/heads/stable/.*"]}, True)
+        self.assertMatches({"branch": ["^stable/.*"]}, True)
+        self.assertMatches({"branch": ["refs/heads/master"]}, False)
+
+    def test_match_reviewers(self):
+        change = ModelChange.from_json({
+            "project": "openstack/nova",
+            "number": "85556",
+            "allReviewers": [{"name": "Dan Smith", "username": "danms"}],
+        })
+        for terms, expected in [({"reviewer": ["danms"]}, True),
+                                ({"reviewer": ['"Dan Smith"']}, True),
+                                ({"reviewer": ["berrange"]}, False),
+                                ({"reviewer": ["!", "danms"]}, False)]:
+            query = self.query(terms, reviewers=True)
+            self.assertTrue(query.can_match())
+            self.assertEqual(query.matches(change), expected)
+
+    def test_cannot_match(self):
+        for query in [self.query({"owner": ["self"]}),
+                      self.query({"owner": ["1000096"]}),
+                      self.query({"reviewer": ["self"]}, reviewers=True),
+                      self.query({"status": [OperationQuery.STATUS_REVIEWED]}),
+                      self.query({"label": ["Code-Review+2"]}),
+                      self.query({"reviewer": ["danms"]}),
+                      self.query({"topic": [""]}),
+                      self.query({}, rawquery="is:starred")]:
+            self.assertFalse(query.can_match())
+            self.assertRaises(Exception, query.matches, CHANGE)
+
+    def test_superset_pages(self):
+        changes = make_changes([100, 90, 80, 70, 60])
+        client = PagingClient(changes)
+        with mock.patch.object(OperationQuery, "PAGE_SIZE", 2):
+            OperationQuery(client, {"project": ["nova"]})._store_pages(changes)
+            self.assertEqual(len(client.stored), 4)
+
+            def run_query():
+                found = []
+                OperationQuery(client, {"project": ["nova"],
+                                        "branch": ["!", "stable"]}).run(found.append)
+                return len(found)
+
+            self.assertEqual(run_query(), 5)
+            self.assertEqual(client.calls, [])
+
+            # Only subsumed once every page is in the cache
+            del client.stored[sorted(client.stored.keys())[0]]
+            self.assertEqual(run_query(), 5)
+            self.assertEqual(len(client.calls), 4)
+
+    def run_paging(self, client, limit=None):
+        changes = []
+        with mock.patch.object(OperationQuery, "PAGE_SIZE", 3):
+            OperationQuery(client, {"project": ["nova"]}).run(changes.append, limit)
+        return [change.number for change in changes]
+
+    def test_paging_keyset(self):
+        changes = make_changes([100, 90, 90, 80, 70, 70, 60])
+        client = PagingClient(changes)
+        self.assertEqual(self.run_paging(client), list(range(1, 8)))
+
+        # Each page asks again for the changes updated within a
+        # second of the last one seen, and drops those it has
+        self.assertEqual(len(client.calls), 4)
+        self.assertNotIn("before:", client.calls[0][-1])
+        for call, before in zip(client.calls[1:], ["00:01:31", "00:01:21", "00:01:11"]):
+            self.assertNotIn("--start", call)
+            self.assertIn('before:"1970-01-01 %s +0000"' % before, call[-1])
+
+        self.assertEqual(self.run_paging(client, limit=5), list(range(1, 6)))
+
+    def test_paging_keyset_full_page(self):
+        # The last page is full, but the server says it is the last
+        changes = make_changes([100, 90, 80, 70, 60])
+        client = PagingClient(changes)
+        self.assertEqual(self.run_paging(client), list(range(1, 6)))
+        self.assertEqual(len(client.calls), 2)
+
+    def test_paging_keyset_ties(self):
+        # More changes updated in the same second than fit in a page
+        changes = make_changes([100, 90, 90, 90, 90, 80])
+        client = PagingClient(changes)
+        self.assertEqual(self.run_paging(client), list(range(1, 7)))
+        self.assertEqual(client.calls[-1][2:4], ["--start", "4"])
+
+    def test_paging_offset(self):
+        changes = make_changes([100, 100, 90, 90, 90, 80, 70, 70, 60, 50])
+        client = PagingClient(changes, paging=ClientLive.PAGING_OFFSET)
+        self.assertEqual(self.run_paging(client), list(range(1, 11)))
+        self.assertEqual(client.calls[1][-3:-1], ["--start", "3"])
+
+    def test_paging_fallback(self):
+        # Servers which don't understand before: are paged by offset
+        changes = make_changes([100, 90, 80, 70, 60, 50, 40])
+        client = PagingClient(changes, before=False)
+        self.assertEqual(self.run_paging(client), list(range(1, 8)))
+        self.assertEqual(client.calls[-1][2:4], ["--start", "6"])
+        self.assertNotIn("before:", client.calls[-1][-1])
+
+    def test_prefetch(self):
+        changes = make_changes(list(range(100, 90, -1)))
+        client = PagingClient(changes, prefetch=True, delay=0.2)
+        processed = []
+        def cb(change):
+            time.sleep(0.05)
+            processed.append((change.number, time.time()))
+
+        with mock.patch.object(OperationQuery, "PAGE_SIZE", 3):
+            OperationQuery(client, {"project": ["nova"]}).run(cb)
+        self.assertEqual([number for number, when in processed], list(range(1, 11)))
+
+        # The second page was on its way while the first
+        # was still being processed
+        self.assertLess(client.times[1][0], processed[2][1])
+
+    def test_prefetch_failure(self):
+        client = PagingClient([], prefetch=True, fail=True)
+        query = OperationQuery(client, {"project": ["nova"]})
+        self.assertRaises(Exception, query.run, lambda change: None)
+
+    def test_shards_by_time(self):
+        changes = make_changes([100, 90, 80, 70, 60, 60, 50, 40])
+        client = PagingClient(changes)
+        query = OperationQuery(client, {"project": ["nova"]})
+        with mock.patch.object(OperationQuery, "SHARD_ROUNDING", 1):
+            for shards in [2, 2, 3]:
+                found = []
+                query.run(found.append, shards=shards)
+                self.assertEqual([change.number for change in found],
+                                 list(range(1, 9)))
+        self.assertEqual(client.plan, [100, 90, 80, 70, 60, 60, 50, 40])
+
+        # Once a run has recorded when the changes were updated,
+        # later runs split them into shards of about equal size
+        self.assertEqual(len(client.calls), 7)
+        self.assertEqual(sorted([call[-1] for call in client.calls[2:4]]),
+                         ['limit:500 AND after:"1970-01-01 00:01:00 +0000" AND ( project:nova )',
+                          'limit:500 AND before:"1970-01-01 00:01:00 +0000" AND ( project:nova )'])
+        self.assertIn('limit:500 AND after:"1970-01-01 00:01:00 +0000" AND '
+                      'before:"1970-01-01 00:01:20 +0000" AND ( project:nova )',
+                      [call[-1] for call in client.calls[4:]])
+
+    def test_shards_cached(self):
+        changes = make_changes([100, 90, 80, 70])
+        client = PagingClient(changes)
+        query = OperationQuery(client, {"project": ["nova"]})
+        query._store_pages(changes)
+        found = []
+        query.run(found.append, shards=2)
+        self.assertEqual([change.number for change in found], list(range(1, 5)))
+        self.assertEqual(client.calls, [])
+
+    def test_shards_by_project(self):
+        changes = [{"project": project, "number": str(idx + 1), "lastUpdated": updated}
+                   for idx, (project, updated) in enumerate([
+                       ("nova", 100), ("glance", 90), ("nova", 80),
+                       ("cinder", 70), ("glance", 60), ("swift", 50)])]
+        client = PagingClient(changes)
+        found = []
+        OperationQuery(client, {"project": ["nova", "glance", "cinder"]}).run(
+            found.append, shards=2)
+        self.assertEqual([change.number for change in found], [1, 2, 3, 4, 5])
+        self.assertEqual(sorted([call[-1] for call in client.calls]),
+                         ["limit:500 AND ( project:glance )",
+                          "limit:500 AND ( project:nova OR project:cinder )"])
+
+    def test_batch_group(self):
+        client = ClientLive()
+        def query(project, **kwargs):
+            return OperationQuery(client, {"project": [project]}, **kwargs)
+
+        queries = [query("nova"), query("glance"), query("swift"),
+                   query("^openstack/.*"),
+                   query("cinder"), query("neutron", patches=OperationQuery.PATCHES_ALL),
+                   query("heat")]
+        grouped = OperationQueryBatch.group(queries, 2)
+        self.assertEqual([getattr(query, "queries", [query]) for query in grouped],
+                         [queries[0:2], queries[2:3], queries[3:4], queries[4:5],
+                          queries[5:6], queries[6:7]])
+        self.assertEqual(OperationQueryBatch.group(queries, 1), queries)
+
+    def test_batch_store_pages(self):
+        changes = [{"project": project, "number": str(idx + 1), "lastUpdated": updated}
+                   for idx, (project, updated) in enumerate([
+                       ("nova", 100), ("glance", 90), ("nova", 90),
+                       ("nova", 90), ("nova", 80), ("glance", 70)])]
+        client = PagingClient(changes)
+        queries = [OperationQuery(client, {"project": [project]})
+                   for project in ["nova", "glance"]]
+        found = []
+        with mock.patch.object(OperationQuery, "PAGE_SIZE", 2):
+            OperationQueryBatch(client, queries).run(found.append)
+        self.assertEqual([change.number for change in found], [1, 3, 4, 5, 2, 6])
+
+        # Saved as the pages each query would have asked for
+        def numbers(rows):
+            return [row.get("number") for row in rows]
+        self.assertEqual(dict([(query, numbers(rows)) for query, rows in client.stored.items()]),
+                         {"limit:2 AND ( project:nova )": ["1", "3", None],
+                          'limit:2 AND before:"1970-01-01 00:01:31 +0000" AND '
+                          '( project:nova )': ["3", "4", None],
+                          "--start 3 limit:2 AND ( project:nova )": ["5", None],
+                          "limit:2 AND ( project:glance )": ["2", "6", None]})
+
+        # Which are enough to answer it without the server
+        del client.calls[:]
+        found = []
+        with mock.patch.object(OperationQuery, "PAGE_SIZE", 2):
+            queries[0].run(found.append)
+        self.assertEqual([change.number for change in found], [1, 3, 4, 5])
+        self.assertEqual(client.calls, [])
+
+    def test_iter(self):
+        changes = make_changes(list(range(100, 90, -1)))
+        client = PagingClient(changes)
+        query = OperationQuery(client, {"project": ["nova"]})
+        with mock.patch.object(OperationQuery, "PAGE_SIZE", 3):
+            self.assertEqual([change.number for change in query.iter()],
+                             list(range(1, 11)))
+            self.assertEqual([change.number for change in query.iter(limit=4)],
+                             list(range(1, 5)))
+
+            # The consumer can stop whenever it has enough
+            found = []
+            before = len(client.calls)
+            with mock.patch.object(OperationBase, "ITER_BUFFER", 2):
+                for change in query.iter():
+                    found.append(change.number)
+                    if len(found) == 3:
+                        break
+            self.assertEqual(found, [1, 2, 3])
+
+            # No more pages are asked for once it has stopped
+            time.sleep(0.5)
+            self.assertEqual(len(client.calls) - before, 2)
+
+    def test_iter_failure(self):
+        query = OperationQuery(PagingClient([], fail=True), {"project": ["nova"]})
+        self.assertRaises(Exception, list, query.iter())
+
+    def test_watch_iter(self):
+        class EventClient(ClientLive):
+            def run(self, cmdargv, cb, decoder=None):
+                for number in range(1, 4):
+                    cb({"type": "change-abandoned",
+                        "change": {"project": "nova", "number": str(number)},
+                        "abandoner": {"name": "Dan", "username": "dan"}})
+
+        events = OperationWatch(EventClient()).iter()
+        self.assertEqual([event.change.number for event in events], [1, 2, 3])
+
+
+if __name__ == '__main__':
+    unittest.main()
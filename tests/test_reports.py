@@ -0,0 +1,157 @@
+#
+# Copyright (C) 2014 Red Hat, Inc
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may
+# not use this file except in compliance with the License. You may obtain
+# a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations
+# under the License.
+
+import io
+import re
+import time
+import unittest
+
+from gerrymander.client import ClientLive
+from gerrymander.operations import OperationQuery
+from gerrymander.reports import ReportPatchReviewStats, ReportPatchReviewRate
+from gerrymander.reports import ReportToDoListMine, ReportToDoListOthers
+from gerrymander.reports import ReportToDoListNoones, ReportToDoListApprovable
+from gerrymander.reports import ReportChanges
+
+
+def make_change(project, number, reviewer, value, granted):
+    return {
+        "project": project,
+        "branch": "master",
+        "id": "I%s%d" % (project, number),
+        "number": str(number),
+        "status": "NEW",
+        "owner": {"name": "Owner", "username": "owner"},
+        "createdOn": granted - 100,
+        "lastUpdated": granted,
+        "patchSets": [
+            {
+                "number": "1",
+                "createdOn": granted - 100,
+                "approvals": [
+                    {
+                        "type": "Code-Review",
+                        "value": str(value),
+                        "grantedOn": granted,
+                        "by": {"name": reviewer, "username": reviewer},
+                    },
+                ],
+            },
+        ],
+    }
+
+
+class FakeClient(ClientLive):
+    '''Answers queries from an in memory list of changes
+    per project, taking longest for the first projects'''
+
+    def __init__(self, changes):
+        super(FakeClient, self).__init__()
+        self.changes = changes
+        self.calls = []
+
+    def run_live(self, cmdargv, cb):
+        self.calls.append(cmdargv)
+        project = re.search(r"project:(\S+)", cmdargv[-1]).group(1)
+        time.sleep(0.01 * (len(self.changes) - sorted(self.changes).index(project)))
+        for change in self.changes[project]:
+            cb(change)
+        cb({"type": "stats", "rowCount": len(self.changes[project])})
+
+
+class TestGerrymanderReports(unittest.TestCase):
+
+    def setUp(self):
+        now = int(time.time())
+        self.changes = {}
+        for idx, project in enumerate(["cinder", "glance", "nova", "swift"]):
+            self.changes[project] = [
+                make_change(project, idx * 10 + 1, "alice", 2, now - 100),
+                make_change(project, idx * 10 + 2, "bob", -1, now - 200),
+                make_change(project, idx * 10 + 3, "user%d" % idx, 1, now - 300),
+            ]
+
+    def render(self, report):
+        stream = io.StringIO()
+        report.generate().display("json", stream)
+        return stream.getvalue()
+
+    def test_concurrent_matches_serial(self):
+        projects = sorted(self.changes.keys())
+        for klass in [ReportPatchReviewStats, ReportPatchReviewRate]:
+            serial = klass(FakeClient(self.changes), projects, jobs=1)
+            client = FakeClient(self.changes)
+            parallel = klass(client, projects, jobs=3)
+
+            self.assertEqual(self.render(serial), self.render(parallel))
+            self.assertEqual(len(client.calls), len(projects))
+
+    def test_todo_lists(self):
+        def numbers(report):
+            return sorted([row.data.number for row in report.generate().rows])
+
+        client = FakeClient(self.changes)
+        self.assertEqual(numbers(ReportToDoListMine(client, "alice", projects=["nova"])),
+                         [22, 23])
+        self.assertEqual(numbers(ReportToDoListOthers(client, "carol", bots=["bob"],
+                                                      projects=["nova"])),
+                         [21, 23])
+        self.assertEqual(numbers(ReportToDoListNoones(client, "carol",
+                                                      bots=["alice", "user2"],
+                                                      projects=["nova"])),
+                         [21, 23])
+        self.assertEqual(numbers(ReportToDoListApprovable(client, "carol", False,
+                                                          projects=["nova"])),
+                         [21])
+        self.assertEqual(numbers(ReportToDoListApprovable(client, "alice", False,
+                                                          projects=["nova"])),
+                         [])
+
+    def test_query_patches(self):
+        client = FakeClient(self.changes)
+        report = ReportChanges(client, projects=["nova"])
+        self.assertEqual(report.get_query_patches(),
+                         (OperationQuery.PATCHES_CURRENT, False))
+        # The columns are shared by every report
+        visible = [(col, col.visible) for col in report.get_columns()]
+        try:
+            for col in report.get_columns():
+                if col.key in ["approvals", "tests", "reviews", "workflow"]:
+                    col.visible = False
+            self.assertEqual(report.get_query_patches(),
+                             (OperationQuery.PATCHES_NONE, False))
+            report.generate()
+            self.assertNotIn("--current-patch-set", client.calls[-1])
+            self.assertNotIn("--files", client.calls[-1])
+
+            # Sorting by votes needs them, as do files to match
+            report.set_sort_column("reviews")
+            self.assertEqual(report.get_query_patches(),
+                             (OperationQuery.PATCHES_CURRENT, False))
+            report = ReportChanges(client, projects=["nova"], files=["^nova/"])
+            self.assertEqual(report.get_query_patches(),
+                             (OperationQuery.PATCHES_CURRENT, False))
+        finally:
+            for col, wasvisible in visible:
+                col.visible = wasvisible
+
+        self.assertEqual(ReportToDoListMine(client, "alice").get_query_patches(),
+                         (OperationQuery.PATCHES_CURRENT, False))
+        self.assertEqual(ReportToDoListOthers(client, "alice").get_query_patches(),
+                         (OperationQuery.PATCHES_ALL, True))
+
+
+if __name__ == '__main__':
+    unittest.main()